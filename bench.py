@@ -0,0 +1,488 @@
+#!/usr/bin/env python3
+"""
+Benchmark / load-test harness for bot.py.
+
+Starts a local fake Telegram Bot API (with configurable latency, error and 429
+injection), points the bot at it via TELEGRAM_API_URL, and replays synthetic webhook
+update streams straight into the FastAPI `app` over ASGI (no network, no uvicorn).
+
+For every scenario it reports throughput, webhook ack latency, end-to-end
+process_update latency (p50/p99) and Bot API calls per update.
+
+Usage:
+    python bench.py                               # all scenarios, defaults
+    python bench.py -s user_text -s user_photo -n 2000 --latency 40 --jitter 20
+    python bench.py --error-rate 0.02 --rate-limit-rate 0.01 --retry-after 1
+    python bench.py --output bench_output.txt
+    python bench.py -s user_text --no-limits      # lift the bot's rate limits and flood control
+
+The bot's API rate limits and per-user flood control stay on by default, as in
+production. Every user message is notified to each admin and an admin chat takes
+about API_CHAT_RATE (1) message/s. Updates are still processed right away (admin
+notifications are queued), but scenarios that notify admins only go idle at roughly
+1 update/s; --no-limits lifts the limits to measure the bot's own overhead.
+
+Runs in a temporary directory, so bot_data.json & co. are never touched.
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import socket
+import sys
+import tempfile
+import time
+import urllib.parse
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+ADMIN_ID = 7627349162   # first entry of bot.ADMIN_IDS
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+# -------------------- Fake Bot API --------------------
+class FakeTelegramServer:
+    """
+    Minimal HTTP/1.1 keep-alive server that answers Bot API calls like Telegram would.
+
+    latency/jitter are in seconds; error_rate returns 500s, rate_limit_rate returns
+    429 with `retry_after`. Every call is counted per method.
+    """
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0,
+                 rate_limit_rate: float = 0.0, retry_after: int = 1, seed: int = 1) -> None:
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.rng = random.Random(seed)
+        self.message_ids = itertools.count(1000)
+        self.calls: Dict[str, int] = {}
+        self.connections = 0
+        self.server: Optional[asyncio.base_events.Server] = None
+        self.port = 0
+
+    def reset(self) -> None:
+        self.calls = {}
+        self.connections = 0
+
+    def total_calls(self) -> int:
+        return sum(self.calls.values())
+
+    async def start(self, port: int = 0) -> int:
+        self.server = await asyncio.start_server(self._handle, "127.0.0.1", port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self.port
+
+    async def stop(self) -> None:
+        if self.server:
+            self.server.close()
+
+    def _result(self, method: str, params: Dict[str, str]) -> Tuple[int, Dict[str, Any]]:
+        roll = self.rng.random()
+        if roll < self.rate_limit_rate:
+            return 429, {"ok": False, "error_code": 429, "description": "Too Many Requests: retry later",
+                         "parameters": {"retry_after": self.retry_after}}
+        if roll < self.rate_limit_rate + self.error_rate:
+            return 500, {"ok": False, "error_code": 500, "description": "Internal Server Error"}
+        chat = {"id": int(params.get("chat_id") or 0)}
+        if method in ("getMe",):
+            return 200, {"ok": True, "result": {"id": 1, "is_bot": True, "username": "bench_bot"}}
+        if method == "getWebhookInfo":
+            return 200, {"ok": True, "result": {"url": "", "pending_update_count": 0}}
+        if method in ("setWebhook", "deleteWebhook", "answerCallbackQuery"):
+            return 200, {"ok": True, "result": True}
+        if method == "getUpdates":
+            return 200, {"ok": True, "result": []}
+        if method == "sendMediaGroup":
+            media = json.loads(params.get("media") or "[]")
+            return 200, {"ok": True, "result": [
+                {"message_id": next(self.message_ids), "chat": chat, "date": int(time.time())} for _ in media
+            ]}
+        if method == "copyMessage":
+            return 200, {"ok": True, "result": {"message_id": next(self.message_ids)}}
+        return 200, {"ok": True, "result": {"message_id": next(self.message_ids), "chat": chat,
+                                            "date": int(time.time())}}
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.connections += 1
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                path = request_line.split()[1].decode()
+                headers: Dict[str, str] = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    key, _, value = line.decode("latin-1").partition(":")
+                    headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length") or 0))
+                method = path.rsplit("/", 1)[-1]
+                params = dict(urllib.parse.parse_qsl(body.decode()))
+                self.calls[method] = self.calls.get(method, 0) + 1
+                delay = self.latency + (self.rng.random() * self.jitter if self.jitter else 0.0)
+                if delay:
+                    await asyncio.sleep(delay)
+                status, payload = self._result(method, params)
+                data = json.dumps(payload).encode()
+                writer.write(
+                    f"HTTP/1.1 {status} OK\r\nContent-Type: application/json\r\n"
+                    f"Content-Length: {len(data)}\r\n\r\n".encode() + data
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass   # client went away, or the loop is shutting down
+        finally:
+            writer.close()
+
+
+# -------------------- ASGI driver --------------------
+class AsgiClient:
+    """Calls the ASGI app in-process: lifespan startup/shutdown and JSON POSTs."""
+
+    def __init__(self, app: Any) -> None:
+        self.app = app
+        self._lifespan_task: Optional[asyncio.Task] = None
+        self._lifespan_in: asyncio.Queue = asyncio.Queue()
+        self._lifespan_out: asyncio.Queue = asyncio.Queue()
+
+    async def startup(self) -> None:
+        async def receive() -> Dict[str, Any]:
+            return await self._lifespan_in.get()
+
+        async def send(message: Dict[str, Any]) -> None:
+            await self._lifespan_out.put(message)
+
+        scope = {"type": "lifespan", "asgi": {"version": "3.0"}, "state": {}}
+        self._lifespan_task = asyncio.get_running_loop().create_task(self.app(scope, receive, send))
+        await self._lifespan_in.put({"type": "lifespan.startup"})
+        msg = await self._lifespan_out.get()
+        if msg["type"] != "lifespan.startup.complete":
+            raise RuntimeError(f"startup failed: {msg}")
+
+    async def shutdown(self) -> None:
+        await self._lifespan_in.put({"type": "lifespan.shutdown"})
+        await self._lifespan_out.get()
+        if self._lifespan_task:
+            await self._lifespan_task
+
+    async def request(self, method: str, path: str, payload: Any = None) -> Tuple[int, bytes]:
+        body = json.dumps(payload).encode() if payload is not None else b""
+        scope = {
+            "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1",
+            "method": method, "scheme": "http", "path": path, "raw_path": path.encode(),
+            "query_string": b"", "root_path": "",
+            "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+            "client": ("127.0.0.1", 1), "server": ("127.0.0.1", 80),
+        }
+        sent = False
+        status = 0
+        chunks: List[bytes] = []
+
+        async def receive() -> Dict[str, Any]:
+            nonlocal sent
+            if not sent:
+                sent = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            await asyncio.Event().wait()   # never disconnects
+            return {"type": "http.disconnect"}
+
+        async def send(message: Dict[str, Any]) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                chunks.append(message.get("body", b""))
+
+        await self.app(scope, receive, send)
+        return status, b"".join(chunks)
+
+
+# -------------------- Update streams --------------------
+UPDATE_IDS = itertools.count(1)
+MESSAGE_IDS = itertools.count(1)
+
+class UpdateFactory:
+    def __init__(self, users: int, seed: int = 7) -> None:
+        self.users = users
+        self.rng = random.Random(seed)
+        # shared across scenarios: repeated update_ids would be dropped by the dedup cache
+        self.update_ids = UPDATE_IDS
+        self.message_ids = MESSAGE_IDS
+        self.album_user: Dict[str, Any] = {}
+        self.album_id = ""
+        self.album_left = 0
+
+    def _user(self) -> Dict[str, Any]:
+        uid = 10_000 + self.rng.randrange(self.users)
+        return {"id": uid, "first_name": f"User{uid}", "username": f"user{uid}"}
+
+    def _message(self, frm: Dict[str, Any], **fields: Any) -> Dict[str, Any]:
+        msg = {"message_id": next(self.message_ids), "date": int(time.time()),
+               "chat": {"id": frm["id"], "type": "private"}, "from": frm}
+        msg.update(fields)
+        return {"update_id": next(self.update_ids), "message": msg}
+
+    def user_text(self) -> Dict[str, Any]:
+        return self._message(self._user(), text="hello, I need help with my order #%d" % self.rng.randrange(10**6))
+
+    def user_photo(self) -> Dict[str, Any]:
+        sizes = [{"file_id": f"photo-{self.rng.randrange(10**9)}-{i}", "width": 90 * (i + 1)} for i in range(3)]
+        return self._message(self._user(), photo=sizes, caption="see screenshot")
+
+    def user_album(self) -> Dict[str, Any]:
+        # consecutive calls return the parts of 3-photo albums from one user
+        if not self.album_left:
+            self.album_user, self.album_id, self.album_left = self._user(), str(self.rng.randrange(10**12)), 3
+        self.album_left -= 1
+        photo = [{"file_id": f"photo-{self.rng.randrange(10**9)}", "width": 1280}]
+        return self._message(self.album_user, photo=photo, media_group_id=self.album_id)
+
+    def user_video(self) -> Dict[str, Any]:
+        return self._message(self._user(), video={"file_id": f"video-{self.rng.randrange(10**9)}"})
+
+    def user_sticker(self) -> Dict[str, Any]:
+        return self._message(self._user(), sticker={"file_id": f"sticker-{self.rng.randrange(10**9)}"})
+
+    def admin_reply(self) -> Dict[str, Any]:
+        # replies to a notification mapped by seed_threads()
+        admin = {"id": ADMIN_ID, "first_name": "Admin"}
+        replied = {"message_id": 1 + self.rng.randrange(self.users), "chat": {"id": ADMIN_ID}}
+        return self._message(admin, text="thanks, fixed!", reply_to_message=replied)
+
+    def callback(self) -> Dict[str, Any]:
+        uid = 10_000 + self.rng.randrange(self.users)
+        action = self.rng.choice(["copyuid", "prep_reply", "prep_send_media"])
+        return {"update_id": next(self.update_ids), "callback_query": {
+            "id": str(self.rng.randrange(10**12)), "from": {"id": ADMIN_ID},
+            "message": {"message_id": 1, "chat": {"id": ADMIN_ID}}, "data": f"{action}:{uid}",
+        }}
+
+    def broadcast(self) -> Dict[str, Any]:
+        admin = {"id": ADMIN_ID, "first_name": "Admin"}
+        return self._message(admin, text="/broadcast scheduled maintenance tonight")
+
+
+SCENARIOS: Dict[str, Callable[[UpdateFactory], Dict[str, Any]]] = {
+    "user_text": UpdateFactory.user_text,
+    "user_photo": UpdateFactory.user_photo,
+    "user_album": UpdateFactory.user_album,
+    "user_video": UpdateFactory.user_video,
+    "user_sticker": UpdateFactory.user_sticker,
+    "admin_reply": UpdateFactory.admin_reply,
+    "callback": UpdateFactory.callback,
+    "broadcast": UpdateFactory.broadcast,
+}
+
+def mixed(factory: UpdateFactory) -> Dict[str, Any]:
+    roll = factory.rng.random()
+    if roll < 0.55:
+        return factory.user_text()
+    if roll < 0.70:
+        return factory.user_photo()
+    if roll < 0.75:
+        return factory.user_video()
+    if roll < 0.82:
+        return factory.user_sticker()
+    if roll < 0.94:
+        return factory.admin_reply()
+    return factory.callback()
+
+SCENARIOS["mixed"] = mixed
+
+
+# -------------------- Runner --------------------
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * (len(ordered) - 1)))))
+    return ordered[idx]
+
+async def wait_idle(bot: Any, timeout: float) -> None:
+    """
+    Wait until the update queue, buffered albums, queued admin notifications, flood and
+    admin digests and all broadcast jobs have finished. Held flood and admin digests are
+    sent once the queue is drained rather than after their (much longer) windows.
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        busy_jobs = [j for j in bot.BROADCASTS.jobs.values() if j.status == "running"]
+        drained = bot.UPDATES.depth() == 0 and bot.UPDATES.processed >= bot.UPDATES.enqueued
+        if drained and not bot.ALBUMS.busy():
+            for buffer in (bot.FLOOD, bot.DIGEST):
+                if buffer.pending:
+                    await buffer.flush()
+        if (drained and not busy_jobs
+                and not any(b.busy() for b in (bot.ALBUMS, bot.FLOOD, bot.NOTIFIER, bot.DIGEST))):
+            return
+        await asyncio.sleep(0.01)
+    print("  ! timed out waiting for the bot to go idle")
+
+async def run_scenario(bot: Any, client: AsgiClient, fake: FakeTelegramServer, name: str,
+                       count: int, concurrency: int, users: int) -> Dict[str, Any]:
+    factory = UpdateFactory(users)
+    make = SCENARIOS[name]
+    if name == "broadcast":
+        count = min(count, 3)   # each broadcast already fans out to every seen chat
+    updates = [make(factory) for _ in range(count)]
+
+    fake.reset()
+    processed_before = bot.UPDATES.processed
+    process_times: List[float] = []
+    original = bot.process_update
+
+    async def timed_process_update(upd: Dict[str, Any]) -> None:
+        t0 = time.perf_counter()
+        try:
+            await original(upd)
+        finally:
+            process_times.append(time.perf_counter() - t0)
+
+    bot.process_update = timed_process_update
+    ack_times: List[float] = []
+    statuses: Dict[int, int] = {}
+    sem = asyncio.Semaphore(concurrency)
+
+    async def post(upd: Dict[str, Any]) -> None:
+        async with sem:
+            t0 = time.perf_counter()
+            status, _ = await client.request("POST", "/webhook", upd)
+            ack_times.append(time.perf_counter() - t0)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    t_start = time.perf_counter()
+    try:
+        await asyncio.gather(*(post(u) for u in updates))
+        await wait_idle(bot, timeout=max(60.0, count * 0.5))
+    finally:
+        bot.process_update = original
+    wall = time.perf_counter() - t_start
+    processed = bot.UPDATES.processed - processed_before
+
+    return {
+        "scenario": name,
+        "updates": count,
+        "processed": processed,
+        "wall_s": wall,
+        "throughput": processed / wall if wall else 0.0,
+        "ack_p50_ms": percentile(ack_times, 50) * 1000,
+        "ack_p99_ms": percentile(ack_times, 99) * 1000,
+        "proc_p50_ms": percentile(process_times, 50) * 1000,
+        "proc_p99_ms": percentile(process_times, 99) * 1000,
+        "api_calls": fake.total_calls(),
+        "api_per_update": fake.total_calls() / max(processed, 1),
+        "api_by_method": dict(sorted(fake.calls.items())),
+        "http_status": statuses,
+        "connections": fake.connections,
+    }
+
+def format_report(results: List[Dict[str, Any]]) -> str:
+    header = (f"{'scenario':<13} {'updates':>7} {'upd/s':>9} {'ack p50':>9} {'ack p99':>9} "
+              f"{'proc p50':>9} {'proc p99':>9} {'api/upd':>8} {'conns':>6}")
+    lines = [header, "-" * len(header)]
+    for r in results:
+        lines.append(
+            f"{r['scenario']:<13} {r['processed']:>7} {r['throughput']:>9.1f} {r['ack_p50_ms']:>7.2f}ms "
+            f"{r['ack_p99_ms']:>7.2f}ms {r['proc_p50_ms']:>7.2f}ms {r['proc_p99_ms']:>7.2f}ms "
+            f"{r['api_per_update']:>8.2f} {r['connections']:>6}"
+        )
+    lines.append("")
+    for r in results:
+        lines.append(f"{r['scenario']}: api calls {r['api_by_method']} http {r['http_status']}")
+    return "\n".join(lines)
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+async def main_async(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    fake = FakeTelegramServer(latency=args.latency / 1000.0, jitter=args.jitter / 1000.0,
+                              error_rate=args.error_rate, rate_limit_rate=args.rate_limit_rate,
+                              retry_after=args.retry_after)
+    port = free_port()
+    await fake.start(port)
+
+    # the bot reads its config at import time, so set it up first
+    os.environ["BOT_TOKEN"] = "bench:token"
+    os.environ["TELEGRAM_API_URL"] = f"http://127.0.0.1:{port}"
+    os.environ.pop("BASE_URL", None)
+    if args.no_limits:
+        for key in ("API_GLOBAL_RATE", "API_CHAT_RATE", "API_GROUP_RATE", "BROADCAST_RATE"):
+            os.environ[key] = "1e9"
+        os.environ["FLOOD_LIMIT"] = "0"
+    for key, value in args.env:
+        os.environ[key] = value
+    sys.path.insert(0, HERE)
+    import bot
+
+    client = AsgiClient(bot.app)
+    await client.startup()
+    # the store loads in the background after startup; seeding before that finishes
+    # would be overwritten by the load
+    await bot.UPDATES.ready.wait()
+    # give the admin_reply stream notifications to reply to
+    await bot.store_thread_maps([(ADMIN_ID, i, 10_000 + i - 1) for i in range(1, args.users + 1)])
+    for i in range(args.users):
+        await bot.store_io(bot.STORE.add_seen_chat, 10_000 + i)
+
+    results = []
+    try:
+        for name in args.scenario or list(SCENARIOS):
+            print(f"running {name} ...", flush=True)
+            results.append(await run_scenario(bot, client, fake, name, args.updates,
+                                              args.concurrency, args.users))
+    finally:
+        await client.shutdown()
+        await fake.stop()
+    return results
+
+def env_setting(text: str) -> Tuple[str, str]:
+    """argparse type for --env KEY=VALUE."""
+    key, sep, value = text.partition("=")
+    if not sep or not key:
+        raise argparse.ArgumentTypeError(f"expected KEY=VALUE, got {text!r}")
+    return key, value
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark bot.py against a local fake Bot API.")
+    parser.add_argument("-s", "--scenario", action="append", choices=sorted(SCENARIOS),
+                        help="scenario to run (repeatable); default: all")
+    parser.add_argument("-n", "--updates", type=int, default=60,
+                        help="updates per scenario (admin notifications run at ~1/s unless --no-limits)")
+    parser.add_argument("-c", "--concurrency", type=int, default=32, help="concurrent webhook deliveries")
+    parser.add_argument("--users", type=int, default=200, help="distinct users/chats in the stream")
+    parser.add_argument("--latency", type=float, default=30.0, help="fake API latency (ms)")
+    parser.add_argument("--jitter", type=float, default=10.0, help="extra random latency (ms)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of API calls answered with 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="fraction answered with 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after for injected 429s (s)")
+    parser.add_argument("--no-limits", action="store_true",
+                        help="lift the bot's rate limits and flood control (default: kept, as in production)")
+    parser.add_argument("--env", action="append", default=[], type=env_setting,
+                        metavar="KEY=VALUE", help="extra bot config, e.g. --env STORE_BACKEND=sqlite")
+    parser.add_argument("--output", help="also write the report to this file")
+    parser.add_argument("--json", action="store_true", help="print raw results as JSON")
+    args = parser.parse_args()
+    if args.output:
+        args.output = os.path.abspath(args.output)
+
+    workdir = tempfile.mkdtemp(prefix="bot-bench-")
+    os.chdir(workdir)
+    results = asyncio.run(main_async(args))
+    report = json.dumps(results, indent=2) if args.json else format_report(results)
+    print()
+    print(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as fh:
+            fh.write(report + "\n")
+
+if __name__ == "__main__":
+    main()
@@ -1,644 +1,4690 @@
 #!/usr/bin/env python3
 """
-Telegram support bot using FastAPI + Webhook (for Render deployment)
+Telegram support bot using FastAPI + Webhook (for Render deployment), or getUpdates
+long polling where there is no public URL (`python bot.py`, BOT_MODE=polling).
 
 Features:
- - Users send messages/media/stickers -> bot forwards media to all admins and notifies admins (quoted text).
+ - Users send messages/media/stickers -> bot copies media (any type) to all admins and notifies admins (quoted text).
  - Admins get buttons: Copy user_id, Prepare Reply, Prepare Send Media.
- - Admin can reply to forwarded admin-message -> bot forwards reply to original user (text/photo/video/sticker).
+ - Admin can reply to forwarded admin-message -> bot copies the reply to original user (any message type).
  - Admin can send media via /send_media flows.
+ - Optional digest mode (DIGEST_MODE=on|auto): under load, text messages from many users reach each
+   admin as one combined message; replying "#N <text>" to it answers user N.
+ - Albums (photos/videos sharing a media_group_id) are collected and sent on as one media group,
+   with a single admin notification per album; admin album replies go to the user the same way.
  - Admin can use /send_sticker <chat_id> then send a sticker which will be forwarded to that chat.
- - Admin can use /sendtoalluser <message> to message all known chats.
+ - Admin can use /sendtoalluser <message> (or /broadcast) to message all known chats; this runs as a
+   rate-limited background job that resumes after a restart (/broadcast_status, /broadcast_cancel).
  - All state persisted in bot_data.json:
-     seen_chats, inbox (recent messages), thread_map (adminMsg -> userChat), pending_sticker.
+     seen_chats (+ last seen / blocked per chat), inbox (recent messages), threads (adminMsg -> userChat, expire after THREAD_TTL), pending_sticker.
 """
 
+import asyncio
+import atexit
+import bisect
+import contextlib
+import contextvars
+import functools
+import heapq
 import json
+import logging
+import logging.handlers
+import queue
+import random
+import re
 import time
-import urllib.request
 import urllib.parse
-import traceback
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import Any, Dict, Optional
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterator, List, Optional, Set, Tuple
 import ssl
+import sqlite3
 import os
+import secrets
+import signal
+import socket
+
+try:
+    import fcntl   # POSIX only; needed for the shared-file backend and cross-process locks
+except ImportError:
+    fcntl = None
 
 from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, PlainTextResponse
+
+IMPORT_STARTED = time.perf_counter()   # startup timing, see startup_phase()
+
+# -------------------- CONFIG --------------------
+BOT_TOKEN = os.getenv("BOT_TOKEN")
+if not BOT_TOKEN:
+    raise RuntimeError("BOT_TOKEN environment variable not set!")
+
+ADMIN_IDS = [7627349162, 5980759440]  # yahan apne admin telegram user IDs
+DATA_FILE = "bot_data.json"
+BOT_MODE = os.getenv("BOT_MODE", "webhook")   # webhook | polling (`python bot.py` defaults to polling)
+POLL_INTERVAL = 1.0                # polling mode: pause after a failed getUpdates
+POLL_TIMEOUT = int(os.getenv("POLL_TIMEOUT", "50"))   # getUpdates long-poll seconds
+POLL_LIMIT = int(os.getenv("POLL_LIMIT", "100"))      # updates per getUpdates batch (Telegram max 100)
+INBOX_LIMIT = 1000
+THREAD_TTL = float(os.getenv("THREAD_TTL", str(14 * 24 * 3600)))  # admin replies route for this long
+THREAD_MAX = int(os.getenv("THREAD_MAX", "50000"))                # thread mappings kept (LRU beyond that)
+THREAD_FILE = os.getenv("THREAD_FILE")      # optional sidecar for thread mappings instead of bot_data.json
+CHAT_SEEN_RESOLUTION = 3600                 # a chat's last_seen is rewritten at most this often (s)
+CHAT_MAX_FAILURES = int(os.getenv("CHAT_MAX_FAILURES", "3"))    # 4xx delivery failures in a row -> blocked
+NOTIFY_CONCURRENCY = int(os.getenv("NOTIFY_CONCURRENCY", "8"))  # admins notified in parallel
+NOTIFY_WORKERS = int(os.getenv("NOTIFY_WORKERS", "16"))         # users whose admin notifications go out in parallel
+NOTIFY_QUEUE_SIZE = int(os.getenv("NOTIFY_QUEUE_SIZE", "100"))  # queued admin notifications; text beyond -> digest
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "8"))          # parallel chats in process_update
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", "1000"))   # pending updates before backpressure
+UPDATE_ENQUEUE_TIMEOUT = float(os.getenv("UPDATE_ENQUEUE_TIMEOUT", "1.0"))
+DEDUP_SIZE = int(os.getenv("DEDUP_SIZE", "10000"))         # recent update_ids remembered
+DEDUP_TTL = float(os.getenv("DEDUP_TTL", str(24 * 3600)))  # Telegram stops redelivering after a day
+DEDUP_FILE = os.getenv("DEDUP_FILE")                        # optional: keep the cache across restarts
+ALBUM_WAIT = float(os.getenv("ALBUM_WAIT", "1.0"))   # seconds to wait for more parts of an album
+FLOOD_WINDOW = float(os.getenv("FLOOD_WINDOW", "60"))  # sliding window for per-user flood control (s)
+FLOOD_LIMIT = int(os.getenv("FLOOD_LIMIT", "5"))        # messages per window notified one by one; 0 = off
+FLOOD_DIGEST_LINES = 20                                 # held messages quoted in one flood digest
+DIGEST_MODE = os.getenv("DIGEST_MODE", "off")            # admin digests for text messages: off | on | auto
+DIGEST_WINDOW = float(os.getenv("DIGEST_WINDOW", "10"))  # seconds gathered into one digest
+DIGEST_MAX_USERS = int(os.getenv("DIGEST_MAX_USERS", "10"))       # users per digest (one button row each)
+DIGEST_AUTO_THRESHOLD = int(os.getenv("DIGEST_AUTO_THRESHOLD", "20"))  # auto: msgs per window that switch it on
+BROADCAST_FILE = os.getenv("BROADCAST_FILE", "broadcast_jobs.json")
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))       # bulk msgs/sec, leaves room for replies
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", "8"))
+STATS_FILE = os.getenv("STATS_FILE", "bot_stats.json")   # /stats rollups (hourly and daily counters)
+STATS_DAYS = int(os.getenv("STATS_DAYS", "30"))           # days of daily counters kept
+STORE_FLUSH_INTERVAL = float(os.getenv("STORE_FLUSH_INTERVAL", "2.0"))  # debounce for bot_data.json writes
+STORE_BACKEND = os.getenv("STORE_BACKEND", "json")      # json | journal | sqlite | shared | kv
+JOURNAL_FILE = os.getenv("JOURNAL_FILE", "bot_data.journal")
+JOURNAL_COMPACT_BYTES = int(os.getenv("JOURNAL_COMPACT_BYTES", str(4 * 1024 * 1024)))
+KV_URL = os.getenv("KV_URL")                 # redis://host:6379/0 for STORE_BACKEND=kv
+KV_PREFIX = os.getenv("KV_PREFIX", "bot:")
+SQLITE_FILE = os.getenv("SQLITE_FILE", "bot_data.sqlite3")
+SQLITE_INBOX_LIMIT = int(os.getenv("SQLITE_INBOX_LIMIT", "100000"))  # inbox rows kept by the sqlite backend
+API_ROOT = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org").rstrip("/")  # override for a local fake API
+API_BASE = f"{API_ROOT}/bot{BOT_TOKEN}/"
+API_TIMEOUT = float(os.getenv("API_TIMEOUT", "30"))
+API_CONNECT_TIMEOUT = float(os.getenv("API_CONNECT_TIMEOUT", "10"))
+API_POOL_SIZE = int(os.getenv("API_POOL_SIZE", "16"))              # idle keep-alive connections kept
+API_MAX_CONCURRENCY = int(os.getenv("API_MAX_CONCURRENCY", "32"))  # max in-flight API requests
+API_GLOBAL_RATE = float(os.getenv("API_GLOBAL_RATE", "30"))     # sends/sec across all chats (Telegram: ~30)
+API_CHAT_RATE = float(os.getenv("API_CHAT_RATE", "1"))          # sends/sec to one private chat
+API_GROUP_RATE = float(os.getenv("API_GROUP_RATE", str(20 / 60)))  # sends/sec to one group (20/min)
+API_CHAT_BURST = float(os.getenv("API_CHAT_BURST", "3"))        # short bursts allowed per chat
+API_MAX_RETRIES = int(os.getenv("API_MAX_RETRIES", "3"))        # retries after 429 / 5xx / network errors
+API_RETRY_BACKOFF = float(os.getenv("API_RETRY_BACKOFF", "0.5"))  # first retry delay, doubled each time
+API_VERIFY_TLS = os.getenv("API_VERIFY_TLS", "0") == "1"        # verify the API's TLS certificate
+
+BASE_URL = os.getenv("BASE_URL")   # e.g. https://ankit-bot.onrender.com
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")          # json (one object per line) | text
+LOG_SAMPLE = float(os.getenv("LOG_SAMPLE", "0.01"))   # share of routine success records kept (0..1)
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))  # records buffered before new ones are dropped
+
+# -------------------- Logging --------------------
+# Records are formatted into a bounded queue by the caller and written to stderr by a
+# background thread, so a slow or blocked stream never stalls the event loop. When the
+# queue is full new records are dropped and counted rather than waited on.
+log = logging.getLogger("bot")
+
+# update_id / chat_id / admin_id / command / method of the work in progress; set with
+# log_context() and attached to every record logged underneath it (tasks inherit it)
+LOG_CONTEXT: contextvars.ContextVar[Dict[str, Any]] = contextvars.ContextVar("log_context", default={})
+
+@contextlib.contextmanager
+def log_context(**fields: Any) -> Iterator[None]:
+    token = LOG_CONTEXT.set({**LOG_CONTEXT.get(), **fields})
+    try:
+        yield
+    finally:
+        LOG_CONTEXT.reset(token)
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that captures LOG_CONTEXT and never blocks on a full queue."""
+
+    def __init__(self, q: "queue.Queue[Any]") -> None:
+        super().__init__(q)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # resolve everything that can't cross threads (args, traceback, context) here
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        record.ctx = LOG_CONTEXT.get()
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class LogQueueListener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self) -> None:
+        self.queue.put(self._sentinel)   # the writer thread is draining, so this can wait
+
+
+class JsonLogFormatter(logging.Formatter):
+    """One JSON object per line: ts, level, msg, context tags, `data` fields, exc."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry: Dict[str, Any] = {
+            "ts": round(record.created, 3),
+            "level": record.levelname.lower(),
+            "msg": record.getMessage(),
+        }
+        entry.update(getattr(record, "ctx", None) or {})
+        entry.update(getattr(record, "data", None) or {})
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextLogFormatter(logging.Formatter):
+    def __init__(self) -> None:
+        super().__init__("%(asctime)s %(levelname)s %(message)s")
+
+    def formatMessage(self, record: logging.LogRecord) -> str:
+        fields = {**(getattr(record, "ctx", None) or {}), **(getattr(record, "data", None) or {})}
+        line = super().formatMessage(record)
+        return line + "".join(f" {k}={v}" for k, v in fields.items())
+
+
+LOG_HANDLER = LogQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+LOG_LISTENER: Optional[LogQueueListener] = None
+
+def setup_logging() -> None:
+    """Attach the queue handler to the "bot" logger and start the writer thread."""
+    global LOG_LISTENER
+    if LOG_LISTENER is not None:
+        return
+    stream = logging.StreamHandler()
+    stream.setFormatter(TextLogFormatter() if LOG_FORMAT == "text" else JsonLogFormatter())
+    LOG_LISTENER = LogQueueListener(LOG_HANDLER.queue, stream)
+    LOG_LISTENER.start()
+    log.addHandler(LOG_HANDLER)
+    log.setLevel(LOG_LEVEL)
+    log.propagate = False
+    atexit.register(stop_logging)
+
+def stop_logging() -> None:
+    """Write out whatever is still queued and stop the writer thread."""
+    global LOG_LISTENER
+    if LOG_LISTENER is not None:
+        LOG_LISTENER.stop()
+        LOG_LISTENER = None
+
+def log_sampled(msg: str, *args: Any, **data: Any) -> None:
+    """
+    Routine success record (update processed, API call ok): kept for a LOG_SAMPLE share
+    of calls, tagged with the rate so counts can be scaled back up.
+    """
+    if LOG_SAMPLE <= 0 or (LOG_SAMPLE < 1 and random.random() >= LOG_SAMPLE):
+        return
+    if log.isEnabledFor(logging.INFO):
+        data["sample"] = LOG_SAMPLE
+        log.info(msg, *args, extra={"data": data})
+
+def log_stats() -> Dict[str, int]:
+    return {"queued": LOG_HANDLER.queue.qsize(), "dropped": LOG_HANDLER.dropped}
+
+# -------------------- Metrics --------------------
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def _label_str(labels: Tuple[Tuple[str, Any], ...], extra: str = "") -> str:
+    parts = [
+        '{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in labels
+    ]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Counter:
+    def __init__(self, name: str, doc: str) -> None:
+        self.name = name
+        self.doc = doc
+        self.values: Dict[Tuple[Tuple[str, Any], ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels: Any) -> None:
+        key = tuple(sorted(labels.items()))
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        out = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} counter"]
+        out += [f"{self.name}{_label_str(k)} {v}" for k, v in self.values.items()]
+        return out
+
+
+class Gauge:
+    """Gauge read at scrape time from `fn` (a number, or a {label_value: number} dict for `label`)."""
+
+    def __init__(self, name: str, doc: str, fn: Callable[[], Any], label: Optional[str] = None) -> None:
+        self.name = name
+        self.doc = doc
+        self.fn = fn
+        self.label = label
+
+    def render(self) -> List[str]:
+        out = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} gauge"]
+        value = self.fn()
+        if isinstance(value, dict):
+            out += [f"{self.name}{_label_str(((self.label, k),))} {v}" for k, v in value.items()]
+        else:
+            out.append(f"{self.name} {value}")
+        return out
+
+
+class Histogram:
+    def __init__(self, name: str, doc: str, buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        self.name = name
+        self.doc = doc
+        self.buckets = buckets
+        # labels -> [per-bucket counts..., +Inf count, sum]
+        self.series: Dict[Tuple[Tuple[str, Any], ...], List[float]] = {}
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = tuple(sorted(labels.items()))
+        row = self.series.get(key)
+        if row is None:
+            row = self.series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        row[bisect.bisect_left(self.buckets, value)] += 1
+        row[-1] += value
+
+    def render(self) -> List[str]:
+        out = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} histogram"]
+        for key, row in self.series.items():
+            running = 0
+            for bound, n in zip(self.buckets, row):
+                running += n
+                le = 'le="%s"' % bound
+                out.append(f"{self.name}_bucket{_label_str(key, le)} {running}")
+            running += row[len(self.buckets)]
+            le = 'le="+Inf"'
+            out.append(f"{self.name}_bucket{_label_str(key, le)} {running}")
+            out.append(f"{self.name}_sum{_label_str(key)} {row[-1]}")
+            out.append(f"{self.name}_count{_label_str(key)} {running}")
+        return out
+
+
+METRICS: List[Any] = []
+
+def register_metric(metric: Any) -> Any:
+    METRICS.append(metric)
+    return metric
+
+def render_metrics() -> str:
+    lines: List[str] = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+API_LATENCY = register_metric(Histogram("bot_api_request_seconds", "Telegram Bot API call latency by method."))
+API_ERRORS = register_metric(Counter("bot_api_errors_total", "Failed Telegram Bot API calls by method and code."))
+STORE_LATENCY = register_metric(Histogram("bot_store_seconds", "State load/save latency by operation."))
+UPDATE_LATENCY = register_metric(Histogram("bot_update_seconds", "process_update latency by update type."))
+UPDATE_ERRORS = register_metric(Counter("bot_update_errors_total", "Updates that raised in process_update."))
+COMMAND_LATENCY = register_metric(Histogram("bot_command_seconds", "Command and callback handler latency."))
+NOTIFY_LATENCY = register_metric(Histogram("bot_notify_admins_seconds", "Admin fan-out latency per user message."))
+API_QUEUE_WAIT = register_metric(Histogram("bot_api_queue_wait_seconds", "Time API calls waited on rate limits."))
+API_RETRIES = register_metric(Counter("bot_api_retries_total", "Retried Telegram Bot API calls by method and reason."))
+register_metric(Gauge("bot_log_records", "Log records waiting to be written, and dropped on a full queue.",
+                      log_stats, label="event"))
+
+def update_type(upd: Dict[str, Any]) -> str:
+    for kind in ("message", "edited_message", "callback_query"):
+        if kind in upd:
+            return kind
+    return "other"
+
+# -------------------- HTTP / API --------------------
+# one SSL context for the whole process, made on the first https connection: loading
+# the system CA store is slow, so it stays out of the import. Certificates aren't
+# verified (as before) unless API_VERIFY_TLS=1.
+SSL_CONTEXT: Optional[ssl.SSLContext] = None
+
+def ssl_context() -> ssl.SSLContext:
+    global SSL_CONTEXT
+    if SSL_CONTEXT is None:
+        ctx = ssl.create_default_context()
+        if not API_VERIFY_TLS:
+            ctx.check_hostname = False
+            ctx.verify_mode = ssl.CERT_NONE
+        SSL_CONTEXT = ctx
+    return SSL_CONTEXT
+
+class PreEncoded(dict):
+    """
+    Params for sending one payload to many chats: every field except chat_id is
+    form-encoded once (encode_params) and the bytes are reused for each recipient.
+    """
+
+    def __init__(self, chat_id: Any, shared: bytes) -> None:
+        super().__init__(chat_id=chat_id)
+        self.shared = shared
+
+def encode_params(params: Optional[Dict[str, Any]]) -> bytes:
+    """Form-encode API params; dict/list values (reply_markup etc.) are sent as JSON."""
+    if not params:
+        return b""
+    if isinstance(params, PreEncoded):
+        return urllib.parse.urlencode({"chat_id": params["chat_id"]}).encode() + b"&" + params.shared
+    safe: Dict[str, Any] = {}
+    for k, v in params.items():
+        if isinstance(v, (dict, list)):
+            safe[k] = json.dumps(v, ensure_ascii=False)
+        else:
+            safe[k] = v
+    return urllib.parse.urlencode(safe).encode()
+
+
+class StaleConnection(ConnectionError):
+    """The connection closed before any byte of the response: safe to send again elsewhere."""
+
+
+class TelegramClient:
+    """
+    Minimal asyncio HTTP/1.1 client for the Bot API.
+
+    Connections are kept alive and reused from a small idle pool, the TLS context is
+    shared, and at most `max_concurrency` requests are in flight at once.
+    Works with plain http:// too, so it can be pointed at a local fake API server.
+    """
+
+    def __init__(self, base_url: str, pool_size: int = 16, max_concurrency: int = 32,
+                 timeout: float = 30.0, connect_timeout: float = 10.0) -> None:
+        parts = urllib.parse.urlsplit(base_url)
+        self.secure = parts.scheme == "https"
+        self.host = parts.hostname or ""
+        self.port = parts.port or (443 if self.secure else 80)
+        self.host_header = parts.netloc.rsplit("@", 1)[-1]
+        self.path = parts.path if parts.path.endswith("/") else parts.path + "/"
+        self.pool_size = pool_size
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self._idle: List[Tuple[asyncio.StreamReader, asyncio.StreamWriter]] = []
+        self._sem: Optional[asyncio.Semaphore] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def _bind_loop(self) -> asyncio.Semaphore:
+        # pooled streams and the semaphore belong to one event loop; start fresh on a new one
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop or self._sem is None:
+            for _, writer in self._idle:
+                writer.transport.abort()
+            self._idle = []
+            self._sem = asyncio.Semaphore(self.max_concurrency)
+            self._loop = loop
+        return self._sem
+
+    async def _connect(self) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        return await asyncio.wait_for(
+            asyncio.open_connection(
+                self.host, self.port,
+                ssl=ssl_context() if self.secure else None,
+                server_hostname=self.host if self.secure else None,
+            ),
+            self.connect_timeout,
+        )
+
+    def _take_idle(self) -> Optional[Tuple[asyncio.StreamReader, asyncio.StreamWriter]]:
+        while self._idle:
+            reader, writer = self._idle.pop()
+            if not writer.is_closing() and not reader.at_eof():
+                return reader, writer
+            writer.close()
+        return None
+
+    def _release(self, conn: Tuple[asyncio.StreamReader, asyncio.StreamWriter], keep_alive: bool) -> None:
+        if keep_alive and len(self._idle) < self.pool_size:
+            self._idle.append(conn)
+        else:
+            conn[1].close()
+
+    async def _roundtrip(self, conn: Tuple[asyncio.StreamReader, asyncio.StreamWriter],
+                         method: str, body: bytes) -> Tuple[int, bytes, bool]:
+        reader, writer = conn
+        head = (
+            f"POST {self.path}{method} HTTP/1.1\r\n"
+            f"Host: {self.host_header}\r\n"
+            "Content-Type: application/x-www-form-urlencoded\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: keep-alive\r\n\r\n"
+        )
+        try:
+            writer.write(head.encode("latin-1") + body)
+            await writer.drain()
+            status_line = await reader.readline()
+        except ConnectionError as exc:
+            raise StaleConnection(str(exc) or exc.__class__.__name__) from exc
+        if not status_line:
+            raise StaleConnection("connection closed by server")
+        version, status, _ = (status_line.decode("latin-1").split(None, 2) + ["", ""])[:3]
+        headers: Dict[str, str] = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            key, _, value = line.decode("latin-1").partition(":")
+            headers[key.strip().lower()] = value.strip()
+
+        keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b";", 1)[0].strip() or b"0", 16)
+                if size == 0:
+                    # trailers, then the final blank line
+                    while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                        pass
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            payload = b"".join(chunks)
+        elif "content-length" in headers:
+            payload = await reader.readexactly(int(headers["content-length"]))
+        else:
+            payload = await reader.read()
+            keep_alive = False
+        return int(status), payload, keep_alive
+
+    @staticmethod
+    def _failed(error: str, sending: bool) -> Dict[str, Any]:
+        """Result for a request that got no answer; `unsent` if it never left this process."""
+        res: Dict[str, Any] = {"ok": False, "error": error}
+        if not sending:
+            res["unsent"] = True
+        return res
+
+    async def request(self, method: str, params: Optional[Dict[str, Any]] = None,
+                      timeout: Optional[float] = None) -> Dict[str, Any]:
+        body = encode_params(params)
+        sem = self._bind_loop()
+        async with sem:
+            for attempt in (1, 2):
+                conn = self._take_idle()
+                reused = conn is not None
+                sending = False   # once set, the server may have received the request
+                try:
+                    if conn is None:
+                        conn = await self._connect()
+                    sending = True
+                    status, payload, keep_alive = await asyncio.wait_for(
+                        self._roundtrip(conn, method, body), timeout or self.timeout
+                    )
+                except (ConnectionError, asyncio.IncompleteReadError) as exc:
+                    if conn is not None:
+                        conn[1].close()
+                    if isinstance(exc, StaleConnection) and reused and attempt == 1:
+                        # an idle keep-alive connection the server had already closed; once
+                        # any of the response has arrived the request can't be sent again
+                        continue
+                    log.warning("connection error: %r", exc)
+                    return self._failed(str(exc) or exc.__class__.__name__, sending)
+                except asyncio.TimeoutError:
+                    if conn is not None:
+                        conn[1].close()
+                    log.warning("API request timed out")
+                    return self._failed("timeout", sending)
+                except asyncio.CancelledError:
+                    # the response may be half read: the connection can't be reused
+                    if conn is not None:
+                        conn[1].close()
+                    raise
+                except Exception as exc:
+                    if conn is not None:
+                        conn[1].close()
+                    log.warning("API request failed: %r", exc)
+                    return self._failed(str(exc), sending)
+                self._release(conn, keep_alive)
+                break
+
+        try:
+            data = json.loads(payload.decode("utf-8"))
+        except Exception:
+            data = {"ok": False, "body": payload.decode("utf-8", errors="ignore")}
+        if status >= 400:
+            log.warning("HTTPError %s: %s", status, data.get("description") or data.get("body"))
+            data.setdefault("ok", False)
+            data["error"] = f"HTTPError {status}"
+            data["code"] = status
+        return data
+
+    async def close(self) -> None:
+        for _, writer in self._idle:
+            writer.close()
+        self._idle = []
+
+
+API_CLIENT = TelegramClient(
+    API_BASE,
+    pool_size=API_POOL_SIZE,
+    max_concurrency=API_MAX_CONCURRENCY,
+    timeout=API_TIMEOUT,
+    connect_timeout=API_CONNECT_TIMEOUT,
+)
+
+async def _api_call(method: str, params: Optional[Dict[str, Any]] = None,
+                    timeout: Optional[float] = None) -> Dict[str, Any]:
+    """One attempt over the pooled keep-alive client."""
+    t0 = time.perf_counter()
+    with log_context(method=method):
+        res = await API_CLIENT.request(method, params, timeout=timeout)
+    elapsed = time.perf_counter() - t0
+    API_LATENCY.observe(elapsed, method=method)
+    if not res.get("ok"):
+        API_ERRORS.inc(method=method, code=res.get("code") or res.get("error_code") or "network")
+    else:
+        log_sampled("API call ok", method=method, ms=round(elapsed * 1000, 1))
+    return res
+
+
+class TokenBucket:
+    """Token bucket limiter: `rate` tokens per second, bursts up to `capacity`; can be paused (429)."""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None) -> None:
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def pause(self, seconds: float) -> None:
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def try_acquire(self) -> bool:
+        now = time.monotonic()
+        if now < self.paused_until:
+            return False
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    async def acquire(self) -> None:
+        while not self.try_acquire():
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+            else:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+# Priority of the API calls made from the current task; broadcasts run as bulk so that
+# user acks and admin replies go first when the global limit is the bottleneck.
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+API_PRIORITY: contextvars.ContextVar[int] = contextvars.ContextVar("api_priority", default=PRIORITY_INTERACTIVE)
+
+# methods that post into a chat and count against Telegram's flood limits
+RATE_LIMITED_PREFIXES = ("send", "copyMessage", "forwardMessage", "editMessage")
+
+
+class ApiScheduler:
+    """
+    Flood-limit aware front of the Bot API client.
+
+    Calls that post into a chat first wait on that chat's bucket (`chat_rate`/s for
+    private chats, `group_rate`/s for groups, bursts of `burst`), then for a token of
+    the global bucket (`global_rate`/s). Global tokens are handed out by priority:
+    interactive calls before bulk ones, and bulk calls are additionally capped at
+    `bulk_rate`/s. A 429 pauses that chat's bucket for `retry_after` and is retried;
+    the global bucket is paused only when 429s hit `global_429_chats` different chats
+    within a second, which means the limit is bot-wide. 5xx answers are retried
+    with jittered exponential backoff (up to `max_retries`), and so are connection
+    errors and timeouts when the request never went out or the method doesn't post
+    anything: otherwise the message may have been sent already.
+    """
+
+    def __init__(self, global_rate: float = 30.0, chat_rate: float = 1.0, group_rate: float = 20 / 60,
+                 burst: float = 3.0, bulk_rate: float = 25.0, max_retries: int = 3,
+                 backoff: float = 0.5, global_429_chats: int = 3) -> None:
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.bucket = TokenBucket(global_rate)
+        self.bulk_bucket = TokenBucket(bulk_rate)
+        self.chats: Dict[Any, TokenBucket] = {}
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._seq = 0
+        self._pump_task: Optional[asyncio.Task] = None
+        self.retries = 0
+        self.throttled = 0    # 429 answers
+        self.global_429_chats = global_429_chats
+        self._recent_429: Dict[Any, float] = {}   # chat -> monotonic time of its last 429
+
+    def _chat_bucket(self, chat_id: Any) -> TokenBucket:
+        bucket = self.chats.get(chat_id)
+        if bucket is None:
+            if len(self.chats) >= 10000:
+                self._prune()
+            is_group = isinstance(chat_id, int) and chat_id < 0
+            bucket = self.chats[chat_id] = TokenBucket(self.group_rate if is_group else self.chat_rate, self.burst)
+        return bucket
+
+    def _prune(self) -> None:
+        # buckets that have refilled completely carry no state worth keeping
+        now = time.monotonic()
+        for chat_id, bucket in list(self.chats.items()):
+            if now >= bucket.paused_until and now - bucket.updated >= bucket.capacity / bucket.rate:
+                del self.chats[chat_id]
+
+    async def _pump(self) -> None:
+        while self._waiters:
+            await self.bucket.acquire()
+            while self._waiters:
+                _, _, fut = heapq.heappop(self._waiters)
+                if not fut.done():
+                    fut.set_result(None)
+                    break
+            else:
+                self.bucket.tokens += 1   # every waiter had gone away; keep the token
+
+    async def _global_turn(self, priority: int) -> None:
+        if not self._waiters and self.bucket.try_acquire():
+            return
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self._seq += 1
+        heapq.heappush(self._waiters, (priority, self._seq, fut))
+        if self._pump_task is None or self._pump_task.done() or self._pump_task.get_loop() is not loop:
+            self._pump_task = loop.create_task(self._pump())
+        await fut
+
+    async def acquire(self, chat_id: Any) -> None:
+        priority = API_PRIORITY.get()
+        t0 = time.perf_counter()
+        await self._chat_bucket(chat_id).acquire()
+        if priority >= PRIORITY_BULK:
+            await self.bulk_bucket.acquire()
+        await self._global_turn(priority)
+        API_QUEUE_WAIT.observe(time.perf_counter() - t0, priority="bulk" if priority else "interactive")
+
+    def _throttled(self, chat_id: Any, limited: bool, delay: float) -> None:
+        """A 429: pause the chat, and the global bucket too if the limit looks bot-wide."""
+        self.throttled += 1
+        if not limited:
+            return   # not a send: the caller just waits out retry_after
+        self._chat_bucket(chat_id).pause(delay)
+        now = time.monotonic()
+        self._recent_429[chat_id] = now
+        for other, ts in list(self._recent_429.items()):
+            if now - ts > 1.0:
+                del self._recent_429[other]
+        if len(self._recent_429) >= self.global_429_chats:
+            self.bucket.pause(delay)
+
+    async def call(self, method: str, params: Optional[Dict[str, Any]] = None,
+                   timeout: Optional[float] = None) -> Dict[str, Any]:
+        chat_id = (params or {}).get("chat_id")
+        posts = method.startswith(RATE_LIMITED_PREFIXES)
+        limited = chat_id is not None and posts
+        if limited:
+            try:
+                chat_id = int(chat_id)
+            except (TypeError, ValueError):
+                pass   # @channelusername
+        res: Dict[str, Any] = {}
+        for attempt in range(self.max_retries + 1):
+            if limited:
+                await self.acquire(chat_id)
+            res = await _api_call(method, params, timeout)
+            if res.get("ok"):
+                return res
+            code = res.get("code") or res.get("error_code")
+            retry_after = (res.get("parameters") or {}).get("retry_after")
+            if code == 429 or retry_after:
+                reason = "429"
+                delay = float(retry_after or 1)
+            elif (code and code >= 500) or (not code and (res.get("unsent") or not posts)):
+                reason = "5xx" if code else "network"
+                delay = self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5)
+            else:
+                return res   # 400/403, or no answer to a send that may have gone through
+            if reason == "429":
+                self._throttled(chat_id, limited, delay)
+            if attempt == self.max_retries:
+                break
+            self.retries += 1
+            API_RETRIES.inc(method=method, reason=reason)
+            if reason != "429" or not limited:
+                await asyncio.sleep(delay)
+        return res
+
+    def stats(self) -> Dict[str, int]:
+        return {"waiting": len(self._waiters), "chats": len(self.chats), "retries": self.retries,
+                "throttled": self.throttled}
+
+
+API_SCHEDULER = ApiScheduler(
+    global_rate=API_GLOBAL_RATE,
+    chat_rate=API_CHAT_RATE,
+    group_rate=API_GROUP_RATE,
+    burst=API_CHAT_BURST,
+    bulk_rate=BROADCAST_RATE,
+    max_retries=API_MAX_RETRIES,
+    backoff=API_RETRY_BACKOFF,
+)
+register_metric(Gauge("bot_api_scheduler", "API scheduler state and counters.", API_SCHEDULER.stats, label="event"))
+
+async def api_request_async(method: str, params: Optional[Dict[str, Any]] = None,
+                            timeout: Optional[float] = None) -> Dict[str, Any]:
+    """
+    Call a Bot API method: waits for Telegram's flood limits, retries 429s and
+    transient errors, and returns the final result.
+    """
+    return await API_SCHEDULER.call(method, params, timeout)
+
+# convenience wrappers
+def _message_params(chat_id: int, text: str, parse_mode: Optional[str] = None,
+                    reply_to_message_id: Optional[int] = None, reply_markup: Optional[Dict] = None) -> Dict:
+    params = {"chat_id": chat_id, "text": text}
+    if parse_mode:
+        params["parse_mode"] = parse_mode
+    if reply_to_message_id:
+        params["reply_to_message_id"] = reply_to_message_id
+    if reply_markup:
+        params["reply_markup"] = reply_markup
+    return params
+
+def _media_params(kind: str, chat_id: int, file_id: str, caption: Optional[str] = None,
+                  reply_to_message_id: Optional[int] = None) -> Dict:
+    params = {"chat_id": chat_id, kind: file_id}
+    if caption:
+        params["caption"] = caption
+    if reply_to_message_id:
+        params["reply_to_message_id"] = reply_to_message_id
+    return params
+
+def _media_group_params(chat_id: int, media: List[Dict[str, Any]],
+                        reply_to_message_id: Optional[int] = None) -> Dict:
+    params: Dict[str, Any] = {"chat_id": chat_id, "media": media}
+    if reply_to_message_id:
+        params["reply_to_message_id"] = reply_to_message_id
+    return params
+
+def _copy_params(chat_id: int, from_chat_id: int, message_id: int, caption: Optional[str] = None,
+                 parse_mode: Optional[str] = None, reply_markup: Optional[Dict] = None) -> Dict:
+    params: Dict[str, Any] = {"chat_id": chat_id, "from_chat_id": from_chat_id, "message_id": message_id}
+    if caption is not None:
+        # "" clears the original caption; leaving it out keeps it
+        params["caption"] = caption
+    if parse_mode:
+        params["parse_mode"] = parse_mode
+    if reply_markup:
+        params["reply_markup"] = reply_markup
+    return params
+
+def _callback_params(callback_id: str, text: Optional[str] = None) -> Dict:
+    params = {"callback_query_id": callback_id}
+    if text:
+        params["text"] = text
+    return params
+
+async def send_message_async(chat_id: int, text: str, parse_mode: Optional[str] = None,
+                             reply_to_message_id: Optional[int] = None,
+                             reply_markup: Optional[Dict] = None) -> Dict:
+    return await api_request_async(
+        "sendMessage", _message_params(chat_id, text, parse_mode, reply_to_message_id, reply_markup)
+    )
+
+async def send_photo_async(chat_id: int, file_id: str, caption: Optional[str] = None,
+                           reply_to_message_id: Optional[int] = None) -> Dict:
+    return await api_request_async("sendPhoto", _media_params("photo", chat_id, file_id, caption, reply_to_message_id))
+
+async def send_video_async(chat_id: int, file_id: str, caption: Optional[str] = None,
+                           reply_to_message_id: Optional[int] = None) -> Dict:
+    return await api_request_async("sendVideo", _media_params("video", chat_id, file_id, caption, reply_to_message_id))
+
+async def send_sticker_async(chat_id: int, sticker_file_id: str, reply_to_message_id: Optional[int] = None) -> Dict:
+    return await api_request_async(
+        "sendSticker", _media_params("sticker", chat_id, sticker_file_id, None, reply_to_message_id)
+    )
+
+async def send_media_group_async(chat_id: int, media: List[Dict[str, Any]],
+                                 reply_to_message_id: Optional[int] = None) -> Dict:
+    return await api_request_async("sendMediaGroup", _media_group_params(chat_id, media, reply_to_message_id))
+
+async def forward_message_async(chat_id: int, from_chat_id: int, message_id: int) -> Dict:
+    params = {"chat_id": chat_id, "from_chat_id": from_chat_id, "message_id": message_id}
+    return await api_request_async("forwardMessage", params)
+
+async def copy_message_async(chat_id: int, from_chat_id: int, message_id: int, caption: Optional[str] = None,
+                             parse_mode: Optional[str] = None, reply_markup: Optional[Dict] = None) -> Dict:
+    return await api_request_async(
+        "copyMessage", _copy_params(chat_id, from_chat_id, message_id, caption, parse_mode, reply_markup)
+    )
+
+async def relay_message_async(chat_id: int, msg: Dict[str, Any], caption: Optional[str] = None,
+                              parse_mode: Optional[str] = None, reply_markup: Optional[Dict] = None) -> Dict:
+    """
+    Re-send any message (text, media, voice, documents, ...) to chat_id in one call with
+    copyMessage. Some messages can't be copied (e.g. quiz polls); those are forwarded
+    instead when no caption or keyboard had to be applied.
+    """
+    from_chat_id = (msg.get("chat") or {}).get("id")
+    res = await copy_message_async(chat_id, from_chat_id, msg.get("message_id"), caption, parse_mode, reply_markup)
+    can_forward = caption is None and reply_markup is None
+    if not res.get("ok") and can_forward and res.get("code") == 400:
+        return await forward_message_async(chat_id, from_chat_id, msg.get("message_id"))
+    return res
+
+async def answer_callback_async(callback_id: str, text: Optional[str] = None) -> Dict:
+    return await api_request_async("answerCallbackQuery", _callback_params(callback_id, text))
+
+# -------------------- Persistence --------------------
+def empty_store() -> Dict[str, Any]:
+    return {
+        "seen_chats": [],
+        "chats": {},
+        "inbox": [],
+        "threads": [],
+        "pending_sticker": {},
+    }
+
+def load_store(path: str = DATA_FILE) -> Dict[str, Any]:
+    t0 = time.perf_counter()
+    try:
+        with open(path, "r", encoding="utf-8") as fh:
+            return json.load(fh)
+    except FileNotFoundError:
+        return empty_store()
+    except Exception as exc:
+        log.error("loading %s failed: %s", path, exc)
+        return empty_store()
+    finally:
+        STORE_LATENCY.observe(time.perf_counter() - t0, op="load")
+
+_save_lock = threading.Lock()
+
+def save_store(data: Dict[str, Any], path: str = DATA_FILE) -> bool:
+    """Atomic snapshot: write a temp file next to `path`, fsync, then rename over it."""
+    tmp = f"{path}.tmp"
+    t0 = time.perf_counter()
+    try:
+        with _save_lock:
+            with open(tmp, "w", encoding="utf-8") as fh:
+                json.dump(data, fh, ensure_ascii=False, separators=(",", ":"))
+                fh.flush()
+                os.fsync(fh.fileno())
+            os.replace(tmp, path)
+        STORE_LATENCY.observe(time.perf_counter() - t0, op="save")
+        return True
+    except Exception as exc:
+        log.error("saving %s failed: %s", path, exc)
+        return False
+
+
+class InboxEntry:
+    """One inbox message; a slotted record instead of a dict (the inbox holds INBOX_LIMIT of them)."""
+
+    FIELDS = ("ts", "chat_id", "user_id", "text", "username", "first_name", "last_name")
+    __slots__ = ("seq",) + FIELDS
+
+    def __init__(self, seq: int, d: Dict[str, Any]) -> None:
+        self.seq = seq
+        for f in self.FIELDS:
+            setattr(self, f, d.get(f))
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {f: getattr(self, f) for f in self.FIELDS}
+
+
+class InboxRing:
+    """
+    Fixed-capacity ring of InboxEntry records: O(1) append (the oldest record is
+    overwritten) and newest-first filtered iteration. Text search is a plain scan,
+    which stays well under a millisecond at INBOX_LIMIT records and needs no memory
+    beyond the records themselves.
+    """
+
+    def __init__(self, capacity: int) -> None:
+        self.capacity = capacity
+        self.slots: List[Optional[InboxEntry]] = [None] * capacity
+        self.next_seq = 0      # seq of the next record; its slot is next_seq % capacity
+
+    def __len__(self) -> int:
+        return min(self.next_seq, self.capacity)
+
+    def append(self, d: Dict[str, Any]) -> None:
+        if not self.capacity:
+            return
+        seq = self.next_seq
+        self.slots[seq % self.capacity] = InboxEntry(seq, d)
+        self.next_seq = seq + 1
+
+    def get(self, seq: int) -> Optional[InboxEntry]:
+        if seq < self.next_seq - len(self) or seq >= self.next_seq:
+            return None
+        return self.slots[seq % self.capacity]
+
+    def newest(self, text: Optional[str] = None) -> Iterator[InboxEntry]:
+        """Records newest first; only those whose text contains `text` (case-insensitive) if given."""
+        needle = (text or "").lower()
+        for seq in range(self.next_seq - 1, self.next_seq - len(self) - 1, -1):
+            entry = self.slots[seq % self.capacity]
+            if entry is not None and (not needle or needle in (entry.text or "").lower()):
+                yield entry
+
+    def page(self, limit: int = 20, offset: int = 0, user_id: Optional[int] = None,
+             chat_id: Optional[int] = None, since: Optional[int] = None, until: Optional[int] = None,
+             text: Optional[str] = None) -> List[Dict[str, Any]]:
+        out: List[Dict[str, Any]] = []
+        skipped = 0
+        for e in self.newest(text):
+            if user_id is not None and e.user_id != user_id:
+                continue
+            if chat_id is not None and e.chat_id != chat_id:
+                continue
+            if since is not None and (e.ts or 0) < since:
+                continue
+            if until is not None and (e.ts or 0) >= until:
+                continue
+            if skipped < offset:
+                skipped += 1
+                continue
+            out.append(e.to_dict())
+            if len(out) >= limit:
+                break
+        return out
+
+    def to_list(self) -> List[Dict[str, Any]]:
+        """Oldest first, as stored in bot_data.json."""
+        start = self.next_seq - len(self)
+        return [self.slots[seq % self.capacity].to_dict() for seq in range(start, self.next_seq)]
+
+
+class ChatRegistry:
+    """
+    Known chats with per-chat metadata: last_seen (ts of the chat's last message, at
+    CHAT_SEEN_RESOLUTION; 0 if unknown), consecutive delivery failures and a blocked
+    flag. Blocked chats (the bot was blocked, the chat is gone, or CHAT_MAX_FAILURES
+    failures in a row) are left out of iteration and counts until they write again.
+    Membership, touches and delivery updates are O(1); segments are one scan.
+    """
+
+    def __init__(self) -> None:
+        self.last_seen: Dict[int, int] = {}
+        self.fails: Dict[int, int] = {}      # only chats with failures
+        self.blocked: Set[int] = set()
+
+    def __contains__(self, chat_id: int) -> bool:
+        return chat_id in self.last_seen and chat_id not in self.blocked
+
+    def __len__(self) -> int:
+        return len(self.last_seen) - len(self.blocked)
+
+    def needs_touch(self, chat_id: int, ts: int) -> bool:
+        """True if a message at `ts` changes anything worth persisting."""
+        last = self.last_seen.get(chat_id)
+        return (last is None or ts - last >= CHAT_SEEN_RESOLUTION
+                or chat_id in self.blocked or chat_id in self.fails)
+
+    def touch(self, chat_id: int, ts: Optional[int]) -> None:
+        """The chat wrote to us: known, reachable again, last seen at `ts` (None: unknown)."""
+        self.last_seen[chat_id] = max(ts or 0, self.last_seen.get(chat_id, 0))
+        self.blocked.discard(chat_id)
+        self.fails.pop(chat_id, None)
+
+    def set_delivery(self, chat_id: int, fails: int, blocked: bool) -> None:
+        self.last_seen.setdefault(chat_id, 0)
+        if fails:
+            self.fails[chat_id] = fails
+        else:
+            self.fails.pop(chat_id, None)
+        if blocked:
+            self.blocked.add(chat_id)
+        else:
+            self.blocked.discard(chat_id)
+
+    def delivery_state(self, chat_id: int, ok: bool, permanent: bool = False) -> Tuple[int, bool]:
+        """(fails, blocked) after one delivery result, see set_delivery."""
+        if ok:
+            return 0, False
+        fails = self.fails.get(chat_id, 0) + 1
+        return fails, permanent or fails >= CHAT_MAX_FAILURES
+
+    def iter(self, active_since: Optional[int] = None) -> Iterator[int]:
+        for chat_id, ts in list(self.last_seen.items()):
+            if chat_id not in self.blocked and (active_since is None or ts >= active_since):
+                yield chat_id
+
+    def count(self, active_since: Optional[int] = None) -> int:
+        if active_since is None:
+            return len(self)
+        return sum(1 for _ in self.iter(active_since))
+
+    def to_snapshot(self) -> Tuple[List[int], Dict[str, List[int]]]:
+        """(live chat ids, {chat_id: [last_seen, fails, blocked]} for chats with metadata)."""
+        meta = {str(c): [ts, self.fails.get(c, 0), int(c in self.blocked)]
+                for c, ts in self.last_seen.items() if ts or c in self.fails or c in self.blocked}
+        return list(self.iter()), meta
+
+    @classmethod
+    def from_snapshot(cls, seen: List[Any], meta: Dict[str, List[int]]) -> "ChatRegistry":
+        reg = cls()
+        for c in seen:
+            reg.last_seen[int(c)] = 0
+        for c, (ts, fails, blocked) in meta.items():
+            reg.last_seen[int(c)] = ts
+            reg.set_delivery(int(c), fails, bool(blocked))
+        return reg
+
+
+class ThreadIndex:
+    """
+    (admin_id, admin_msg_id) -> user chat_id routes for admin replies, with a TTL and
+    a size cap. Entries are (chat_id, ts) under int-tuple keys in LRU order (lookups
+    refresh an entry); expired entries are dropped when met, the least recently used
+    ones once there are more than `max_size`.
+    """
+
+    def __init__(self, ttl: float, max_size: int) -> None:
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries: "OrderedDict[Tuple[int, int], Tuple[int, int]]" = OrderedDict()
+        self.expired = 0
+        self.evicted = 0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __iter__(self) -> Iterator[Tuple[int, int]]:
+        return iter(list(self.entries))
+
+    def put(self, admin_id: int, admin_msg_id: int, chat_id: int, ts: Optional[int] = None) -> None:
+        key = (admin_id, admin_msg_id)
+        self.entries[key] = (chat_id, ts if ts is not None else now_ts())
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evicted += 1
+
+    def get(self, admin_id: int, admin_msg_id: int) -> Optional[int]:
+        key = (admin_id, admin_msg_id)
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if now_ts() - entry[1] > self.ttl:
+            del self.entries[key]
+            self.expired += 1
+            return None
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def live(self) -> List[List[int]]:
+        """[admin_id, admin_msg_id, chat_id, ts] rows that have not expired, oldest use first."""
+        cutoff = now_ts() - self.ttl
+        return [[aid, mid, chat, ts] for (aid, mid), (chat, ts) in self.entries.items() if ts >= cutoff]
+
+    def stats(self) -> Dict[str, int]:
+        return {"size": len(self.entries), "expired": self.expired, "evicted": self.evicted}
+
+
+class MemoryStore:
+    """
+    Bot state kept in memory, with bot_data.json as a write-behind snapshot.
+
+    Every helper works on typed in-memory indexes (ChatRegistry, InboxRing,
+    (admin_id, admin_msg_id) -> chat_id dict, admin_id -> chat_id dict) and only marks the
+    store dirty. Dirty changes are written at most once per STORE_FLUSH_INTERVAL as one
+    atomic snapshot, and flush() is called on shutdown. State is loaded on first use.
+    """
+
+    def __init__(self, path: str, flush_interval: float = 2.0) -> None:
+        self.path = path
+        self.flush_interval = flush_interval
+        self.chats = ChatRegistry()
+        self.inbox = InboxRing(INBOX_LIMIT)
+        self.thread_map = ThreadIndex(THREAD_TTL, THREAD_MAX)
+        self.thread_path = THREAD_FILE
+        self.pending_sticker: Dict[int, int] = {}
+        self.loaded = False
+        self.dirty = False
+        self._writing = False
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self.chat_lock: Callable[[Optional[int]], Any] = no_chat_lock
+        self.blocking = False   # see store_io()
+
+    # ---- load / snapshot ----
+    def load(self) -> None:
+        self._load_dict(load_store(self.path))
+        self.loaded = True
+
+    def _load_dict(self, d: Dict[str, Any]) -> None:
+        # "seen_chats" stays the plain list of live chats; metadata lives beside it
+        self.chats = ChatRegistry.from_snapshot(d.get("seen_chats", []), d.get("chats", {}))
+        self.inbox = InboxRing(INBOX_LIMIT)
+        for entry in d.get("inbox", [])[-INBOX_LIMIT:]:
+            self.inbox.append(entry)
+        self.thread_map = ThreadIndex(THREAD_TTL, THREAD_MAX)
+        # older snapshots: {"admin_id:msg_id": chat_id} without timestamps (treated as new)
+        for key, target in d.get("thread_map", {}).items():
+            try:
+                aid, mid = key.split(":", 1)
+                self.thread_map.put(int(aid), int(mid), int(target))
+            except (ValueError, TypeError):
+                continue
+        if self.thread_path and os.path.exists(self.thread_path):
+            rows = load_store(self.thread_path).get("threads", [])
+        else:
+            rows = d.get("threads", [])   # no sidecar (yet): mappings live in the snapshot
+        cutoff = now_ts() - THREAD_TTL
+        for aid, mid, target, ts in rows:
+            if ts >= cutoff:
+                self.thread_map.put(aid, mid, target, ts)
+        self.pending_sticker = {int(k): int(v) for k, v in d.get("pending_sticker", {}).items()}
+
+    def ensure_loaded(self) -> None:
+        if not self.loaded:
+            self.load()
+
+    def snapshot(self) -> Dict[str, Any]:
+        seen, meta = self.chats.to_snapshot()
+        return {
+            "seen_chats": seen,
+            "chats": meta,
+            "inbox": self.inbox.to_list(),
+            "threads": self.thread_map.live(),
+            "pending_sticker": {str(k): v for k, v in self.pending_sticker.items()},
+        }
+
+    # ---- mutations ----
+    # every change is an op tuple, applied in memory and then handed to _record(),
+    # so persistence backends can choose between snapshots and deltas
+    def _apply(self, op: Tuple) -> None:
+        kind = op[0]
+        if kind == "seen":
+            self.chats.touch(op[1], op[2] if len(op) > 2 else None)
+        elif kind == "chat":
+            self.chats.set_delivery(op[1], op[2], op[3])
+        elif kind == "inbox":
+            self.inbox.append(op[1])
+        elif kind == "thread":
+            self.thread_map.put(op[1], op[2], op[3], op[4] if len(op) > 4 else None)
+        elif kind == "pend":
+            self.pending_sticker[op[1]] = op[2]
+        elif kind == "unpend":
+            self.pending_sticker.pop(op[1], None)
+
+    def _commit(self, *op: Any) -> None:
+        self._apply(op)
+        self._record(op)
+
+    def _record(self, op: Tuple) -> None:
+        self.mark_dirty()
+
+    def _save(self, snap: Dict[str, Any]) -> bool:
+        """Write a snapshot; thread mappings go to the THREAD_FILE sidecar when one is set."""
+        if self.thread_path:
+            if not save_store({"threads": snap.pop("threads", [])}, self.thread_path):
+                return False
+        return save_store(snap, self.path)
+
+    # ---- write-behind ----
+    def mark_dirty(self) -> None:
+        self.dirty = True
+        if self._flush_handle is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.flush()   # no event loop (scripts): write through
+            return
+        self._flush_handle = loop.call_later(self.flush_interval, self._flush_due, loop)
+
+    def _flush_due(self, loop: asyncio.AbstractEventLoop) -> None:
+        self._flush_handle = None
+        loop.create_task(self.flush_async())
+
+    async def flush_async(self) -> None:
+        if not self.dirty:
+            return
+        if self._writing:
+            self.mark_dirty()   # a write is in progress; try again after the next interval
+            return
+        self.dirty = False
+        snap = self.snapshot()
+        self._writing = True
+        try:
+            ok = await asyncio.to_thread(self._save, snap)
+        finally:
+            self._writing = False
+        if not ok:
+            self.mark_dirty()
+
+    def flush(self) -> None:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self.dirty:
+            self.dirty = False
+            if not self._save(self.snapshot()):
+                self.dirty = True
+
+    def close(self) -> None:
+        self.flush()
+
+    # ---- seen chats ----
+    def add_seen_chat(self, chat_id: int) -> None:
+        self.ensure_loaded()
+        ts = now_ts()
+        if self.chats.needs_touch(chat_id, ts):
+            self._commit("seen", chat_id, ts)
+
+    def iter_seen_chats(self, active_since: Optional[int] = None) -> Iterator[int]:
+        self.ensure_loaded()
+        yield from self.chats.iter(active_since)
+
+    def count_seen_chats(self, active_since: Optional[int] = None) -> int:
+        self.ensure_loaded()
+        return self.chats.count(active_since)
+
+    def count_blocked_chats(self) -> int:
+        self.ensure_loaded()
+        return len(self.chats.blocked)
+
+    def record_delivery(self, chat_id: int, ok: bool, permanent: bool = False) -> bool:
+        """Note a delivery result for chat_id; True if the chat is now blocked."""
+        self.ensure_loaded()
+        if ok and chat_id not in self.chats.fails:
+            return False
+        fails, blocked = self.chats.delivery_state(chat_id, ok, permanent)
+        self._commit("chat", chat_id, fails, blocked)
+        return blocked
+
+    # ---- inbox ----
+    def append_inbox(self, entry: Dict[str, Any]) -> None:
+        self.ensure_loaded()
+        self._commit("inbox", entry)
+
+    def query_inbox(self, limit: int = 20, offset: int = 0, user_id: Optional[int] = None,
+                    chat_id: Optional[int] = None, since: Optional[int] = None,
+                    until: Optional[int] = None, text: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Newest-first page of inbox entries matching the given filters (`text`: substring)."""
+        self.ensure_loaded()
+        return self.inbox.page(limit, offset, user_id, chat_id, since, until, text)
+
+    # ---- thread map ----
+    def put_thread(self, admin_id: int, admin_msg_id: int, user_chat_id: int) -> None:
+        self.ensure_loaded()
+        self._commit("thread", admin_id, admin_msg_id, user_chat_id, now_ts())
+
+    def put_threads(self, entries: List[Tuple[int, int, int]]) -> None:
+        self.ensure_loaded()
+        ts = now_ts()
+        for admin_id, admin_msg_id, user_chat_id in entries:
+            self._commit("thread", admin_id, admin_msg_id, user_chat_id, ts)
+
+    def get_thread(self, admin_id: int, admin_msg_id: int) -> Optional[int]:
+        self.ensure_loaded()
+        return self.thread_map.get(admin_id, admin_msg_id)
+
+    # ---- pending sticker ----
+    def set_pending(self, admin_id: int, target_chat: int) -> None:
+        self.ensure_loaded()
+        self._commit("pend", admin_id, target_chat)
+
+    def get_pending(self, admin_id: int) -> Optional[int]:
+        self.ensure_loaded()
+        return self.pending_sticker.get(admin_id)
+
+    def pop_pending(self, admin_id: int) -> Optional[int]:
+        self.ensure_loaded()
+        val = self.pending_sticker.get(admin_id)
+        if val is not None:
+            self._commit("unpend", admin_id)
+        return val
+
+
+class JournalStore(MemoryStore):
+    """
+    MemoryStore persisted as a base snapshot plus an append-only journal of deltas.
+
+    Each change is one JSON line `[seq, op, ...args]` appended to the journal, so write
+    cost follows the size of the change rather than the size of the state. On startup
+    the snapshot is loaded and newer journal lines are replayed on top. Once the journal
+    passes `compact_bytes` it is rotated aside, a fresh snapshot (tagged with the last
+    seq it contains) is written in the background and the rotated log is deleted;
+    the seq tag makes replay safe if we crash halfway through.
+    """
+
+    def __init__(self, path: str, journal_path: str, flush_interval: float = 2.0,
+                 compact_bytes: int = 4 * 1024 * 1024) -> None:
+        super().__init__(path, flush_interval)
+        self.journal_path = journal_path
+        self.compact_bytes = compact_bytes
+        self.seq = 0
+        self.journal_size = 0
+        self._pending_ops: List[str] = []
+        self._compacting = False
+
+    def load(self) -> None:
+        d = load_store(self.path)
+        self._load_dict(d)
+        self.seq = base_seq = int(d.get("journal_seq", 0))
+        for log_path in (self.journal_path + ".old", self.journal_path):
+            try:
+                fh = open(log_path, "r", encoding="utf-8")
+            except FileNotFoundError:
+                continue
+            with fh:
+                for line in fh:
+                    try:
+                        seq, *op = json.loads(line)
+                    except ValueError:
+                        continue   # torn last line after a crash
+                    if seq > base_seq:
+                        self._apply(tuple(op))
+                        self.seq = max(self.seq, seq)
+        try:
+            self.journal_size = os.path.getsize(self.journal_path)
+        except OSError:
+            self.journal_size = 0
+        self.loaded = True
+
+    def snapshot(self) -> Dict[str, Any]:
+        snap = super().snapshot()
+        snap["journal_seq"] = self.seq
+        return snap
+
+    def _record(self, op: Tuple) -> None:
+        self.seq += 1
+        self._pending_ops.append(json.dumps([self.seq, *op], ensure_ascii=False, separators=(",", ":")))
+        self.mark_dirty()
+
+    def _append_pending(self) -> None:
+        if not self._pending_ops:
+            return
+        chunk = ("\n".join(self._pending_ops) + "\n").encode("utf-8")
+        t0 = time.perf_counter()
+        try:
+            with open(self.journal_path, "ab") as fh:
+                fh.write(chunk)
+            STORE_LATENCY.observe(time.perf_counter() - t0, op="journal_append")
+        except Exception as exc:
+            log.error("journal append failed: %s", exc)
+            self.mark_dirty()
+            return
+        self._pending_ops = []
+        self.journal_size += len(chunk)
+
+    async def flush_async(self) -> None:
+        if self.dirty:
+            self.dirty = False
+            self._append_pending()
+        if self.journal_size > self.compact_bytes and not self._compacting:
+            self._compacting = True
+            asyncio.get_running_loop().create_task(self._compact())
+
+    async def _compact(self) -> None:
+        old_path = self.journal_path + ".old"
+        try:
+            # everything up to self.seq is in the journal now; rotate it aside so new
+            # appends start a fresh file while the snapshot is written
+            self._append_pending()
+            if os.path.exists(old_path):
+                # a previous compaction never finished; keep its ops in the rotated log
+                with open(self.journal_path, "rb") as src, open(old_path, "ab") as dst:
+                    dst.write(src.read())
+                os.remove(self.journal_path)
+            else:
+                os.replace(self.journal_path, old_path)
+            self.journal_size = 0
+            if await asyncio.to_thread(self._save, self.snapshot()):
+                os.remove(old_path)
+        except Exception as exc:
+            log.error("journal compaction failed: %s", exc)
+        finally:
+            self._compacting = False
+
+    def flush(self) -> None:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        self.dirty = False
+        self._append_pending()
+
+
+class SqliteStore:
+    """
+    Bot state in a SQLite database (WAL mode), same interface as MemoryStore.
+
+    Thread lookups are primary-key point queries, /inbox pages and filters through
+    the ts/chat_id/user_id indexes, and seen chats (with the ChatRegistry metadata as
+    columns) are streamed in keyset pages so a broadcast never holds the whole list in
+    memory. The inbox keeps `inbox_limit`
+    rows instead of INBOX_LIMIT. An existing bot_data.json is imported on first open.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS seen_chats (
+            chat_id INTEGER PRIMARY KEY,
+            first_seen INTEGER NOT NULL,
+            last_seen INTEGER NOT NULL DEFAULT 0,
+            fails INTEGER NOT NULL DEFAULT 0,
+            blocked INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS inbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            ts INTEGER NOT NULL,
+            chat_id INTEGER,
+            user_id INTEGER,
+            text TEXT,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT
+        );
+        CREATE INDEX IF NOT EXISTS inbox_ts ON inbox (ts);
+        CREATE INDEX IF NOT EXISTS inbox_chat ON inbox (chat_id, ts);
+        CREATE INDEX IF NOT EXISTS inbox_user ON inbox (user_id, ts);
+        CREATE TABLE IF NOT EXISTS thread_map (
+            admin_id INTEGER NOT NULL,
+            admin_msg_id INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL,
+            ts INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (admin_id, admin_msg_id)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS pending_sticker (
+            admin_id INTEGER PRIMARY KEY,
+            chat_id INTEGER NOT NULL
+        );
+    """
+    INBOX_COLUMNS = ("ts", "chat_id", "user_id", "text", "username", "first_name", "last_name")
+
+    def __init__(self, path: str, inbox_limit: int = 100000, import_from: Optional[str] = None) -> None:
+        self.path = path
+        self.inbox_limit = inbox_limit
+        self.import_from = import_from
+        self.conn: Optional[sqlite3.Connection] = None
+        self._inserts = 0
+        self._thread_puts = 0
+        self.blocking = False   # local queries, run on the event loop
+        # sqlite is safe to share between processes; keep chats ordered across them too
+        self.chat_lock = FileChatLocks(path + ".chats") if fcntl is not None else no_chat_lock
+
+    @property
+    def loaded(self) -> bool:
+        return self.conn is not None
+
+    def load(self) -> None:
+        conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        # databases created before thread mappings expired have no ts column; the
+        # CREATE INDEX on it below would fail, so add the column first
+        has_threads = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'thread_map'").fetchone()
+        if has_threads and "ts" not in {row[1] for row in conn.execute("PRAGMA table_info(thread_map)")}:
+            conn.execute("ALTER TABLE thread_map ADD COLUMN ts INTEGER NOT NULL DEFAULT 0")
+            conn.execute("UPDATE thread_map SET ts = ?", (now_ts(),))
+        # same for seen_chats from before the chat metadata
+        seen_cols = {row[1] for row in conn.execute("PRAGMA table_info(seen_chats)")}
+        if seen_cols and "last_seen" not in seen_cols:
+            for col in ("last_seen", "fails", "blocked"):
+                conn.execute(f"ALTER TABLE seen_chats ADD COLUMN {col} INTEGER NOT NULL DEFAULT 0")
+        conn.executescript(self.SCHEMA)
+        conn.execute("CREATE INDEX IF NOT EXISTS thread_ts ON thread_map (ts)")
+        conn.execute("CREATE INDEX IF NOT EXISTS seen_last ON seen_chats (last_seen)")
+        self.conn = conn
+        if self.import_from and os.path.exists(self.import_from):
+            if conn.execute("SELECT NOT EXISTS (SELECT 1 FROM seen_chats) AND NOT EXISTS (SELECT 1 FROM inbox)").fetchone()[0]:
+                self._import_json(load_store(self.import_from))
+
+    def ensure_loaded(self) -> sqlite3.Connection:
+        if self.conn is None:
+            self.load()
+        return self.conn
+
+    def _import_json(self, d: Dict[str, Any]) -> None:
+        conn = self.conn
+        ts = now_ts()
+        with conn:
+            conn.execute("BEGIN")
+            conn.executemany("INSERT OR IGNORE INTO seen_chats (chat_id, first_seen) VALUES (?, ?)",
+                             ((int(c), ts) for c in d.get("seen_chats", [])))
+            conn.executemany(
+                "INSERT OR REPLACE INTO seen_chats (chat_id, first_seen, last_seen, fails, blocked) "
+                "VALUES (?, ?, ?, ?, ?)",
+                ((int(c), ts, *meta) for c, meta in d.get("chats", {}).items()),
+            )
+            conn.executemany(
+                "INSERT INTO inbox (ts, chat_id, user_id, text, username, first_name, last_name) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (tuple(e.get(c) for c in self.INBOX_COLUMNS) for e in d.get("inbox", [])),
+            )
+            rows = [tuple(row) for row in d.get("threads", [])]
+            for key, target in d.get("thread_map", {}).items():
+                try:
+                    aid, mid = key.split(":", 1)
+                    rows.append((int(aid), int(mid), int(target), ts))
+                except (ValueError, TypeError):
+                    continue
+            conn.executemany("INSERT OR REPLACE INTO thread_map VALUES (?, ?, ?, ?)", rows)
+            conn.executemany("INSERT OR REPLACE INTO pending_sticker VALUES (?, ?)",
+                             ((int(k), int(v)) for k, v in d.get("pending_sticker", {}).items()))
+        log.info("imported %s into %s", self.import_from, self.path)
+
+    # ---- seen chats ----
+    def add_seen_chat(self, chat_id: int) -> None:
+        ts = now_ts()
+        self.ensure_loaded().execute(
+            "INSERT INTO seen_chats (chat_id, first_seen, last_seen) VALUES (?, ?, ?) "
+            "ON CONFLICT (chat_id) DO UPDATE SET last_seen = excluded.last_seen, fails = 0, blocked = 0 "
+            "WHERE excluded.last_seen - last_seen >= ? OR fails > 0 OR blocked = 1",
+            (chat_id, ts, ts, CHAT_SEEN_RESOLUTION))
+
+    def iter_seen_chats(self, active_since: Optional[int] = None, page_size: int = 500) -> Iterator[int]:
+        conn = self.ensure_loaded()
+        since = -1 if active_since is None else active_since
+        last = None
+        while True:
+            if last is None:
+                rows = conn.execute("SELECT chat_id FROM seen_chats WHERE blocked = 0 AND last_seen >= ? "
+                                    "ORDER BY chat_id LIMIT ?", (since, page_size)).fetchall()
+            else:
+                rows = conn.execute("SELECT chat_id FROM seen_chats WHERE chat_id > ? AND blocked = 0 "
+                                    "AND last_seen >= ? ORDER BY chat_id LIMIT ?",
+                                    (last, since, page_size)).fetchall()
+            if not rows:
+                return
+            for (cid,) in rows:
+                yield cid
+            last = rows[-1][0]
+
+    def count_seen_chats(self, active_since: Optional[int] = None) -> int:
+        since = -1 if active_since is None else active_since
+        return self.ensure_loaded().execute(
+            "SELECT COUNT(*) FROM seen_chats WHERE blocked = 0 AND last_seen >= ?", (since,)).fetchone()[0]
+
+    def count_blocked_chats(self) -> int:
+        return self.ensure_loaded().execute("SELECT COUNT(*) FROM seen_chats WHERE blocked = 1").fetchone()[0]
+
+    def record_delivery(self, chat_id: int, ok: bool, permanent: bool = False) -> bool:
+        """Note a delivery result for chat_id; True if the chat is now blocked."""
+        conn = self.ensure_loaded()
+        if ok:
+            conn.execute("UPDATE seen_chats SET fails = 0, blocked = 0 "
+                         "WHERE chat_id = ? AND (fails > 0 OR blocked = 1)", (chat_id,))
+            return False
+        conn.execute(
+            "UPDATE seen_chats SET fails = fails + 1, blocked = (? OR fails + 1 >= ?) WHERE chat_id = ?",
+            (int(permanent), CHAT_MAX_FAILURES, chat_id))
+        row = conn.execute("SELECT blocked FROM seen_chats WHERE chat_id = ?", (chat_id,)).fetchone()
+        return bool(row and row[0])
+
+    # ---- inbox ----
+    def append_inbox(self, entry: Dict[str, Any]) -> None:
+        conn = self.ensure_loaded()
+        conn.execute(
+            "INSERT INTO inbox (ts, chat_id, user_id, text, username, first_name, last_name) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            tuple(entry.get(c) for c in self.INBOX_COLUMNS),
+        )
+        self._inserts += 1
+        if self.inbox_limit and self._inserts % 256 == 0:
+            conn.execute("DELETE FROM inbox WHERE id <= (SELECT MAX(id) FROM inbox) - ?", (self.inbox_limit,))
+
+    def query_inbox(self, limit: int = 20, offset: int = 0, user_id: Optional[int] = None,
+                    chat_id: Optional[int] = None, since: Optional[int] = None,
+                    until: Optional[int] = None, text: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Newest-first page of inbox entries matching the given filters (`text`: substring)."""
+        where, args = [], []
+        if user_id is not None:
+            where.append("user_id = ?")
+            args.append(user_id)
+        if chat_id is not None:
+            where.append("chat_id = ?")
+            args.append(chat_id)
+        if since is not None:
+            where.append("ts >= ?")
+            args.append(since)
+        if until is not None:
+            where.append("ts < ?")
+            args.append(until)
+        if text:
+            where.append("instr(lower(text), ?) > 0")
+            args.append(text.lower())
+        sql = "SELECT " + ", ".join(self.INBOX_COLUMNS) + " FROM inbox"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY ts DESC, id DESC LIMIT ? OFFSET ?"
+        rows = self.ensure_loaded().execute(sql, (*args, limit, offset)).fetchall()
+        return [dict(zip(self.INBOX_COLUMNS, row)) for row in rows]
+
+    # ---- thread map ----
+    def put_thread(self, admin_id: int, admin_msg_id: int, user_chat_id: int) -> None:
+        self.put_threads([(admin_id, admin_msg_id, user_chat_id)])
+
+    def put_threads(self, entries: List[Tuple[int, int, int]]) -> None:
+        conn = self.ensure_loaded()
+        ts = now_ts()
+        with conn:
+            conn.execute("BEGIN")
+            conn.executemany("INSERT OR REPLACE INTO thread_map VALUES (?, ?, ?, ?)",
+                             ((aid, mid, chat, ts) for aid, mid, chat in entries))
+        self._thread_puts += len(entries)
+        if self._thread_puts >= 256:
+            self._thread_puts = 0
+            self._prune_threads()
+
+    def _prune_threads(self) -> None:
+        # expired rows, then the oldest beyond THREAD_MAX (ts is indexed)
+        conn = self.ensure_loaded()
+        conn.execute("DELETE FROM thread_map WHERE ts < ?", (now_ts() - THREAD_TTL,))
+        excess = conn.execute("SELECT COUNT(*) FROM thread_map").fetchone()[0] - THREAD_MAX
+        if excess > 0:
+            conn.execute(
+                "DELETE FROM thread_map WHERE (admin_id, admin_msg_id) IN "
+                "(SELECT admin_id, admin_msg_id FROM thread_map ORDER BY ts LIMIT ?)",
+                (excess,),
+            )
+
+    def get_thread(self, admin_id: int, admin_msg_id: int) -> Optional[int]:
+        row = self.ensure_loaded().execute(
+            "SELECT chat_id FROM thread_map WHERE admin_id = ? AND admin_msg_id = ? AND ts >= ?",
+            (admin_id, admin_msg_id, now_ts() - THREAD_TTL),
+        ).fetchone()
+        return row[0] if row else None
+
+    # ---- pending sticker ----
+    def set_pending(self, admin_id: int, target_chat: int) -> None:
+        self.ensure_loaded().execute("INSERT OR REPLACE INTO pending_sticker VALUES (?, ?)", (admin_id, target_chat))
+
+    def get_pending(self, admin_id: int) -> Optional[int]:
+        row = self.ensure_loaded().execute(
+            "SELECT chat_id FROM pending_sticker WHERE admin_id = ?", (admin_id,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def pop_pending(self, admin_id: int) -> Optional[int]:
+        val = self.get_pending(admin_id)
+        if val is not None:
+            self.conn.execute("DELETE FROM pending_sticker WHERE admin_id = ?", (admin_id,))
+        return val
+
+    # every statement autocommits (WAL + synchronous=NORMAL), so there is nothing to flush
+    def flush(self) -> None:
+        pass
+
+    async def flush_async(self) -> None:
+        pass
+
+    def close(self) -> None:
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+# ---- multi-process / multi-node backends ----
+@contextlib.asynccontextmanager
+async def no_chat_lock(chat_id: Optional[int]) -> AsyncIterator[None]:
+    """Single-process backends: UpdateQueue shards already keep each chat in order."""
+    yield
+
+
+class FileChatLocks:
+    """
+    Per-chat locks shared by processes on one host: flock on one of `shards` lock files.
+    Polls with LOCK_NB so a busy chat never blocks the event loop.
+    """
+
+    def __init__(self, lock_dir: str, shards: int = 64) -> None:
+        if fcntl is None:
+            raise RuntimeError("file locking needs fcntl (POSIX)")
+        self.lock_dir = lock_dir
+        self.shards = shards
+        self._files: Dict[int, Any] = {}
+        self._local: Dict[int, asyncio.Lock] = {}   # flock is per-process, so serialize locally too
+
+    def _file(self, shard: int) -> Any:
+        fh = self._files.get(shard)
+        if fh is None:
+            if not self._files:
+                os.makedirs(self.lock_dir, exist_ok=True)
+            fh = self._files[shard] = open(os.path.join(self.lock_dir, f"chat-{shard}.lock"), "a+")
+        return fh
+
+    @contextlib.asynccontextmanager
+    async def __call__(self, chat_id: Optional[int]) -> AsyncIterator[None]:
+        if chat_id is None:
+            yield
+            return
+        shard = chat_id % self.shards
+        local = self._local.setdefault(shard, asyncio.Lock())
+        async with local:
+            fh = self._file(shard)
+            delay = 0.005
+            while True:
+                try:
+                    fcntl.flock(fh.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, 0.1)
+            try:
+                yield
+            finally:
+                fcntl.flock(fh.fileno(), fcntl.LOCK_UN)
+
+
+class SharedFileStore(JournalStore):
+    """
+    JournalStore that several processes on the same host can share (uvicorn --workers N).
+
+    Every change is written through to the journal under an exclusive flock, after first
+    catching up on lines other processes appended, so all processes see one total
+    order. Reads catch up under a shared lock (a stat plus reading any new lines).
+    Compaction moves the journal aside and swaps in a fresh one under the lock, then
+    writes the snapshot without holding it; other processes notice the new inode and
+    reload (snapshot, then the moved-aside journal until it is gone, then the new one).
+    Calls wait on flock, so they go through store_io() rather than the event loop.
+    """
+
+    def __init__(self, path: str, journal_path: str, compact_bytes: int = 4 * 1024 * 1024) -> None:
+        if fcntl is None:
+            raise RuntimeError("STORE_BACKEND=shared needs fcntl (POSIX)")
+        super().__init__(path, journal_path, compact_bytes=compact_bytes)
+        self._lock_fh: Any = None   # opened on first use, not at import
+        self._inode: Optional[int] = None
+        self._offset = 0
+        self.chat_lock = FileChatLocks(journal_path + ".chats")
+        self._compact_fh: Any = None
+        self.blocking = True    # flock waits: called through store_io()
+
+    @contextlib.contextmanager
+    def _locked(self, mode: int) -> Iterator[None]:
+        if self._lock_fh is None:
+            self._lock_fh = open(self.journal_path + ".lock", "a+")
+        fcntl.flock(self._lock_fh.fileno(), mode)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._lock_fh.fileno(), fcntl.LOCK_UN)
+
+    def _reload(self) -> None:
+        JournalStore.load(self)
+        try:
+            st = os.stat(self.journal_path)
+            self._inode, self._offset = st.st_ino, st.st_size
+        except FileNotFoundError:
+            self._inode, self._offset = None, 0
+
+    def load(self) -> None:
+        with self._locked(fcntl.LOCK_SH):
+            self._reload()
+
+    def _catch_up(self) -> None:
+        """Apply journal lines written by other processes (caller holds the lock)."""
+        try:
+            st = os.stat(self.journal_path)
+        except FileNotFoundError:
+            return
+        if st.st_ino != self._inode or st.st_size < self._offset:
+            self._reload()   # compacted by another process
+            return
+        if st.st_size == self._offset:
+            return
+        with open(self.journal_path, "rb") as fh:
+            fh.seek(self._offset)
+            chunk = fh.read(st.st_size - self._offset)
+        self._offset += len(chunk)
+        for line in chunk.splitlines():
+            try:
+                seq, *op = json.loads(line)
+            except ValueError:
+                continue
+            if seq > self.seq:
+                self._apply(tuple(op))
+                self.seq = seq
+
+    def ensure_loaded(self) -> None:
+        if not self.loaded:
+            self.load()
+            return
+        with self._locked(fcntl.LOCK_SH):
+            self._catch_up()
+
+    def _commit(self, *op: Any) -> None:
+        snap = None
+        with self._locked(fcntl.LOCK_EX):
+            self._catch_up()
+            self._apply(op)
+            self.seq += 1
+            line = (json.dumps([self.seq, *op], ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+            with open(self.journal_path, "ab") as fh:
+                fh.write(line)
+            if self._inode is None:
+                self._inode = os.stat(self.journal_path).st_ino
+            self._offset += len(line)
+            if self._offset > self.compact_bytes:
+                snap = self._rotate_locked()
+        if snap is not None:
+            self._finish_compaction(snap)
+
+    def _rotate_locked(self) -> Optional[Dict[str, Any]]:
+        """
+        Compaction, first half (under the journal lock): move the journal aside to
+        `.old`, start a fresh one and return the snapshot of the state it ended with.
+        Readers replay `.old` until the snapshot is written, so that slow part runs
+        after the lock is released. None if another process is already compacting.
+        """
+        fh = open(self.journal_path + ".compact", "a+")
+        try:
+            fcntl.flock(fh.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            fh.close()
+            return None
+        old_path = self.journal_path + ".old"
+        if os.path.exists(old_path):
+            # a compaction that never finished; keep its ops in the rotated log
+            with open(self.journal_path, "rb") as src, open(old_path, "ab") as dst:
+                dst.write(src.read())
+            os.remove(self.journal_path)
+        else:
+            os.replace(self.journal_path, old_path)
+        tmp = self.journal_path + ".new"
+        open(tmp, "wb").close()
+        os.replace(tmp, self.journal_path)
+        st = os.stat(self.journal_path)
+        self._inode, self._offset = st.st_ino, 0
+        self._compact_fh = fh
+        return self.snapshot()
+
+    def _finish_compaction(self, snap: Dict[str, Any]) -> None:
+        try:
+            if self._save(snap):
+                with self._locked(fcntl.LOCK_EX):
+                    os.remove(self.journal_path + ".old")
+        except Exception as exc:
+            log.error("journal compaction failed: %s", exc)
+        finally:
+            self._compact_fh.close()   # releases the compaction flock
+            self._compact_fh = None
+
+    # written through in _commit; nothing is buffered
+    def flush(self) -> None:
+        pass
+
+    async def flush_async(self) -> None:
+        pass
+
+
+class MemoryKV:
+    """In-process stand-in for the Redis subset KVStore uses (tests, single process)."""
+
+    def __init__(self) -> None:
+        self.data: Dict[str, Any] = {}
+        self.expires: Dict[str, float] = {}
+
+    def _live(self, key: str) -> Any:
+        exp = self.expires.get(key)
+        if exp is not None and exp <= time.time():
+            self.data.pop(key, None)
+            self.expires.pop(key, None)
+        return self.data.get(key)
+
+    def get(self, key: str) -> Optional[str]:
+        return self._live(key)
+
+    def set(self, key: str, value: Any, nx: bool = False, px: Optional[int] = None) -> bool:
+        if nx and self._live(key) is not None:
+            return False
+        self.data[key] = str(value)
+        if px:
+            self.expires[key] = time.time() + px / 1000.0
+        else:
+            self.expires.pop(key, None)
+        return True
+
+    def mset(self, mapping: Dict[str, Any]) -> None:
+        for key, value in mapping.items():
+            self.set(key, value)
+
+    def execute_many(self, commands: List[Tuple[Any, ...]]) -> List[Any]:
+        """RedisKV's pipeline, for commands whose arguments match the method's (SADD, ZADD, HDEL...)."""
+        return [getattr(self, cmd[0].lower())(*cmd[1:]) for cmd in commands]
+
+    def mset_px(self, mapping: Dict[str, Any], px: int) -> None:
+        for key, value in mapping.items():
+            self.set(key, value, px=px)
+
+    def delete(self, key: str) -> None:
+        self.data.pop(key, None)
+        self.expires.pop(key, None)
+
+    def sadd(self, key: str, member: Any) -> None:
+        self.data.setdefault(key, set()).add(str(member))
+
+    def srem(self, key: str, member: Any) -> int:
+        members = self.data.get(key, set())
+        if str(member) not in members:
+            return 0
+        members.discard(str(member))
+        return 1
+
+    def sismember(self, key: str, member: Any) -> bool:
+        return str(member) in self.data.get(key, ())
+
+    def scard(self, key: str) -> int:
+        return len(self.data.get(key, ()))
+
+    def sscan(self, key: str, cursor: int, count: int = 500) -> Tuple[int, List[str]]:
+        members = sorted(self.data.get(key, ()))
+        page = members[cursor:cursor + count]
+        nxt = cursor + count
+        return (nxt if nxt < len(members) else 0), page
+
+    def rpush(self, key: str, value: str) -> int:
+        lst = self.data.setdefault(key, [])
+        lst.append(value)
+        return len(lst)
+
+    def ltrim(self, key: str, start: int, stop: int) -> None:
+        lst = self.data.get(key, [])
+        n = len(lst)
+        start, stop = (start + n if start < 0 else start), (stop + n if stop < 0 else stop)
+        self.data[key] = lst[max(start, 0):stop + 1]
+
+    def lrange(self, key: str, start: int, stop: int) -> List[str]:
+        lst = self.data.get(key, [])
+        n = len(lst)
+        start, stop = (start + n if start < 0 else start), (stop + n if stop < 0 else stop)
+        return lst[max(start, 0):stop + 1]
+
+    def llen(self, key: str) -> int:
+        return len(self.data.get(key, []))
+
+    def hset(self, key: str, field: Any, value: Any) -> None:
+        self.data.setdefault(key, {})[str(field)] = str(value)
+
+    def hget(self, key: str, field: Any) -> Optional[str]:
+        return self.data.get(key, {}).get(str(field))
+
+    def hdel(self, key: str, field: Any) -> None:
+        self.data.get(key, {}).pop(str(field), None)
+
+    def hincrby(self, key: str, field: Any, amount: int) -> int:
+        h = self.data.setdefault(key, {})
+        h[str(field)] = str(int(h.get(str(field), 0)) + amount)
+        return int(h[str(field)])
+
+    def zadd(self, key: str, score: float, member: Any) -> None:
+        self.data.setdefault(key, {})[str(member)] = score
+
+    def zrem(self, key: str, member: Any) -> None:
+        self.data.get(key, {}).pop(str(member), None)
+
+    def zscore(self, key: str, member: Any) -> Optional[float]:
+        return self.data.get(key, {}).get(str(member))
+
+    def zcount(self, key: str, low: float, high: float) -> int:
+        return sum(1 for score in self.data.get(key, {}).values() if low <= score <= high)
+
+    def zrangebyscore(self, key: str, low: float, high: float, offset: int, count: int) -> List[str]:
+        hits = sorted((score, m) for m, score in self.data.get(key, {}).items() if low <= score <= high)
+        return [m for _, m in hits[offset:offset + count]]
+
+
+class RedisKV:
+    """
+    Tiny blocking RESP client for the commands KVStore needs (stdlib socket only).
+
+    Calls run on the store thread (store_io), never on the event loop; multi-command
+    updates go out as one pipelined round trip (execute_many).
+    """
+
+    def __init__(self, url: str, timeout: float = 5.0) -> None:
+        parts = urllib.parse.urlsplit(url)
+        self.host = parts.hostname or "127.0.0.1"
+        self.port = parts.port or 6379
+        self.password = parts.password
+        self.db = int((parts.path or "/0").lstrip("/") or 0)
+        self.timeout = timeout
+        self.sock: Optional[socket.socket] = None
+        self.rfile: Any = None
+
+    def _connect(self) -> None:
+        self.sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        self.rfile = self.sock.makefile("rb")
+        if self.password:
+            self._call("AUTH", self.password)
+        if self.db:
+            self._call("SELECT", self.db)
+
+    def _read(self) -> Any:
+        line = self.rfile.readline()
+        if not line:
+            raise ConnectionError("redis connection closed")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b"+":
+            return rest.decode()
+        if kind == b"-":
+            raise RuntimeError(rest.decode())
+        if kind == b":":
+            return int(rest)
+        if kind == b"$":
+            n = int(rest)
+            if n < 0:
+                return None
+            data = self.rfile.read(n + 2)[:-2]
+            return data.decode("utf-8")
+        if kind == b"*":
+            n = int(rest)
+            return None if n < 0 else [self._read() for _ in range(n)]
+        raise RuntimeError(f"bad redis reply: {line!r}")
+
+    @staticmethod
+    def _encode(args: Tuple[Any, ...]) -> bytes:
+        out = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode("utf-8")
+            out.append(b"$%d\r\n%s\r\n" % (len(data), data))
+        return b"".join(out)
+
+    def _call(self, *args: Any) -> Any:
+        self.sock.sendall(self._encode(args))
+        return self._read()
+
+    def _call_many(self, commands: List[Tuple[Any, ...]]) -> List[Any]:
+        # pipelined: all commands in one write, then one reply per command
+        self.sock.sendall(b"".join(self._encode(args) for args in commands))
+        return [self._read() for _ in commands]
+
+    def execute(self, *args: Any) -> Any:
+        for attempt in (1, 2):
+            try:
+                if self.sock is None:
+                    self._connect()
+                return self._call(*args)
+            except (OSError, ConnectionError):
+                self.close()
+                if attempt == 2:
+                    raise
+
+    def execute_many(self, commands: List[Tuple[Any, ...]]) -> List[Any]:
+        for attempt in (1, 2):
+            try:
+                if self.sock is None:
+                    self._connect()
+                return self._call_many(commands)
+            except (OSError, ConnectionError):
+                self.close()
+                if attempt == 2:
+                    raise
+        return []
+
+    def close(self) -> None:
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            finally:
+                self.sock = None
+                self.rfile = None
+
+    def get(self, key: str) -> Optional[str]:
+        return self.execute("GET", key)
+
+    def set(self, key: str, value: Any, nx: bool = False, px: Optional[int] = None) -> bool:
+        args: List[Any] = ["SET", key, value]
+        if px:
+            args += ["PX", px]
+        if nx:
+            args.append("NX")
+        return self.execute(*args) == "OK"
+
+    def mset(self, mapping: Dict[str, Any]) -> None:
+        args: List[Any] = ["MSET"]
+        for key, value in mapping.items():
+            args += [key, value]
+        self.execute(*args)
+
+    def mset_px(self, mapping: Dict[str, Any], px: int) -> None:
+        # MSET can't set expiries: pipeline one SET ... PX per key instead
+        self.execute_many([("SET", key, value, "PX", px) for key, value in mapping.items()])
+
+    def delete(self, key: str) -> None:
+        self.execute("DEL", key)
+
+    def sadd(self, key: str, member: Any) -> None:
+        self.execute("SADD", key, member)
+
+    def srem(self, key: str, member: Any) -> int:
+        return self.execute("SREM", key, member)
+
+    def sismember(self, key: str, member: Any) -> bool:
+        return bool(self.execute("SISMEMBER", key, member))
+
+    def scard(self, key: str) -> int:
+        return self.execute("SCARD", key)
+
+    def sscan(self, key: str, cursor: int, count: int = 500) -> Tuple[int, List[str]]:
+        nxt, page = self.execute("SSCAN", key, cursor, "COUNT", count)
+        return int(nxt), page
+
+    def rpush(self, key: str, value: str) -> int:
+        return self.execute("RPUSH", key, value)
+
+    def ltrim(self, key: str, start: int, stop: int) -> None:
+        self.execute("LTRIM", key, start, stop)
+
+    def lrange(self, key: str, start: int, stop: int) -> List[str]:
+        return self.execute("LRANGE", key, start, stop)
+
+    def llen(self, key: str) -> int:
+        return self.execute("LLEN", key)
+
+    def hset(self, key: str, field: Any, value: Any) -> None:
+        self.execute("HSET", key, field, value)
+
+    def hget(self, key: str, field: Any) -> Optional[str]:
+        return self.execute("HGET", key, field)
+
+    def hdel(self, key: str, field: Any) -> None:
+        self.execute("HDEL", key, field)
+
+    def hincrby(self, key: str, field: Any, amount: int) -> int:
+        return self.execute("HINCRBY", key, field, amount)
+
+    def zadd(self, key: str, score: float, member: Any) -> None:
+        self.execute("ZADD", key, score, member)
+
+    def zrem(self, key: str, member: Any) -> None:
+        self.execute("ZREM", key, member)
+
+    def zscore(self, key: str, member: Any) -> Optional[float]:
+        score = self.execute("ZSCORE", key, member)
+        return None if score is None else float(score)
+
+    def zcount(self, key: str, low: float, high: float) -> int:
+        return self.execute("ZCOUNT", key, low, high)
+
+    def zrangebyscore(self, key: str, low: float, high: float, offset: int, count: int) -> List[str]:
+        return self.execute("ZRANGEBYSCORE", key, low, high, "LIMIT", offset, count)
+
+
+class KVStore:
+    """
+    Bot state in a networked key-value server (Redis protocol), for several instances.
+
+    live chats are a set (streamed with SSCAN) plus a last-seen sorted set for segments,
+    blocked chats a set (their last-seen times in a hash) and delivery failure counts a
+    hash; the inbox is a capped list, every thread mapping its own key (expiring after
+    THREAD_TTL; THREAD_MAX is left to the server's eviction policy), pending stickers a
+    hash. Per-chat ordering across instances uses short SET NX PX locks. `client` is a RedisKV or a MemoryKV stand-in.
+    """
+
+    def __init__(self, client: Any, prefix: str = "bot:", inbox_limit: int = INBOX_LIMIT,
+                 lock_ttl_ms: int = 30000) -> None:
+        self.kv = client
+        self.prefix = prefix
+        self.inbox_limit = inbox_limit
+        self.lock_ttl_ms = lock_ttl_ms
+        self.loaded = True
+        self.blocking = not isinstance(client, MemoryKV)   # server round trips: through store_io()
+        self._appends = 0
+        self._touched: Dict[int, int] = {}   # chat_id -> last_seen written by this instance
+
+    def _key(self, *parts: Any) -> str:
+        return self.prefix + ":".join(str(p) for p in parts)
+
+    def load(self) -> None:
+        pass
+
+    def ensure_loaded(self) -> None:
+        pass
+
+    # ---- seen chats ----
+    def add_seen_chat(self, chat_id: int) -> None:
+        ts = now_ts()
+        last = self._touched.get(chat_id)
+        # another instance may have blocked the chat since this one last wrote it
+        if (last is not None and ts - last < CHAT_SEEN_RESOLUTION
+                and not self.kv.sismember(self._key("blocked"), chat_id)):
+            return
+        if len(self._touched) >= 100000:
+            self._touched.clear()
+        self._touched[chat_id] = ts
+        self.kv.execute_many([
+            ("SADD", self._key("seen"), chat_id),
+            ("ZADD", self._key("lastseen"), ts, chat_id),
+            ("SREM", self._key("blocked"), chat_id),
+            ("HDEL", self._key("fails"), chat_id),
+            ("HDEL", self._key("blockedseen"), chat_id),
+        ])
+
+    def iter_seen_chats(self, active_since: Optional[int] = None, page_size: int = 500) -> Iterator[int]:
+        if active_since is not None:
+            offset = 0
+            while True:
+                page = self.kv.zrangebyscore(self._key("lastseen"), active_since, float("inf"), offset, page_size)
+                for member in page:
+                    yield int(member)
+                if len(page) < page_size:
+                    return
+                offset += page_size
+        cursor = 0
+        while True:
+            cursor, page = self.kv.sscan(self._key("seen"), cursor, page_size)
+            for member in page:
+                yield int(member)
+            if cursor == 0:
+                return
+
+    def count_seen_chats(self, active_since: Optional[int] = None) -> int:
+        if active_since is not None:
+            return self.kv.zcount(self._key("lastseen"), active_since, float("inf"))
+        return self.kv.scard(self._key("seen"))
+
+    def count_blocked_chats(self) -> int:
+        return self.kv.scard(self._key("blocked"))
+
+    def record_delivery(self, chat_id: int, ok: bool, permanent: bool = False) -> bool:
+        """Note a delivery result for chat_id; True if the chat is now blocked."""
+        if ok:
+            # a blocked chat that takes a message is reachable again, with its old last_seen
+            _, unblocked, last_seen = self.kv.execute_many([
+                ("HDEL", self._key("fails"), chat_id),
+                ("SREM", self._key("blocked"), chat_id),
+                ("HGET", self._key("blockedseen"), chat_id),
+            ])
+            if unblocked:
+                self.kv.execute_many([
+                    ("SADD", self._key("seen"), chat_id),
+                    ("ZADD", self._key("lastseen"), int(last_seen or 0), chat_id),
+                    ("HDEL", self._key("blockedseen"), chat_id),
+                ])
+            return False
+        fails = self.kv.hincrby(self._key("fails"), chat_id, 1)
+        if not permanent and fails < CHAT_MAX_FAILURES:
+            return False
+        last_seen = self.kv.zscore(self._key("lastseen"), chat_id)
+        self.kv.execute_many([
+            ("SREM", self._key("seen"), chat_id),
+            ("ZREM", self._key("lastseen"), chat_id),
+            ("SADD", self._key("blocked"), chat_id),
+            ("HDEL", self._key("fails"), chat_id),
+            ("HSET", self._key("blockedseen"), chat_id, int(last_seen or 0)),
+        ])
+        self._touched.pop(chat_id, None)
+        return True
+
+    # ---- inbox ----
+    def append_inbox(self, entry: Dict[str, Any]) -> None:
+        key = self._key("inbox")
+        self.kv.rpush(key, json.dumps(entry, ensure_ascii=False, separators=(",", ":")))
+        self._appends += 1
+        if self._appends % 32 == 0:
+            self.kv.ltrim(key, -self.inbox_limit, -1)
+
+    def query_inbox(self, limit: int = 20, offset: int = 0, user_id: Optional[int] = None,
+                    chat_id: Optional[int] = None, since: Optional[int] = None,
+                    until: Optional[int] = None, text: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Newest-first page of inbox entries matching the given filters (`text`: substring)."""
+        key = self._key("inbox")
+        needle = (text or "").lower()
+        out: List[Dict[str, Any]] = []
+        skipped = 0
+        end = -1
+        total = min(self.kv.llen(key), self.inbox_limit)
+        while -end <= total and len(out) < limit:
+            start = max(end - 199, -total)
+            for raw in reversed(self.kv.lrange(key, start, end)):
+                e = json.loads(raw)
+                if user_id is not None and e.get("user_id") != user_id:
+                    continue
+                if chat_id is not None and e.get("chat_id") != chat_id:
+                    continue
+                if since is not None and e.get("ts", 0) < since:
+                    continue
+                if until is not None and e.get("ts", 0) >= until:
+                    continue
+                if needle and needle not in (e.get("text") or "").lower():
+                    continue
+                if skipped < offset:
+                    skipped += 1
+                    continue
+                out.append(e)
+                if len(out) >= limit:
+                    break
+            end = start - 1
+        return out
+
+    # ---- thread map ----
+    def put_thread(self, admin_id: int, admin_msg_id: int, user_chat_id: int) -> None:
+        self.kv.set(self._key("thread", admin_id, admin_msg_id), user_chat_id, px=int(THREAD_TTL * 1000))
+
+    def put_threads(self, entries: List[Tuple[int, int, int]]) -> None:
+        if entries:
+            self.kv.mset_px({self._key("thread", aid, mid): chat for aid, mid, chat in entries},
+                            int(THREAD_TTL * 1000))
+
+    def get_thread(self, admin_id: int, admin_msg_id: int) -> Optional[int]:
+        val = self.kv.get(self._key("thread", admin_id, admin_msg_id))
+        return int(val) if val is not None else None
+
+    # ---- pending sticker ----
+    def set_pending(self, admin_id: int, target_chat: int) -> None:
+        self.kv.hset(self._key("pending"), admin_id, target_chat)
+
+    def get_pending(self, admin_id: int) -> Optional[int]:
+        val = self.kv.hget(self._key("pending"), admin_id)
+        return int(val) if val is not None else None
+
+    def pop_pending(self, admin_id: int) -> Optional[int]:
+        val = self.get_pending(admin_id)
+        if val is not None:
+            self.kv.hdel(self._key("pending"), admin_id)
+        return val
+
+    # ---- per-chat ordering ----
+    @contextlib.asynccontextmanager
+    async def chat_lock(self, chat_id: Optional[int]) -> AsyncIterator[None]:
+        if chat_id is None:
+            yield
+            return
+        key = self._key("lock", chat_id)
+        token = secrets.token_hex(8)
+        delay = 0.005
+        while not await store_io(self.kv.set, key, token, nx=True, px=self.lock_ttl_ms):
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.1)
+        try:
+            yield
+        finally:
+            await store_io(self._unlock, key, token)
+
+    def _unlock(self, key: str, token: str) -> None:
+        if self.kv.get(key) == token:
+            self.kv.delete(key)
+
+    def flush(self) -> None:
+        pass
+
+    async def flush_async(self) -> None:
+        pass
+
+    def close(self) -> None:
+        if hasattr(self.kv, "close"):
+            self.kv.close()
+
+
+def make_store() -> "MemoryStore | SqliteStore | KVStore":
+    if STORE_BACKEND == "kv":
+        return KVStore(RedisKV(KV_URL) if KV_URL else MemoryKV(), prefix=KV_PREFIX)
+    if STORE_BACKEND == "shared":
+        return SharedFileStore(DATA_FILE, JOURNAL_FILE, compact_bytes=JOURNAL_COMPACT_BYTES)
+    if STORE_BACKEND == "sqlite":
+        return SqliteStore(SQLITE_FILE, inbox_limit=SQLITE_INBOX_LIMIT, import_from=DATA_FILE)
+    if STORE_BACKEND == "journal":
+        return JournalStore(DATA_FILE, JOURNAL_FILE, flush_interval=STORE_FLUSH_INTERVAL,
+                            compact_bytes=JOURNAL_COMPACT_BYTES)
+    return MemoryStore(DATA_FILE, flush_interval=STORE_FLUSH_INTERVAL)
+
+
+STORE = make_store()
+STORE_THREAD: Optional[ThreadPoolExecutor] = None
+
+async def store_io(fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+    """
+    Call a STORE method from the event loop. Backends that make network round trips or
+    wait on file locks (kv with a server, shared) run on one dedicated thread, which also
+    keeps their calls in order; the in-process backends are called directly.
+    """
+    global STORE_THREAD
+    if not STORE.blocking:
+        return fn(*args, **kwargs)
+    if STORE_THREAD is None:
+        STORE_THREAD = ThreadPoolExecutor(1, thread_name_prefix="store")
+    ctx = contextvars.copy_context()   # keeps the log context
+    call = functools.partial(ctx.run, fn, *args, **kwargs)
+    return await asyncio.get_running_loop().run_in_executor(STORE_THREAD, call)
+
+def close_store() -> None:
+    """Let queued store calls finish, then flush and close the store."""
+    global STORE_THREAD
+    if STORE_THREAD is not None:
+        STORE_THREAD.shutdown(wait=True)
+        STORE_THREAD = None
+    STORE.close()
+
+register_metric(Gauge("bot_thread_map", "In-memory thread map size and evictions.",
+                      lambda: STORE.thread_map.stats() if isinstance(STORE, MemoryStore) else {}, label="event"))
+
+# -------------------- Helpers --------------------
+def is_admin(uid: Optional[int]) -> bool:
+    return uid in ADMIN_IDS
+
+def now_ts() -> int:
+    return int(time.time())
+
+def fmt_time(ts: int) -> str:
+    return datetime.fromtimestamp(ts).strftime("%Y-%m-%d %H:%M:%S")
+
+def escape_html(s: str) -> str:
+    if "&" in s or "<" in s or ">" in s:
+        return s.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+    return s   # most messages have nothing to escape
+
+# message content helpers
+MEDIA_KINDS = ("photo", "video", "animation", "document", "audio", "voice", "video_note", "sticker",
+               "contact", "location", "venue", "poll", "dice")
+CAPTION_KINDS = ("photo", "video", "animation", "document", "audio", "voice")   # accept a caption
+CAPTION_LIMIT = 1024
+MESSAGE_LIMIT = 4096
+
+def message_kind(msg: Dict[str, Any]) -> Optional[str]:
+    """Type of non-text content in a message ("photo", "voice", ...), or None for plain text."""
+    return next((k for k in MEDIA_KINDS if msg.get(k)), None)
+
+def split_text(text: str, limit: int = MESSAGE_LIMIT) -> List[str]:
+    """Split text into chunks of at most `limit` chars, at line breaks where possible."""
+    chunks: List[str] = []
+    current = ""
+    for line in text.split("\n"):
+        while len(line) > limit:
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(line[:limit])
+            line = line[limit:]
+        if current and len(current) + 1 + len(line) > limit:
+            chunks.append(current)
+            current = line
+        else:
+            current = f"{current}\n{line}" if current else line
+    if current or not chunks:
+        chunks.append(current)
+    return chunks
+
+async def send_long_message_async(chat_id: int, text: str, parse_mode: Optional[str] = None) -> Dict:
+    """send_message_async for text that may exceed MESSAGE_LIMIT: one message per chunk, in order."""
+    res: Dict[str, Any] = {}
+    for chunk in split_text(text):
+        res = await send_message_async(chat_id, chunk, parse_mode=parse_mode)
+        if not res.get("ok"):
+            break
+    return res
+
+# album helpers
+ALBUM_KINDS = ("photo", "video", "document", "audio")   # what sendMediaGroup accepts
+MAX_ALBUM_PARTS = 10
+
+def album_media(msgs: List[Dict[str, Any]], captions: Optional[List[Optional[str]]] = None) -> List[Dict[str, Any]]:
+    """
+    InputMedia list for sendMediaGroup from the messages of an album. Each item keeps its
+    own caption unless `captions` (one entry per message) is given.
+    """
+    media: List[Dict[str, Any]] = []
+    for i, m in enumerate(msgs):
+        kind = next((k for k in ALBUM_KINDS if m.get(k)), None)
+        if kind is None:
+            continue
+        file_id = m["photo"][-1].get("file_id") if kind == "photo" else m[kind].get("file_id")
+        item = {"type": kind, "media": file_id}
+        caption = captions[i] if captions is not None else m.get("caption")
+        if caption:
+            item["caption"] = caption
+        media.append(item)
+    return media
+
+# thread_map helpers
+async def store_thread_map(admin_id: int, admin_msg_id: int, user_chat_id: int) -> None:
+    await store_io(STORE.put_thread, admin_id, admin_msg_id, user_chat_id)
+
+async def store_thread_maps(entries: List[Tuple[int, int, int]]) -> None:
+    """Store several (admin_id, admin_msg_id, user_chat_id) mappings in one batch."""
+    if entries:
+        await store_io(STORE.put_threads, entries)
+
+async def lookup_thread_target(admin_id: int, admin_msg_id: int) -> Optional[int]:
+    return await store_io(STORE.get_thread, admin_id, admin_msg_id)
+
+# only the line the bot writes under the user's name (UserRender); names can't span lines,
+# and the first such line comes before any quoted user text
+CHAT_ID_RE = re.compile(r"^user_id: \S+ \| chat_id: (-?\d+)$", re.M)
+
+DIGEST_TITLE = "🗂 Digest"
+DIGEST_LINE_RE = re.compile(r"^#(\d+) .*\| chat_id: (-?\d+)$", re.M)
+
+def parse_digest_reply(replied: Dict[str, Any], text: str) -> Tuple[Optional[int], str]:
+    """
+    (user chat_id, text without the `#N` prefix) for an admin reply to a digest; the chat
+    id comes from line `#N` of the digest. Without a `#N` prefix only a single-user
+    digest has an unambiguous target.
+    """
+    targets = {int(n): int(chat) for n, chat in DIGEST_LINE_RE.findall(replied.get("text") or "")}
+    m = re.match(r"#(\d+)\s*", text or "")
+    if m and int(m.group(1)) in targets:
+        return targets[int(m.group(1))], text[m.end():]
+    if len(set(targets.values())) == 1:
+        return next(iter(targets.values())), text
+    return None, text
+
+def is_digest(replied: Dict[str, Any]) -> bool:
+    if not (replied.get("from") or {}).get("is_bot", True):
+        return False
+    return (replied.get("text") or "").startswith(DIGEST_TITLE)
+
+async def resolve_reply_target(admin_id: int, replied: Dict[str, Any], text: str = "") -> Optional[int]:
+    """
+    User chat an admin's reply should go to: the thread mapping of the replied-to message,
+    or, once that has expired, the `user_id: … | chat_id: …` line notify_admins puts in its
+    texts/captions (never one from user-written text).
+    Replies to a digest pick their user with a `#N` prefix in `text`.
+    """
+    if is_digest(replied):
+        return parse_digest_reply(replied, text)[0]
+    target = await lookup_thread_target(admin_id, replied.get("message_id"))
+    if target:
+        return target
+    if not (replied.get("from") or {}).get("is_bot", True):
+        return None   # the admin's own message, not one of our notifications
+    m = CHAT_ID_RE.search(replied.get("text") or replied.get("caption") or "")
+    return int(m.group(1)) if m else None
+
+# pending sticker helpers
+async def set_pending_sticker(admin_id: int, target_chat: int) -> None:
+    await store_io(STORE.set_pending, admin_id, int(target_chat))
+
+async def get_pending_sticker(admin_id: int) -> Optional[int]:
+    return await store_io(STORE.get_pending, admin_id)
+
+async def pop_pending_sticker(admin_id: int) -> Optional[int]:
+    return await store_io(STORE.pop_pending, admin_id)
+
+# -------------------- Notifications to admins --------------------
+class UserRender:
+    """Pre-rendered notification pieces for one (user, chat); `key` is what they were built from."""
+
+    __slots__ = ("key", "identity", "album_caption", "keyboard")
+
+    def __init__(self, uid: Any, chat_id: int, first: str, last: str, username: str) -> None:
+        self.key = (first, last, username)
+        fullname = (first + " " + last).strip() or "(no name)"
+        lines = [f"Name: {escape_html(fullname)}"]
+        if username:
+            lines.append(f"Username: @{escape_html(username)}")
+        lines.append(f"user_id: {uid} | chat_id: {chat_id}")
+        self.identity = "\n".join(lines)
+        self.album_caption = f"{fullname} | @{username if username else 'no-username'}\nuser_id: {uid} | chat_id: {chat_id}"
+        # inline keyboard, already JSON so encode_params sends it as is
+        self.keyboard = json.dumps({"inline_keyboard": [[
+            {"text": "Copy user_id", "callback_data": f"copyuid:{uid}"},
+            {"text": "Prepare Reply", "callback_data": f"prep_reply:{chat_id}"},
+            {"text": "Prepare Send Media", "callback_data": f"prep_send_media:{chat_id}"},
+        ]]}, ensure_ascii=False)
+
+
+class RenderCache:
+    """
+    UserRender per (user_id, chat_id), rebuilt when the user's name or username changes,
+    LRU-bounded at `max_users`; plus the formatted time of the current second.
+    """
+
+    def __init__(self, max_users: int = 10000) -> None:
+        self.max_users = max_users
+        self.users: "OrderedDict[Tuple[Any, int], UserRender]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._ts = -1
+        self._ts_text = ""
+
+    def user(self, user_from: Dict[str, Any], chat_id: int) -> UserRender:
+        uid = user_from.get("id")
+        first = user_from.get("first_name") or ""
+        last = user_from.get("last_name") or ""
+        username = user_from.get("username") or ""
+        cache_key = (uid, chat_id)
+        r = self.users.get(cache_key)
+        if r is not None and r.key == (first, last, username):
+            self.users.move_to_end(cache_key)
+            self.hits += 1
+            return r
+        self.misses += 1
+        r = self.users[cache_key] = UserRender(uid, chat_id, first, last, username)
+        self.users.move_to_end(cache_key)
+        if len(self.users) > self.max_users:
+            self.users.popitem(last=False)
+        return r
+
+    def time(self, ts: int) -> str:
+        if ts != self._ts:
+            self._ts, self._ts_text = ts, fmt_time(ts)
+        return self._ts_text
+
+    def stats(self) -> Dict[str, int]:
+        return {"users": len(self.users), "hits": self.hits, "misses": self.misses}
+
+
+RENDER = RenderCache()
+register_metric(Gauge("bot_render_cache", "Notification render cache counters since start.", RENDER.stats, label="event"))
+
+def quote_block(text: str, limit: int) -> str:
+    """`<pre>"text"</pre>` taking at most `limit` characters once rendered (text cut with …)."""
+    room = max(limit - 2, 1)
+    if len(text) > room:
+        text = text[:room - 1] + "…"
+    return f"<pre>\"{escape_html(text)}\"</pre>"
+
+async def notify_admins(user_chat_id: int, user_from: Dict[str, Any], text: str,
+                        message=None, album=None, title: str = "📩 New message to bot") -> None:
+    """
+    Copy the user's message to admins (so admins can reply directly to it), an album
+    (list of messages) as one media group, and send a quoted notification with 3 inline buttons:
+      - Copy user_id
+      - Prepare Reply
+      - Prepare Send Media
+    Media that takes a caption is copied with the notification as its caption, so it
+    costs one call per admin; other content is copied and followed by the notification.
+    Admins are notified concurrently (at most NOTIFY_CONCURRENCY at a time); within one
+    admin's chat the media still arrives before the notification. Each admin message id
+    is mapped back to the user's chat id, and all mappings are stored in one batch.
+    The user's identity lines and keyboard come from RENDER, and each payload is encoded
+    once for all admins (PreEncoded); a quoted text too long for one message is cut.
+    """
+    r = RENDER.user(user_from, user_chat_id)
+    head = f"{title}\nTime: {RENDER.time(now_ts())}\n{r.identity}\n\n"
+    body = head + quote_block(text or "", MESSAGE_LIMIT - len(head))
+    kind = message_kind(message) if message else None
+    with_caption = kind in CAPTION_KINDS and len(body) <= CAPTION_LIMIT
+
+    notice_body = encode_params({"text": body, "parse_mode": "HTML", "reply_markup": r.keyboard})
+    if with_caption:
+        copy_body = encode_params({"from_chat_id": (message.get("chat") or {}).get("id"),
+                                   "message_id": message.get("message_id"), "caption": body,
+                                   "parse_mode": "HTML", "reply_markup": r.keyboard})
+    if album:
+        # identity caption on the first item only: Telegram shows it as the album caption
+        group_body = encode_params({"media": album_media(album, [r.album_caption] + [None] * (len(album) - 1))})
+
+    sem = asyncio.Semaphore(NOTIFY_CONCURRENCY)
+
+    async def notify_one(aid: int) -> List[Tuple[int, int, int]]:
+        mapped: List[Tuple[int, int, int]] = []
+
+        def track(res: Dict[str, Any]) -> None:
+            if res.get("ok") and res.get("result"):
+                result = res["result"]
+                for sent in result if isinstance(result, list) else [result]:
+                    mapped.append((aid, sent["message_id"], user_chat_id))
+
+        async with sem:
+            try:
+                if album:
+                    track(await api_request_async("sendMediaGroup", PreEncoded(aid, group_body)))
+                if with_caption:
+                    res = await api_request_async("copyMessage", PreEncoded(aid, copy_body))
+                    track(res)
+                    if res.get("ok"):
+                        return mapped
+                elif kind in CAPTION_KINDS:
+                    # without the user's caption: it is quoted in the notification, and a
+                    # copied caption must not be mistaken for our chat_id line (CHAT_ID_RE)
+                    track(await relay_message_async(aid, message, caption=""))
+                elif kind:
+                    track(await relay_message_async(aid, message))
+                # notification message -> user chat (for reply-forwarding)
+                track(await api_request_async("sendMessage", PreEncoded(aid, notice_body)))
+            except Exception as exc:
+                log.warning("notifying admin %s failed: %r", aid, exc)
+        return mapped
+
+    t0 = time.perf_counter()
+    results = await asyncio.gather(*(notify_one(aid) for aid in ADMIN_IDS))
+    NOTIFY_LATENCY.observe(time.perf_counter() - t0)
+    try:
+        await store_thread_maps([entry for mapped in results for entry in mapped])
+    except Exception as exc:
+        log.error("storing thread map failed: %s", exc)
+
+async def notify_admins_digest(entries: List[Dict[str, Any]]) -> None:
+    """
+    One combined notification per admin for several users' text messages (digest mode).
+    Each user gets a numbered block `#N name | user_id | chat_id` with their messages and
+    one row of buttons; admins answer with a reply starting `#N` (see parse_digest_reply).
+    A digest for a single user is also thread-mapped, so a plain reply works. A digest
+    still too long for one message is sent as two.
+    """
+    blocks, kb = [], []
+    for n, e in enumerate(entries, 1):
+        frm = e["from"]
+        name = ((frm.get("first_name") or "") + " " + (frm.get("last_name") or "")).strip() or "(no name)"
+        if frm.get("username"):
+            name += f" @{frm['username']}"
+        lines = [f"#{n} {escape_html(name)} | user_id: {frm.get('id')} | chat_id: {e['chat_id']}"]
+        lines += [f"  › {text}" for text in e["texts"]]   # escaped by AdminDigest.add
+        if e["count"] > len(e["texts"]):
+            lines.append(f"  (+{e['count'] - len(e['texts'])} more)")
+        blocks.append("\n".join(lines))
+        kb.append([
+            {"text": f"#{n} Reply", "callback_data": f"prep_reply:{e['chat_id']}"},
+            {"text": f"#{n} Media", "callback_data": f"prep_send_media:{e['chat_id']}"},
+        ])
+    total = sum(e["count"] for e in entries)
+    body = (f"{DIGEST_TITLE}: {total} messages from {len(entries)} users ({fmt_time(now_ts())})\n"
+            "Reply with #N &lt;text&gt; to answer user N.\n\n" + "\n\n".join(blocks))
+    if len(body) > MESSAGE_LIMIT and len(entries) > 1:
+        half = len(entries) // 2
+        await notify_admins_digest(entries[:half])
+        await notify_admins_digest(entries[half:])
+        return
+    payload = encode_params({"text": body, "parse_mode": "HTML", "reply_markup": {"inline_keyboard": kb}})
+    sem = asyncio.Semaphore(NOTIFY_CONCURRENCY)
+
+    async def notify_one(aid: int) -> Optional[Tuple[int, int, int]]:
+        async with sem:
+            res = await api_request_async("sendMessage", PreEncoded(aid, payload))
+        if res.get("ok") and len(entries) == 1:
+            return aid, res["result"]["message_id"], entries[0]["chat_id"]
+        return None
+
+    t0 = time.perf_counter()
+    results = await asyncio.gather(*(notify_one(aid) for aid in ADMIN_IDS), return_exceptions=True)
+    NOTIFY_LATENCY.observe(time.perf_counter() - t0)
+    try:
+        await store_thread_maps([r for r in results if isinstance(r, tuple)])
+    except Exception as exc:
+        log.error("storing digest thread map failed: %s", exc)
+
+# -------------------- Stats rollups --------------------
+class StatsRollup:
+    """
+    Counters for /stats, kept as hourly and daily buckets ({bucket start: {counter: n}})
+    and updated as messages, admin replies and broadcast deliveries happen, so a
+    query adds up buckets instead of scanning the inbox. Unique users are one id set
+    per day. Hours older than `hours` and days older than `days` are dropped.
+
+    Workers (uvicorn --workers N) share `path`: each save adds the counts this worker
+    gathered since its last save into the file under a lock and takes the merged totals
+    back, so every worker sees everyone's counts as of its last save. Saves run in a
+    thread at most every `save_interval` seconds, before /stats and on shutdown.
+    """
+
+    def __init__(self, path: str, hours: int = 48, days: int = 30, save_interval: float = 60.0) -> None:
+        self.path = path
+        self.keep_hours = hours
+        self.keep_days = days
+        self.save_interval = save_interval
+        self.hours: Dict[int, Dict[str, float]] = {}
+        self.days: Dict[int, Dict[str, float]] = {}
+        self.users: Dict[int, Set[int]] = {}
+        self._delta = self._empty()   # counted here since the last save
+        self._last_save = time.monotonic()
+        self._save_lock = asyncio.Lock()
+        self._save_task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def _empty() -> Dict[str, Dict[int, Any]]:
+        return {"hours": {}, "days": {}, "users": {}}
+
+    @staticmethod
+    def _merge(into: Dict[str, Dict[int, Any]], other: Dict[str, Dict[int, Any]]) -> None:
+        for name in ("hours", "days"):
+            for start, counts in other[name].items():
+                bucket = into[name].setdefault(start, {})
+                for k, v in counts.items():
+                    bucket[k] = bucket.get(k, 0) + v
+        for start, ids in other["users"].items():
+            into["users"].setdefault(start, set()).update(ids)
+
+    def _view(self) -> Dict[str, Dict[int, Any]]:
+        return {"hours": self.hours, "days": self.days, "users": self.users}
+
+    def add(self, counter: str, amount: float = 1, ts: Optional[float] = None) -> None:
+        ts = time.time() if ts is None else ts
+        hour = int(ts // 3600 * 3600)
+        day = int(ts // 86400 * 86400)
+        for name, start in (("hours", hour), ("days", day)):
+            buckets = getattr(self, name)
+            if start not in buckets:
+                self._expire(buckets, ts, name)
+            for target in (buckets, self._delta[name]):
+                bucket = target.setdefault(start, {})
+                bucket[counter] = bucket.get(counter, 0) + amount
+        self._maybe_save()
+
+    def _expire(self, buckets: Dict[int, Any], ts: float, name: str) -> None:
+        keep = ts - (self.keep_hours * 3600 if name == "hours" else self.keep_days * 86400)
+        for start in [s for s in buckets if s < keep]:
+            del buckets[start]
+
+    def _expire_all(self, data: Dict[str, Dict[int, Any]], ts: float) -> None:
+        for name, buckets in data.items():
+            self._expire(buckets, ts, name)
+
+    # ---- events ----
+    def record_message(self, msg: Dict[str, Any]) -> None:
+        """A user message: counted by content type, and its sender for unique users."""
+        ts = time.time()
+        self.add("messages", ts=ts)
+        self.add("kind:" + (message_kind(msg) or "text"), ts=ts)
+        user_id = (msg.get("from") or {}).get("id")
+        if user_id is not None:
+            day = int(ts // 86400 * 86400)
+            for users in (self.users, self._delta["users"]):
+                users.setdefault(day, set()).add(user_id)
+
+    def record_reply(self, admin_id: int, msg: Dict[str, Any], replied: Dict[str, Any]) -> None:
+        """
+        An admin reply relayed to a user. The response time runs from the notification
+        it replies to (the thread map entry's message) to the reply, using both dates.
+        """
+        self.add(f"replies:{admin_id}")
+        sent, answered = replied.get("date"), msg.get("date")
+        if sent and answered and answered >= sent:
+            self.add(f"reply_secs:{admin_id}", answered - sent)
+            self.add(f"timed:{admin_id}")
+
+    def record_delivery(self, result: str) -> None:
+        """Broadcast delivery result: "sent", "failed" or "pruned"."""
+        self.add("broadcast:" + result)
+
+    # ---- queries ----
+    def totals(self, since: float, hourly: bool = False) -> Dict[str, float]:
+        """Counters summed over the buckets starting at or after `since`."""
+        out: Dict[str, float] = {}
+        for start, bucket in (self.hours if hourly else self.days).items():
+            if start >= since:
+                for k, v in bucket.items():
+                    out[k] = out.get(k, 0) + v
+        return out
+
+    def series(self, counter: str, count: int, hourly: bool = False) -> List[Tuple[int, float]]:
+        """(bucket start, value) for the last `count` hours or days, oldest first, zeros included."""
+        step = 3600 if hourly else 86400
+        buckets = self.hours if hourly else self.days
+        last = int(time.time() // step * step)
+        return [(s, buckets.get(s, {}).get(counter, 0)) for s in range(last - (count - 1) * step, last + 1, step)]
+
+    def unique_users(self, since: float) -> int:
+        days = [users for start, users in self.users.items() if start >= since]
+        return len(set().union(*days)) if days else 0
+
+    def daily_users(self, day: int) -> int:
+        return len(self.users.get(day, ()))
+
+    # ---- persistence ----
+    @staticmethod
+    def to_snapshot(data: Dict[str, Dict[int, Any]]) -> Dict[str, Any]:
+        return {
+            "hours": {str(k): v for k, v in data["hours"].items()},
+            "days": {str(k): v for k, v in data["days"].items()},
+            "users": {str(k): sorted(v) for k, v in data["users"].items()},
+        }
+
+    @classmethod
+    def from_snapshot(cls, snap: Dict[str, Any]) -> Dict[str, Dict[int, Any]]:
+        data = cls._empty()
+        for name in ("hours", "days"):
+            data[name] = {int(k): dict(v) for k, v in (snap.get(name) or {}).items()}
+        data["users"] = {int(k): set(v) for k, v in (snap.get("users") or {}).items()}
+        return data
+
+    def _merge_file(self, delta: Dict[str, Dict[int, Any]]) -> Optional[Dict[str, Dict[int, Any]]]:
+        """Add `delta` into the file under its lock; the merged totals, or None if saving failed."""
+        lock_fh = open(self.path + ".wlock", "a+") if fcntl is not None else None
+        try:
+            if lock_fh is not None:
+                fcntl.flock(lock_fh.fileno(), fcntl.LOCK_EX)
+            data = self.from_snapshot(load_store(self.path))
+            self._merge(data, delta)
+            self._expire_all(data, time.time())
+            if any(delta.values()) and not save_store(self.to_snapshot(data), self.path):
+                return None
+            return data
+        finally:
+            if lock_fh is not None:
+                lock_fh.close()   # releases the flock
+
+    async def save(self) -> None:
+        """Merge this worker's counts into `path` (in a thread: it waits on the file lock and fsyncs)."""
+        self._last_save = time.monotonic()
+        async with self._save_lock:
+            delta, self._delta = self._delta, self._empty()
+            data = await asyncio.to_thread(self._merge_file, delta)
+            if data is None:
+                self._merge(self._delta, delta)   # keep them for the next save
+                return
+            # counts that arrived while the thread ran are not in the file yet
+            self._merge(data, self._delta)
+            self.hours, self.days, self.users = data["hours"], data["days"], data["users"]
+
+    async def load(self) -> None:
+        await self.save()
+
+    def _maybe_save(self) -> None:
+        if time.monotonic() - self._last_save < self.save_interval:
+            return
+        if self._save_task is None or self._save_task.done():
+            self._last_save = time.monotonic()
+            self._save_task = asyncio.get_running_loop().create_task(self.save())
+
+    async def close(self) -> None:
+        if self._save_task is not None:
+            await asyncio.gather(self._save_task, return_exceptions=True)
+        if any(self._delta.values()):
+            await self.save()
+
+    def stats(self) -> Dict[str, int]:
+        return {"hours": len(self.hours), "days": len(self.days),
+                "user_ids": sum(len(u) for u in self.users.values())}
+
+
+STATS = StatsRollup(STATS_FILE, days=STATS_DAYS)
+register_metric(Gauge("bot_stats_buckets", "Buckets and user ids held by the /stats rollups.", STATS.stats, label="event"))
+
+# -------------------- Broadcast jobs --------------------
+def is_dead_chat(res: Dict[str, Any]) -> bool:
+    """True for send errors meaning the chat can't be reached again (bot blocked, chat gone)."""
+    desc = (res.get("description") or "").lower()
+    code = res.get("code")
+    return code == 403 or (code == 400 and ("chat not found" in desc or "user is deactivated" in desc))
+
+class BroadcastJob:
+    """One broadcast: a fixed list of target chats plus progress counters."""
+
+    FIELDS = ("id", "admin_id", "text", "total", "done_upto", "sent", "failed", "pruned", "status",
+              "created", "finished", "active_days")
+
+    def __init__(self, job_id: str, admin_id: int, text: str, targets: List[int]) -> None:
+        self.id = job_id
+        self.admin_id = admin_id
+        self.text = text
+        self.targets = targets
+        self.total = len(targets)
+        self.done_upto = 0          # every target before this index has been attempted
+        self.sent = 0
+        self.failed = 0
+        self.pruned = 0             # failed chats that are now marked blocked
+        self.status = "running"     # running | done | cancelled
+        self.created = now_ts()
+        self.finished: Optional[int] = None
+        self.active_days: Optional[int] = None   # segment: chats active in the last N days
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {f: getattr(self, f) for f in self.FIELDS}
+
+    @classmethod
+    def from_dict(cls, d: Dict[str, Any], targets: List[int]) -> "BroadcastJob":
+        job = cls(d["id"], d["admin_id"], d["text"], targets)
+        for f in cls.FIELDS:
+            if f in d:
+                setattr(job, f, d[f])
+        return job
+
+    def describe(self) -> str:
+        pruned = f" ({self.pruned} unreachable chats pruned)" if self.pruned else ""
+        return (f"Broadcast {self.id}: {self.status} — sent {self.sent}, failed {self.failed}{pruned}, "
+                f"progress {self.done_upto}/{self.total}")
+
+
+class BroadcastManager:
+    """
+    Runs broadcasts as background asyncio tasks so the webhook can return at once.
+
+    Sends run at bulk priority through API_SCHEDULER, which applies the global, per-chat
+    and bulk (BROADCAST_RATE/s) limits and the 429/transient-error retries, with
+    BROADCAST_WORKERS sends in flight. Targets are all reachable chats or a segment of
+    them (active in the last N days); every result is recorded in the chat registry,
+    so chats that blocked the bot are pruned from later broadcasts.
+    Progress is saved to BROADCAST_FILE about once a second and running jobs resume
+    from their last saved position on startup (a few chats near the resume point can
+    get the message twice).
+    """
+
+    def __init__(self, path: str, workers: int) -> None:
+        self.path = path
+        self.workers = workers
+        self.jobs: Dict[str, BroadcastJob] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._changed: Set[str] = set()   # jobs changed here since the last save
+        self._last_save = 0.0
+        self._save_lock = asyncio.Lock()
+        self._leader_fh: Any = None
+
+    def _targets_path(self, job_id: str) -> str:
+        return f"{self.path}.{job_id}.targets"
+
+    # ---- persistence ----
+    # Workers (uvicorn --workers N) share BROADCAST_FILE: each save merges this worker's
+    # changed and running jobs into the file under a lock and takes every other job from
+    # it, so any worker can report on or cancel any job. A cancel written by another
+    # worker stops the job at the owner's next save.
+    def _merge_file(self, local: Dict[str, Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+        lock_fh = open(self.path + ".wlock", "a+") if fcntl is not None else None
+        try:
+            if lock_fh is not None:
+                fcntl.flock(lock_fh.fileno(), fcntl.LOCK_EX)
+            saved = {d["id"]: d for d in load_store(self.path).get("jobs", [])}
+            for job_id, d in local.items():
+                other = saved.get(job_id)
+                if other and other.get("status") == "cancelled" and d["status"] == "running":
+                    d = dict(d, status="cancelled", finished=other.get("finished"))
+                saved[job_id] = d
+            if local:
+                save_store({"jobs": list(saved.values())}, self.path)
+            return saved
+        finally:
+            if lock_fh is not None:
+                lock_fh.close()   # releases the flock
+
+    def _local_changes(self) -> Dict[str, Dict[str, Any]]:
+        ids = self._changed | set(self._tasks)
+        self._changed = set()
+        return {job_id: self.jobs[job_id].to_dict() for job_id in ids if job_id in self.jobs}
+
+    def _apply_saved(self, saved: Dict[str, Dict[str, Any]]) -> None:
+        for job_id, d in saved.items():
+            job = self.jobs.get(job_id)
+            if job_id in self._tasks:
+                if d.get("status") == "cancelled" and job.status == "running":
+                    job.status = "cancelled"
+                    job.finished = d.get("finished") or now_ts()
+            elif job is None:
+                self.jobs[job_id] = BroadcastJob.from_dict(d, [])
+            elif job_id not in self._changed:
+                for f in BroadcastJob.FIELDS:
+                    if f in d:
+                        setattr(job, f, d[f])
+
+    async def save(self) -> None:
+        """Merge with BROADCAST_FILE (in a thread: it waits on the file lock and fsyncs)."""
+        self._last_save = time.monotonic()
+        async with self._save_lock:
+            self._apply_saved(await asyncio.to_thread(self._merge_file, self._local_changes()))
+
+    async def _maybe_save(self) -> None:
+        if time.monotonic() - self._last_save >= 1.0:
+            await self.save()
+
+    def load(self) -> None:
+        self._apply_saved(self._merge_file({}))
+        for job in self.jobs.values():
+            if job.status == "running" and not job.targets:
+                job.targets = load_store(self._targets_path(job.id)).get("targets", [])
+
+    async def resume(self) -> None:
+        # with several workers sharing BROADCAST_FILE only one of them may resume jobs
+        if fcntl is not None:
+            self._leader_fh = open(self.path + ".lock", "a+")
+            try:
+                fcntl.flock(self._leader_fh.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                log.info("another worker owns broadcast resume")
+                return
+        await asyncio.to_thread(self.load)
+        for job in self.jobs.values():
+            if job.status == "running":
+                log.info("resuming broadcast %s at %s/%s", job.id, job.done_upto, job.total)
+                self._spawn(job)
+
+    # ---- jobs ----
+    async def start(self, admin_id: int, text: str, targets: Optional[List[int]] = None,
+                    active_days: Optional[int] = None) -> BroadcastJob:
+        if targets is None:
+            since = now_ts() - active_days * 86400 if active_days else None
+            targets = await store_io(lambda: list(STORE.iter_seen_chats(since)))
+        job = BroadcastJob(secrets.token_hex(4), admin_id, text, targets)
+        job.active_days = active_days
+        self.jobs[job.id] = job
+        await asyncio.to_thread(save_store, {"targets": targets}, self._targets_path(job.id))
+        self._spawn(job)
+        await self.save()
+        return job
+
+    async def cancel(self, job_id: str) -> Optional[BroadcastJob]:
+        """Cancel a job, whichever worker runs it."""
+        await self.save()
+        job = self.jobs.get(job_id)
+        if job and job.status == "running":
+            job.status = "cancelled"
+            job.finished = now_ts()
+            self._changed.add(job_id)
+            await self.save()
+        return job
+
+    def _spawn(self, job: BroadcastJob) -> None:
+        self._tasks[job.id] = asyncio.get_running_loop().create_task(self._run(job))
+
+    async def _run(self, job: BroadcastJob) -> None:
+        next_idx = job.done_upto
+        # results past the low-water mark; counters only include the contiguous prefix so
+        # the saved counts always match done_upto
+        finished: Dict[int, str] = {}
+
+        async def worker() -> None:
+            nonlocal next_idx
+            while job.status == "running" and next_idx < job.total:
+                idx = next_idx
+                next_idx += 1
+                finished[idx] = await self._deliver(job.targets[idx], job.text)
+                STATS.record_delivery(finished[idx])
+                while job.done_upto in finished:
+                    result = finished.pop(job.done_upto)
+                    if result == "sent":
+                        job.sent += 1
+                    else:
+                        job.failed += 1
+                        job.pruned += result == "pruned"
+                    job.done_upto += 1
+                await self._maybe_save()
+
+        priority = API_PRIORITY.set(PRIORITY_BULK)
+        try:
+            await asyncio.gather(*(worker() for _ in range(self.workers)))
+            if job.status == "running":
+                job.status = "done"
+                job.finished = now_ts()
+        except Exception as exc:
+            log.exception("broadcast %s crashed: %r", job.id, exc)
+        finally:
+            API_PRIORITY.reset(priority)
+            self._changed.add(job.id)
+            self._tasks.pop(job.id, None)
+            await self.save()
+        if job.status != "running":
+            try:
+                os.remove(self._targets_path(job.id))
+            except OSError:
+                pass
+            await send_message_async(job.admin_id, job.describe())
+
+    async def _deliver(self, chat_id: int, text: str) -> str:
+        """"sent", "failed" or "pruned" (failed, and the chat is now blocked)."""
+        try:
+            res = await send_message_async(chat_id, text)
+        except Exception as exc:
+            res = {"ok": False, "error": str(exc)}
+        if res.get("ok"):
+            await store_io(STORE.record_delivery, chat_id, True)
+            return "sent"
+        # only client errors say something about the chat; 429s, 5xx and network errors don't
+        code = res.get("code") or 0
+        if 400 <= code < 500 and code != 429:
+            if await store_io(STORE.record_delivery, chat_id, False, permanent=is_dead_chat(res)):
+                return "pruned"
+        return "failed"
+
+    def close(self) -> None:
+        if self._changed or self._tasks:
+            self._merge_file(self._local_changes())
+
+
+BROADCASTS = BroadcastManager(BROADCAST_FILE, workers=BROADCAST_WORKERS)
+
+# -------------------- Admin commands / helpers --------------------
+async def cmd_reply(admin_id: int, args: str) -> Dict[str, Any]:
+    if not is_admin(admin_id):
+        return {"ok": False, "error": "not admin"}
+    if not args:
+        return {"ok": False, "error": "usage: /reply <chat_id> <message>"}
+    parts = args.strip().split(None, 1)
+    if len(parts) < 2:
+        return {"ok": False, "error": "usage: /reply <chat_id> <message>"}
+    try:
+        target = int(parts[0])
+    except Exception:
+        return {"ok": False, "error": "invalid chat_id"}
+    message = parts[1].strip()
+    if not message:
+        return {"ok": False, "error": "empty message"}
+    res = await send_message_async(target, message)
+    if res.get("ok"):
+        return {"ok": True, "sent_to": target}
+    return {"ok": False, "error": res.get("description")}
+
+async def cmd_send_media(admin_id: int, msg: Dict[str, Any], args_text: str) -> Dict[str, Any]:
+    """
+    Supports:
+      - Admin replies to a media/sticker message with `/send_media <chat_id> [caption]`
+      - Admin sends a media with caption starting `/send_media <chat_id> [caption]`
+    """
+    if not is_admin(admin_id):
+        return {"ok": False, "error": "not admin"}
+    args = (args_text or "").strip()
+    if not args:
+        return {"ok": False, "error": "usage: /send_media <chat_id> <optional caption>"}
+    parts = args.split(None, 1)
+    try:
+        target = int(parts[0])
+    except Exception:
+        return {"ok": False, "error": "invalid chat_id"}
+    caption = parts[1].strip() if len(parts) > 1 else None
+
+    # the replied-to message's media if any, else this message's own; either is copied
+    # with the caption replaced ("" drops the old one: it may be our notification or the command)
+    source = msg.get("reply_to_message") or msg
+    kind = message_kind(source)
+    if not kind:
+        if source is msg:
+            return {"ok": False, "error": "no media/sticker found"}
+        return {"ok": False, "error": "replied message has no media/sticker"}
+    if kind in CAPTION_KINDS:
+        return await relay_message_async(target, source, caption=caption or "")
+    return await relay_message_async(target, source)
+
+async def cmd_sendtoalluser(admin_id: int, text: str) -> Dict[str, Any]:
+    """Start a background broadcast job; progress is reported with /broadcast_status."""
+    if not is_admin(admin_id):
+        return {"ok": False, "error": "not admin"}
+    if not text or not text.strip():
+        return {"ok": False, "error": "no message"}
+    job = await BROADCASTS.start(admin_id, text)
+    return {"ok": True, "job_id": job.id, "total": job.total}
+
+# -------------------- Command registry --------------------
+# Commands are looked up by exact name (the first token of the message, without any
+# @botname suffix), callback buttons by the part of callback_data before the first ':'.
+AdminHandler = Callable[[Dict[str, Any], int, str], Awaitable[None]]
+CallbackHandler = Callable[[str, int, str], Awaitable[None]]
+
+ADMIN_COMMANDS: Dict[str, AdminHandler] = {}
+EARLY_ADMIN_COMMANDS: Dict[str, AdminHandler] = {}   # checked before reply-forwarding
+USER_COMMANDS: Dict[str, AdminHandler] = {}
+CALLBACK_ACTIONS: Dict[str, CallbackHandler] = {}
+
+def admin_command(name: str, early: bool = False) -> Callable[[AdminHandler], AdminHandler]:
+    def register(fn: AdminHandler) -> AdminHandler:
+        (EARLY_ADMIN_COMMANDS if early else ADMIN_COMMANDS)[name] = fn
+        return fn
+    return register
+
+def user_command(name: str) -> Callable[[AdminHandler], AdminHandler]:
+    def register(fn: AdminHandler) -> AdminHandler:
+        USER_COMMANDS[name] = fn
+        return fn
+    return register
+
+def callback_action(prefix: str) -> Callable[[CallbackHandler], CallbackHandler]:
+    def register(fn: CallbackHandler) -> CallbackHandler:
+        CALLBACK_ACTIONS[prefix] = fn
+        return fn
+    return register
+
+def parse_command(text: str) -> Tuple[Optional[str], str]:
+    """Split '/cmd@bot args' into ('/cmd', 'args'); (None, text) if it's not a command."""
+    text = text.strip()
+    if not text.startswith("/"):
+        return None, text
+    parts = text.split(None, 1)
+    name = parts[0].split("@", 1)[0].lower()
+    return name, (parts[1].strip() if len(parts) > 1 else "")
+
+async def run_timed(name: str, coro: Awaitable[Any]) -> Any:
+    """Await a command/callback handler and record its latency under `name`."""
+    t0 = time.perf_counter()
+    try:
+        with log_context(command=name):
+            return await coro
+    finally:
+        COMMAND_LATENCY.observe(time.perf_counter() - t0, command=name)
+
+# -------------------- Callback actions --------------------
+@callback_action("copyuid")
+async def cb_copyuid(cq_id: str, admin_id: int, value: str) -> None:
+    await answer_callback_async(cq_id, text="User ID sent to your chat.")
+    try:
+        await send_message_async(admin_id, value)
+    except Exception:
+        await send_message_async(admin_id, "Failed to send user id.")
+
+@callback_action("prep_reply")
+async def cb_prep_reply(cq_id: str, admin_id: int, value: str) -> None:
+    await answer_callback_async(cq_id, text="Prepared reply command.")
+    try:
+        await send_message_async(admin_id, f"/reply {value} ")
+    except Exception:
+        await send_message_async(admin_id, "Failed to prepare reply.")
+
+@callback_action("prep_send_media")
+async def cb_prep_send_media(cq_id: str, admin_id: int, value: str) -> None:
+    await answer_callback_async(cq_id, text="Prepared send_media command.")
+    try:
+        await send_message_async(admin_id, f"/send_media {value} ")
+    except Exception:
+        await send_message_async(admin_id, "Failed to prepare send_media.")
+
+# -------------------- Admin command handlers --------------------
+@admin_command("/send_sticker", early=True)
+async def on_send_sticker(msg: Dict[str, Any], user_id: int, args: str) -> None:
+    if not args:
+        await send_message_async(user_id, "Usage: /send_sticker <chat_id>")
+        return
+    try:
+        target = int(args)
+        await set_pending_sticker(user_id, target)
+        await send_message_async(
+            user_id,
+            f"OK — now send the sticker to forward to {target}. Use /cancel_sticker to cancel.",
+        )
+    except Exception:
+        await send_message_async(user_id, "Invalid chat_id. Usage: /send_sticker <chat_id>")
+
+@admin_command("/cancel_sticker", early=True)
+async def on_cancel_sticker(msg: Dict[str, Any], user_id: int, args: str) -> None:
+    prev = await pop_pending_sticker(user_id)
+    if prev:
+        await send_message_async(user_id, f"Pending sticker to {prev} cancelled.")
+    else:
+        await send_message_async(user_id, "No pending sticker request.")
+
+@admin_command("/send_media")
+async def on_send_media(msg: Dict[str, Any], user_id: int, args: str) -> None:
+    res = await cmd_send_media(user_id, msg, args)
+    if res.get("ok"):
+        await send_message_async(user_id, "Media/sticker sent to target.")
+    else:
+        await send_message_async(user_id, "Send media failed: " + (res.get("error") or "unknown"))
+
+@admin_command("/sendtoalluser")
+async def on_sendtoalluser(msg: Dict[str, Any], user_id: int, args: str) -> None:
+    res = await cmd_sendtoalluser(user_id, args)
+    if res.get("ok"):
+        await send_message_async(
+            user_id,
+            f"Broadcast {res.get('job_id')} started for {res.get('total')} users. "
+            f"Check with /broadcast_status {res.get('job_id')}",
+        )
+    else:
+        await send_message_async(user_id, "sendtoalluser failed: " + (res.get("error") or "unknown"))
+
+@admin_command("/reply")
+async def on_reply(msg: Dict[str, Any], user_id: int, args: str) -> None:
+    res = await cmd_reply(user_id, args)
+    if res.get("ok"):
+        await send_message_async(user_id, f"Message sent to {res.get('sent_to')}.")
+    else:
+        await send_message_async(user_id, "Reply failed: " + (res.get("error") or "unknown"))
+
+INBOX_PAGE_SIZE = 20
+INBOX_MAX_PAGE_SIZE = 200
+
+def parse_inbox_args(args: str) -> Dict[str, Any]:
+    """
+    `/inbox [page] [user:<id>] [chat:<id>] [n:<page size>] [words to search for]`
+    -> query_inbox filters plus "page" and "limit". Raises ValueError on bad numbers.
+    """
+    opts: Dict[str, Any] = {"page": 1, "limit": INBOX_PAGE_SIZE}
+    words: List[str] = []
+    for token in args.split():
+        key, sep, value = token.partition(":")
+        if sep and key in ("user", "chat", "n", "page"):
+            opts[{"user": "user_id", "chat": "chat_id", "n": "limit"}.get(key, key)] = int(value)
+        elif token.isdigit() and not words and opts["page"] == 1:
+            opts["page"] = int(token)
+        else:
+            words.append(token)
+    if words:
+        opts["text"] = " ".join(words)
+    opts["page"] = max(1, opts["page"])
+    opts["limit"] = min(max(1, opts["limit"]), INBOX_MAX_PAGE_SIZE)
+    return opts
+
+@admin_command("/inbox")
+async def on_inbox(msg: Dict[str, Any], user_id: int, args: str) -> None:
+    try:
+        opts = parse_inbox_args(args)
+    except ValueError:
+        await send_message_async(user_id, "Usage: /inbox [page] [user:<id>] [chat:<id>] [n:<count>] [search text]")
+        return
+    page, limit = opts.pop("page"), opts.pop("limit")
+    # one extra row tells whether there is a next page
+    inbox = await store_io(STORE.query_inbox, limit=limit + 1, offset=(page - 1) * limit, **opts)
+    more = len(inbox) > limit
+    inbox = inbox[:limit][::-1]
+    if not inbox:
+        await send_message_async(user_id, "Inbox is empty." if page == 1 and not opts else "No matching messages.")
+        return
+    lines = [
+        f"{fmt_time(e['ts'])} | user_id:{e['user_id']} | chat:{e['chat_id']} | {(e.get('text') or '')[:60]}"
+        for e in inbox
+    ]
+    header = "Last messages" if page == 1 else f"Messages, page {page}"
+    footer = ""
+    if more:
+        next_args = [str(page + 1)]
+        if "user_id" in opts:
+            next_args.append(f"user:{opts['user_id']}")
+        if "chat_id" in opts:
+            next_args.append(f"chat:{opts['chat_id']}")
+        if limit != INBOX_PAGE_SIZE:
+            next_args.append(f"n:{limit}")
+        if "text" in opts:
+            next_args.append(opts["text"])
+        footer = "\nMore: /inbox " + " ".join(next_args)
+    await send_long_message_async(user_id, f"{header}:\n" + "\n".join(lines) + footer)
+
+SEGMENT_RE = re.compile(r"days:(\d+)\s+")
+
+@admin_command("/broadcast")
+async def on_broadcast(msg: Dict[str, Any], user_id: int, args: str) -> None:
+    # optional segment first: `/broadcast days:7 <message>` -> chats active in the last 7 days
+    m = SEGMENT_RE.match(args)
+    days = int(m.group(1)) if m else None
+    text = args[m.end():] if m else args
+    if text.strip():
+        job = await BROADCASTS.start(user_id, text, active_days=days)
+        segment = f" active in the last {days} days" if days else ""
+        await send_message_async(
+            user_id, f"Broadcast {job.id} started for {job.total} chats{segment}. "
+                     f"Check with /broadcast_status {job.id}"
+        )
+    else:
+        await send_message_async(user_id, "Usage: /broadcast [days:N] <message>")
+
+@admin_command("/chats")
+async def on_chats(msg: Dict[str, Any], user_id: int, args: str) -> None:
+    now = now_ts()
+    reachable = await store_io(STORE.count_seen_chats)
+    blocked = await store_io(STORE.count_blocked_chats)
+    lines = [f"Chats: {reachable} reachable, {blocked} blocked"]
+    for days in (1, 7, 30):
+        active = await store_io(STORE.count_seen_chats, now - days * 86400)
+        lines.append(f"Active in the last {days} days: {active}")
+    await send_message_async(user_id, "\n".join(lines))
+
+def fmt_duration(seconds: float) -> str:
+    if seconds < 90:
+        return f"{seconds:.0f}s"
+    if seconds < 90 * 60:
+        return f"{seconds / 60:.0f}m"
+    return f"{seconds / 3600:.1f}h"
+
+@admin_command("/stats")
+async def on_stats(msg: Dict[str, Any], user_id: int, args: str) -> None:
+    try:
+        days = min(max(1, int(args or 7)), STATS_DAYS)
+    except ValueError:
+        await send_message_async(user_id, f"Usage: /stats [days, up to {STATS_DAYS}]")
+        return
+    await STATS.save()   # take in the other workers' counts
+    now = time.time()
+    per_day = STATS.series("messages", days)
+    totals = STATS.totals(per_day[0][0])
+    last_24h = STATS.totals(now - 24 * 3600, hourly=True)
+    messages = int(totals.get("messages", 0))
+    lines = [
+        f"📊 Stats, last {days} days (UTC)",
+        f"Messages: {messages} from {STATS.unique_users(per_day[0][0])} users "
+        f"(last 24h: {int(last_24h.get('messages', 0))})",
+        "Per hour (last 12h): " + ", ".join(
+            f"{time.strftime('%H', time.gmtime(hour))}h {int(n)}" for hour, n in STATS.series("messages", 12, hourly=True)
+        ),
+        "Per day:",
+    ]
+    lines += [
+        f"  {time.strftime('%m-%d', time.gmtime(day))}: {int(n)} messages, {STATS.daily_users(day)} users"
+        for day, n in reversed(per_day)
+    ]
+    kinds = sorted(((k[5:], v) for k, v in totals.items() if k.startswith("kind:")), key=lambda kv: -kv[1])
+    if kinds:
+        lines.append("Media mix: " + ", ".join(f"{k} {v * 100 / messages:.0f}%" for k, v in kinds))
+    for aid in ADMIN_IDS:
+        replies = int(totals.get(f"replies:{aid}", 0))
+        timed = totals.get(f"timed:{aid}", 0)
+        avg = f", avg response {fmt_duration(totals[f'reply_secs:{aid}'] / timed)}" if timed else ""
+        lines.append(f"Admin {aid}: {replies} replies{avg}")
+    sent = int(totals.get("broadcast:sent", 0))
+    failed = int(totals.get("broadcast:failed", 0))
+    pruned = int(totals.get("broadcast:pruned", 0))
+    if sent + failed + pruned:
+        lines.append(f"Broadcast deliveries: {sent} sent, {failed + pruned} failed ({pruned} pruned), "
+                     f"{sent * 100 / (sent + failed + pruned):.1f}% delivered")
+    await send_long_message_async(user_id, "\n".join(lines))
+
+@admin_command("/broadcast_status")
+async def on_broadcast_status(msg: Dict[str, Any], user_id: int, args: str) -> None:
+    await BROADCASTS.save()   # picks up jobs run by other workers
+    if args:
+        job = BROADCASTS.jobs.get(args)
+        await send_message_async(user_id, job.describe() if job else f"No broadcast {args}.")
+    else:
+        jobs = sorted(BROADCASTS.jobs.values(), key=lambda j: j.created)[-5:]
+        await send_message_async(user_id, "\n".join(j.describe() for j in jobs) if jobs else "No broadcasts yet.")
+
+@admin_command("/broadcast_cancel")
+async def on_broadcast_cancel(msg: Dict[str, Any], user_id: int, args: str) -> None:
+    job = await BROADCASTS.cancel(args)
+    await send_message_async(user_id, job.describe() if job else "Usage: /broadcast_cancel <job_id>")
+
+@admin_command("/help")
+async def on_admin_help(msg: Dict[str, Any], user_id: int, args: str) -> None:
+    await send_message_async(
+        user_id,
+        "Admin commands:\n"
+        "/reply <chat_id> <message>\n"
+        "/send_media <chat_id> (reply to media or send media with caption)\n"
+        "/send_sticker <chat_id>  -> then send the sticker\n"
+        "/cancel_sticker\n"
+        "/sendtoalluser <message>\n"
+        "/inbox [page] [user:<id>] [chat:<id>] [n:<count>] [search text]\n"
+        "/broadcast [days:N] <message>\n"
+        "/broadcast_status [job_id]\n"
+        "/broadcast_cancel <job_id>\n"
+        "/chats\n"
+        "/stats [days]\n"
+        "You can also reply to a forwarded message to send to the original user.\n"
+        "In a digest, start the reply with #N to answer user N."
+    )
+
+@user_command("/help")
+async def on_user_help(msg: Dict[str, Any], user_id: int, args: str) -> None:
+    await send_message_async(msg["chat"]["id"], "Commands:\n/start\n/help\n(You can message admin via this bot.)")
+
+# -------------------- Core update processing --------------------
+async def handle_callback(cq: Dict[str, Any]) -> None:
+    """Inline button presses: dispatch on the callback_data prefix."""
+    cq_id = cq.get("id")
+    cq_from = cq.get("from", {}) or {}
+    action, _, value = (cq.get("data", "") or "").partition(":")
+    handler = CALLBACK_ACTIONS.get(action)
+    if handler is None:
+        await answer_callback_async(cq_id, text="Unknown action")
+        return
+    await run_timed(f"cb:{action}", handler(cq_id, cq_from.get("id"), value))
+
+async def handle_admin_message(msg: Dict[str, Any], user_id: int) -> None:
+    text = msg.get("text", "") or ""
+    sticker = msg.get("sticker")
+    caption = msg.get("caption", "") or ""
+    cmd, args = parse_command(text)
+
+    # /send_sticker and /cancel_sticker win over everything else
+    handler = EARLY_ADMIN_COMMANDS.get(cmd)
+    if handler:
+        await run_timed(cmd, handler(msg, user_id, args))
+        return
+
+    # parts of an album are collected and forwarded together (handle_admin_album)
+    if msg.get("media_group_id"):
+        ALBUMS.add(msg)
+        return
+
+    # if admin sends a sticker and has a pending target -> forward and clear pending
+    if sticker:
+        pending = await get_pending_sticker(user_id)
+        if pending:
+            fid = sticker.get("file_id")
+            res = await send_sticker_async(pending, fid)
+            if res.get("ok"):
+                await send_message_async(user_id, f"Sticker forwarded to {pending}.")
+                await pop_pending_sticker(user_id)
+            else:
+                await send_message_async(user_id, f"Failed to forward sticker: {res}")
+            return
+        # else sticker may be reply-forward; handled below
+
+    # reply-to-admin-message mapping -> forward to user
+    if msg.get("reply_to_message"):
+        replied = msg["reply_to_message"]
+        if is_digest(replied):
+            await reply_to_digest(msg, user_id, replied)
+            return
+        target_chat = await resolve_reply_target(user_id, replied)
+        if target_chat:
+            # any content type, caption included, in one copyMessage call
+            res = await relay_message_async(target_chat, msg)
+            if res.get("ok"):
+                STATS.record_reply(user_id, msg, replied)
+                await send_message_async(user_id, f"Forwarded to user {target_chat}.")
+            else:
+                await send_message_async(user_id, f"Failed to forward: {res.get('description') or res}")
+            return
+
+    # media sent with a `/send_media <chat_id> [caption]` caption
+    if message_kind(msg):
+        cap_cmd, cap_args = parse_command(caption)
+        if cap_cmd == "/send_media":
+            await run_timed(cap_cmd, on_send_media(msg, user_id, cap_args))
+            return
+
+    handler = ADMIN_COMMANDS.get(cmd)
+    if handler:
+        await run_timed(cmd, handler(msg, user_id, args))
+    # if none matched, ignore
+
+async def reply_to_digest(msg: Dict[str, Any], user_id: int, replied: Dict[str, Any]) -> None:
+    """Admin reply to a digest: relayed to user #N without the `#N` prefix."""
+    text = msg.get("text")
+    caption = msg.get("caption")
+    target_chat, body = parse_digest_reply(replied, text or caption or "")
+    if not target_chat:
+        await send_message_async(user_id, "This digest lists several users; start your reply with #N.")
+        return
+    if text is not None:
+        res = await send_message_async(target_chat, body)
+    else:
+        res = await relay_message_async(target_chat, msg, caption=body if caption else None)
+    if res.get("ok"):
+        STATS.record_reply(user_id, msg, replied)
+        await send_message_async(user_id, f"Forwarded to user {target_chat}.")
+    else:
+        await send_message_async(user_id, f"Failed to forward: {res.get('description') or res}")
+
+async def handle_admin_album(msgs: List[Dict[str, Any]], user_id: int) -> None:
+    """
+    Album from an admin: sent to the user as one media group when any part replies to a
+    mapped message, or when a part's caption is `/send_media <chat_id> [caption]`.
+    """
+    captions: List[Optional[str]] = [m.get("caption") for m in msgs]
+    target_chat = None
+    answered: Optional[Dict[str, Any]] = None   # the notification replied to, for STATS
+    for i, m in enumerate(msgs):
+        replied = m.get("reply_to_message")
+        if replied:
+            target_chat = await resolve_reply_target(user_id, replied, captions[i] or "")
+            if target_chat:
+                answered = replied
+                if is_digest(replied) and captions[i]:
+                    captions[i] = parse_digest_reply(replied, captions[i])[1] or None
+                break
+    if not target_chat:
+        for i, m in enumerate(msgs):
+            cap_cmd, cap_args = parse_command(m.get("caption", "") or "")
+            if cap_cmd != "/send_media":
+                continue
+            parts = cap_args.split(None, 1)
+            try:
+                target_chat = int(parts[0])
+            except (IndexError, ValueError):
+                await send_message_async(user_id, "usage: /send_media <chat_id> <optional caption>")
+                return
+            captions[i] = parts[1].strip() if len(parts) > 1 else None
+            break
+    if not target_chat:
+        return
+    res = await send_media_group_async(target_chat, album_media(msgs, captions))
+    if res.get("ok"):
+        if answered:
+            STATS.record_reply(user_id, msgs[0], answered)
+        await send_message_async(user_id, f"Album ({len(msgs)} items) forwarded to user {target_chat}.")
+    else:
+        await send_message_async(user_id, f"Failed to forward album: {res}")
+
+async def handle_user_album(msgs: List[Dict[str, Any]]) -> None:
+    """Album from a user: one inbox entry, one media group + notification per admin, one ack."""
+    first = msgs[0]
+    chat_id = (first.get("chat") or {}).get("id")
+    from_user = first.get("from", {}) or {}
+    text = "\n".join(m["caption"] for m in msgs if m.get("caption"))
+    try:
+        await store_io(STORE.append_inbox, {
+            "ts": now_ts(),
+            "chat_id": chat_id,
+            "user_id": from_user.get("id"),
+            "text": text,
+            "username": from_user.get("username"),
+            "first_name": from_user.get("first_name"),
+            "last_name": from_user.get("last_name")
+        })
+        if chat_id:
+            await store_io(STORE.add_seen_chat, chat_id)
+    except Exception as exc:
+        log.error("storing album inbox entry failed: %s", exc)
+
+    flood_key = from_user.get("id") or chat_id
+    if FLOOD.should_ack(flood_key):
+        await send_message_async(chat_id, "धन्यवाद — आपका संदेश पहुँच गया। Admin जल्द reply कर देगा।")
+    if FLOOD.allow(flood_key):
+        await NOTIFIER.put(chat_id, from_user, text, album=msgs)
+    else:
+        for m in msgs:
+            FLOOD.hold(flood_key, m)
+
+async def send_flood_digest(msgs: List[Dict[str, Any]], skipped: int) -> None:
+    """One admin notification for the messages FLOOD held back from one user."""
+    first = msgs[0]
+    chat_id = (first.get("chat") or {}).get("id")
+    lines = []
+    for m in msgs[:FLOOD_DIGEST_LINES]:
+        content = (m.get("text") or m.get("caption") or "")[:150]
+        kind = message_kind(m)
+        if kind:
+            content = f"[{kind}] {content}".rstrip()
+        lines.append(f"{datetime.fromtimestamp(m.get('date') or now_ts()):%H:%M:%S} {content}")
+    more = len(msgs) - len(lines) + skipped
+    if more > 0:
+        lines.append(f"... and {more} more")
+    await notify_admins(chat_id, first.get("from", {}) or {}, "\n".join(lines),
+                        title=f"🚨 {len(msgs) + skipped} more messages (flood digest)")
+
+async def process_album(msgs: List[Dict[str, Any]]) -> None:
+    """Handle the collected parts of one album (called by ALBUMS)."""
+    if len(msgs) == 1:
+        # the rest of the album never arrived: handle it as a plain message
+        msg = dict(msgs[0])
+        msg.pop("media_group_id", None)
+        await process_update({"message": msg})
+        return
+    user_id = (msgs[0].get("from") or {}).get("id")
+    if is_admin(user_id):
+        await handle_admin_album(msgs, user_id)
+    else:
+        for msg in msgs:
+            STATS.record_message(msg)
+        await handle_user_album(msgs)
+
+async def process_update(upd: Dict[str, Any]) -> None:
+    """
+    Process a single Telegram update (called from the update queue workers, which
+    are fed by the webhook or by UpdatePoller).
+    """
+
+    # callback queries (inline button presses)
+    if "callback_query" in upd:
+        await handle_callback(upd["callback_query"])
+        return
+
+    # normal message or edited_message
+    msg = upd.get("message") or upd.get("edited_message")
+    if not msg:
+        return
+
+    chat = msg.get("chat", {}) or {}
+    chat_id = chat.get("id")
+    from_user = msg.get("from", {}) or {}
+    user_id = from_user.get("id")
+    text = msg.get("text", "") or ""
+
+    # -------------------- ADMIN flows --------------------
+    if is_admin(user_id):
+        await handle_admin_message(msg, user_id)
+        return
+
+    # -------------------- NON-ADMIN (user) --------------------
+    cmd, args = parse_command(text)
+    handler = USER_COMMANDS.get(cmd)
+    if handler:
+        await run_timed(cmd, handler(msg, user_id, args))
+        return
+
+    # albums arrive as one update per item; handle_user_album sees them all at once
+    # (process_album counts them, or hands a lone part back here)
+    if msg.get("media_group_id"):
+        ALBUMS.add(msg)
+        return
+
+    STATS.record_message(msg)
+
+    # store inbox entry (with small info) + track seen_chats here
+    text = text or msg.get("caption", "") or ""
+    ts = now_ts()
+    try:
+        await store_io(STORE.append_inbox, {
+            "ts": ts,
+            "chat_id": chat_id,
+            "user_id": user_id,
+            "text": text,
+            "username": from_user.get("username"),
+            "first_name": from_user.get("first_name"),
+            "last_name": from_user.get("last_name")
+        })
+        if chat_id:
+            await store_io(STORE.add_seen_chat, chat_id)
+    except Exception as exc:
+        log.error("storing inbox entry failed: %s", exc)
+
+    # ack first (once per FLOOD_WINDOW), then notify admins and forward any media/sticker
+    # in the background (NOTIFIER); a flooding user's extra messages are held and reach
+    # the admins as one digest; in digest mode text messages are batched across users
+    flood_key = user_id or chat_id
+    if FLOOD.should_ack(flood_key):
+        await send_message_async(chat_id, "धन्यवाद — आपका संदेश पहुँच गया। Admin जल्द reply कर देगा।")
+    if not FLOOD.allow(flood_key):
+        FLOOD.hold(flood_key, msg)
+    elif DIGEST.wants(msg):
+        DIGEST.add(chat_id, from_user, text)
+    else:
+        await NOTIFIER.put(chat_id, from_user, text, message=msg)
+    return
+
+# -------------------- Update queue --------------------
+def update_chat_key(upd: Dict[str, Any]) -> Optional[int]:
+    """Chat an update belongs to (for per-chat ordering); None if it has none."""
+    msg = upd.get("message") or upd.get("edited_message")
+    if msg:
+        return (msg.get("chat") or {}).get("id")
+    cq = upd.get("callback_query")
+    if cq:
+        return ((cq.get("message") or {}).get("chat") or {}).get("id") or (cq.get("from") or {}).get("id")
+    return None
 
-# -------------------- CONFIG --------------------
-BOT_TOKEN = os.getenv("BOT_TOKEN")
-if not BOT_TOKEN:
-    raise RuntimeError("BOT_TOKEN environment variable not set!")
+def update_log_fields(upd: Dict[str, Any]) -> Dict[str, Any]:
+    """Log context for one update: update_id, chat_id, and admin_id when an admin sent it."""
+    fields: Dict[str, Any] = {"update_id": upd.get("update_id"), "chat_id": update_chat_key(upd)}
+    src = upd.get("message") or upd.get("edited_message") or upd.get("callback_query") or {}
+    sender = (src.get("from") or {}).get("id")
+    if is_admin(sender):
+        fields["admin_id"] = sender
+    return fields
 
-ADMIN_IDS = [7627349162, 5980759440]  # yahan apne admin telegram user IDs
-DATA_FILE = "bot_data.json"
-POLL_INTERVAL = 1.0                # ab use nahi ho raha, but rakha hua hai
-INBOX_LIMIT = 1000
-API_BASE = f"https://api.telegram.org/bot{BOT_TOKEN}/"
 
-BASE_URL = os.getenv("BASE_URL")   # e.g. https://ankit-bot.onrender.com
+class UpdateQueue:
+    """
+    Bounded in-process queue between the webhook and process_update.
 
-# -------------------- HTTP / API --------------------
-def api_request(method: str, params: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
-    """Make a simple application/x-www-form-urlencoded POST to Telegram API"""
-    url = API_BASE + method
-    data = None
-    if params:
-        safe: Dict[str, Any] = {}
-        for k, v in params.items():
-            if isinstance(v, (dict, list)):
-                safe[k] = json.dumps(v, ensure_ascii=False)
-            else:
-                safe[k] = v
-        data = urllib.parse.urlencode(safe).encode()
+    Updates are sharded by chat onto `workers` worker tasks, each with its own bounded
+    asyncio.Queue, so one chat's updates are processed in order while different chats
+    run in parallel. When a shard is full, submit() waits up to `enqueue_timeout`
+    (backpressure on the webhook) and then drops the update and counts it.
+    Workers only take updates while `ready` is set; startup clears it until the state
+    is loaded, so updates that arrive earlier just wait in their shard.
+    """
 
-    try:
-        # Create SSL context that doesn't verify certificates
-        ssl_context = ssl.create_default_context()
-        ssl_context.check_hostname = False
-        ssl_context.verify_mode = ssl.CERT_NONE
-        
-        with urllib.request.urlopen(url, data=data, timeout=30, context=ssl_context) as resp:
-            return json.load(resp)
-    except urllib.error.HTTPError as he:
-        try:
-            body = he.read().decode("utf-8", errors="ignore")
-        except Exception:
-            body = str(he)
-        print(f"[api_request] HTTPError {he.code}: {body}")
-        return {"ok": False, "error": f"HTTPError {he.code}", "code": he.code, "body": body}
-    except Exception as exc:
-        print(f"[api_request] Exception: {exc}")
-        return {"ok": False, "error": str(exc)}
+    def __init__(self, workers: int = 8, maxsize: int = 1000, enqueue_timeout: float = 1.0) -> None:
+        self.workers = workers
+        self.maxsize = maxsize
+        self.enqueue_timeout = enqueue_timeout
+        self.queues: List[asyncio.Queue] = []
+        self.tasks: List[asyncio.Task] = []
+        self.enqueued = 0
+        self.processed = 0
+        self.dropped = 0
+        self.overflows = 0       # submits that found their shard full
+        self.errors = 0
+        self.max_depth = 0
+        self.ready = asyncio.Event()
+        self.ready.set()
 
-# convenience wrappers
-def send_message(chat_id: int, text: str, parse_mode: Optional[str] = None,
-                 reply_to_message_id: Optional[int] = None, reply_markup: Optional[Dict] = None) -> Dict:
-    params = {"chat_id": chat_id, "text": text}
-    if parse_mode:
-        params["parse_mode"] = parse_mode
-    if reply_to_message_id:
-        params["reply_to_message_id"] = reply_to_message_id
-    if reply_markup:
-        params["reply_markup"] = reply_markup
-    return api_request("sendMessage", params)
+    def start(self) -> None:
+        if self.tasks:
+            return
+        loop = asyncio.get_running_loop()
+        per_shard = max(1, self.maxsize // self.workers)
+        self.queues = [asyncio.Queue(maxsize=per_shard) for _ in range(self.workers)]
+        self.tasks = [loop.create_task(self._worker(q)) for q in self.queues]
 
-def send_photo(chat_id: int, file_id: str, caption: Optional[str] = None,
-               reply_to_message_id: Optional[int] = None) -> Dict:
-    params = {"chat_id": chat_id, "photo": file_id}
-    if caption:
-        params["caption"] = caption
-    if reply_to_message_id:
-        params["reply_to_message_id"] = reply_to_message_id
-    return api_request("sendPhoto", params)
+    def depth(self) -> int:
+        return sum(q.qsize() for q in self.queues)
 
-def send_video(chat_id: int, file_id: str, caption: Optional[str] = None,
-               reply_to_message_id: Optional[int] = None) -> Dict:
-    params = {"chat_id": chat_id, "video": file_id}
-    if caption:
-        params["caption"] = caption
-    if reply_to_message_id:
-        params["reply_to_message_id"] = reply_to_message_id
-    return api_request("sendVideo", params)
+    def _shard(self, upd: Dict[str, Any]) -> asyncio.Queue:
+        key = update_chat_key(upd)
+        return self.queues[hash(key if key is not None else upd.get("update_id")) % self.workers]
 
-def send_sticker(chat_id: int, sticker_file_id: str, reply_to_message_id: Optional[int] = None) -> Dict:
-    params = {"chat_id": chat_id, "sticker": sticker_file_id}
-    if reply_to_message_id:
-        params["reply_to_message_id"] = reply_to_message_id
-    return api_request("sendSticker", params)
+    async def put(self, upd: Dict[str, Any]) -> None:
+        """Enqueue, waiting as long as it takes (polling: backpressure on getUpdates, no drops)."""
+        self.start()
+        await self._shard(upd).put(upd)
+        self.enqueued += 1
+        self.max_depth = max(self.max_depth, self.depth())
 
-def forward_message(chat_id: int, from_chat_id: int, message_id: int) -> Dict:
-    params = {"chat_id": chat_id, "from_chat_id": from_chat_id, "message_id": message_id}
-    return api_request("forwardMessage", params)
+    async def join(self) -> None:
+        """Wait until every update enqueued so far has been processed."""
+        await asyncio.gather(*(q.join() for q in self.queues))
 
-def answer_callback(callback_id: str, text: Optional[str] = None) -> Dict:
-    params = {"callback_query_id": callback_id}
-    if text:
-        params["text"] = text
-    return api_request("answerCallbackQuery", params)
+    async def submit(self, upd: Dict[str, Any]) -> bool:
+        self.start()
+        q = self._shard(upd)
+        try:
+            q.put_nowait(upd)
+        except asyncio.QueueFull:
+            self.overflows += 1
+            try:
+                await asyncio.wait_for(q.put(upd), self.enqueue_timeout)
+            except asyncio.TimeoutError:
+                self.dropped += 1
+                log.warning("dropped update %s (shard full)", upd.get("update_id"))
+                return False
+        self.enqueued += 1
+        self.max_depth = max(self.max_depth, self.depth())
+        return True
 
-# -------------------- Persistence --------------------
-def load_store() -> Dict[str, Any]:
-    try:
-        with open(DATA_FILE, "r", encoding="utf-8") as fh:
-            return json.load(fh)
-    except FileNotFoundError:
-        return {
-            "seen_chats": [],
-            "inbox": [],
-            "thread_map": {},
-            "pending_sticker": {},
-        }
-    except Exception as exc:
-        print(f"[load_store] error: {exc}")
+    async def _worker(self, q: asyncio.Queue) -> None:
+        while True:
+            upd = await q.get()
+            await self.ready.wait()
+            kind = update_type(upd)
+            t0 = time.perf_counter()
+            token = LOG_CONTEXT.set(update_log_fields(upd))
+            try:
+                # cross-process ordering for shared backends (no-op for single-process ones)
+                async with STORE.chat_lock(update_chat_key(upd)):
+                    await process_update(upd)
+            except Exception as exc:
+                self.errors += 1
+                UPDATE_ERRORS.inc(type=kind)
+                log.exception("process_update failed: %s", exc)
+            else:
+                log_sampled("update processed", type=kind, ms=round((time.perf_counter() - t0) * 1000, 1))
+            finally:
+                LOG_CONTEXT.reset(token)
+                UPDATE_LATENCY.observe(time.perf_counter() - t0, type=kind)
+                self.processed += 1
+                q.task_done()
+
+    async def stop(self, timeout: float = 10.0) -> None:
+        """Let queued updates finish (up to `timeout`), then stop the workers."""
+        if not self.tasks:
+            return
+        try:
+            await asyncio.wait_for(asyncio.gather(*(q.join() for q in self.queues)), timeout)
+        except asyncio.TimeoutError:
+            log.warning("stopping with %s updates still queued", self.depth())
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    def stats(self) -> Dict[str, int]:
         return {
-            "seen_chats": [],
-            "inbox": [],
-            "thread_map": {},
-            "pending_sticker": {},
+            "depth": self.depth(),
+            "max_depth": self.max_depth,
+            "enqueued": self.enqueued,
+            "processed": self.processed,
+            "dropped": self.dropped,
+            "overflows": self.overflows,
+            "errors": self.errors,
         }
 
-def save_store(data: Dict[str, Any]) -> None:
-    try:
-        with open(DATA_FILE, "w", encoding="utf-8") as fh:
-            json.dump(data, fh, ensure_ascii=False, indent=2)
-    except Exception as exc:
-        print(f"[save_store] error: {exc}")
 
-# -------------------- Helpers --------------------
-def is_admin(uid: Optional[int]) -> bool:
-    return uid in ADMIN_IDS
+UPDATES = UpdateQueue(workers=UPDATE_WORKERS, maxsize=UPDATE_QUEUE_SIZE, enqueue_timeout=UPDATE_ENQUEUE_TIMEOUT)
 
-def now_ts() -> int:
-    return int(time.time())
+class BatchBuffer:
+    """
+    Scaffolding shared by AlbumAggregator, FloodGuard and AdminDigest: messages are
+    buffered in `pending` per key, and a timer per key (or an early flush) hands the
+    batch to `handler` in a background task that holds the batch's chat lock.
+    Subclasses fill `pending` and override _take() to pick the chat lock and shape the
+    handler's arguments.
+    """
 
-def fmt_time(ts: int) -> str:
-    return datetime.fromtimestamp(ts).strftime("%Y-%m-%d %H:%M:%S")
+    label = "batch"   # names the batch in error logs
 
-def escape_html(s: str) -> str:
-    return s.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+    def __init__(self, handler: Callable[..., Awaitable[None]]) -> None:
+        self.handler = handler
+        self.pending: Dict[Any, Any] = {}
+        self.timers: Dict[Any, asyncio.TimerHandle] = {}
+        self.tasks: Set[asyncio.Task] = set()
+        self.errors = 0
 
-# thread_map helpers
-def store_thread_map(admin_id: int, admin_msg_id: int, user_chat_id: int) -> None:
-    d = load_store()
-    tm = d.get("thread_map", {})
-    tm[f"{admin_id}:{admin_msg_id}"] = user_chat_id
-    d["thread_map"] = tm
-    save_store(d)
+    def _take(self, key: Any) -> Optional[Tuple[Optional[int], Tuple[Any, ...]]]:
+        """Remove the batch for `key`: (chat id to lock or None, handler args), None if empty."""
+        batch = self.pending.pop(key, None)
+        if not batch:
+            return None
+        return None, (batch,)
 
-def lookup_thread_target(admin_id: int, admin_msg_id: int) -> Optional[int]:
-    d = load_store()
-    return d.get("thread_map", {}).get(f"{admin_id}:{admin_msg_id}")
+    def _keys(self) -> List[Any]:
+        return list(self.pending)
 
-# pending sticker helpers
-def set_pending_sticker(admin_id: int, target_chat: int) -> None:
-    d = load_store()
-    pend = d.get("pending_sticker", {})
-    pend[str(admin_id)] = int(target_chat)
-    d["pending_sticker"] = pend
-    save_store(d)
-
-def get_pending_sticker(admin_id: int) -> Optional[int]:
-    d = load_store()
-    return d.get("pending_sticker", {}).get(str(admin_id))
-
-def pop_pending_sticker(admin_id: int) -> Optional[int]:
-    d = load_store()
-    pend = d.get("pending_sticker", {})
-    key = str(admin_id)
-    if key in pend:
-        val = pend.pop(key)
-        d["pending_sticker"] = pend
-        save_store(d)
-        return val
-    return None
+    def _start_timer(self, key: Any, delay: float) -> None:
+        if key not in self.timers:
+            self.timers[key] = asyncio.get_running_loop().call_later(delay, self._fire, key)
 
-# -------------------- Notifications to admins --------------------
-def notify_admins(user_chat_id: int, user_from: Dict[str, Any], text: str,
-                  photos=None, video=None, sticker=None) -> None:
+    def _cancel_timer(self, key: Any) -> None:
+        timer = self.timers.pop(key, None)
+        if timer:
+            timer.cancel()
+
+    def _fire(self, key: Any) -> None:
+        self._cancel_timer(key)
+        batch = self._take(key)
+        if batch is None:
+            return
+        task = asyncio.get_running_loop().create_task(self._run(*batch))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _run(self, chat_id: Optional[int], args: Tuple[Any, ...]) -> None:
+        try:
+            async with STORE.chat_lock(chat_id):
+                await self.handler(*args)
+        except Exception as exc:
+            self.errors += 1
+            log.exception("%s failed: %s", self.label, exc)
+
+    def busy(self) -> bool:
+        return bool(self.pending or self.tasks)
+
+    async def flush(self) -> None:
+        """Hand over every buffered batch now and wait for the handlers (shutdown)."""
+        for key in self._keys():
+            self._fire(key)
+        if self.tasks:
+            await asyncio.gather(*list(self.tasks), return_exceptions=True)
+
+
+class AlbumAggregator(BatchBuffer):
     """
-    Forward any media to admins (so admins can reply directly to forwarded media),
-    then send a quoted notification with 3 inline buttons:
-      - Copy user_id
-      - Prepare Reply
-      - Prepare Send Media
-    Each admin message id is mapped back to the user's chat id.
+    Collects messages that share a media_group_id (Telegram sends one update per album
+    item) until no new part has arrived for `wait` seconds or the album is full, then
+    passes the parts, in message order, to `handler` in a background task that holds
+    the chat lock.
     """
-    uid = user_from.get("id")
-    username = user_from.get("username") or ""
-    first = user_from.get("first_name") or ""
-    last = user_from.get("last_name") or ""
-    fullname = (first + " " + last).strip() or "(no name)"
 
-    ts = fmt_time(now_ts())
-    safe_text = escape_html(text or "")
+    label = "album flush"
 
-    # forward media first so admins can reply to it
-    caption = f"{fullname} | @{username if username else 'no-username'}\nuser_id:{uid} | chat_id:{user_chat_id}"
+    def __init__(self, handler: Callable[[List[Dict[str, Any]]], Awaitable[None]], wait: float = 1.0,
+                 max_parts: int = MAX_ALBUM_PARTS) -> None:
+        super().__init__(handler)
+        self.wait = wait
+        self.max_parts = max_parts
+        self.pending: Dict[Tuple[Optional[int], str], List[Dict[str, Any]]] = {}
+        self.albums = 0
+        self.parts = 0
 
-    if photos:
-        file_id = photos[-1].get("file_id")
-        for aid in ADMIN_IDS:
-            res = send_photo(aid, file_id, caption=caption)
-            if res.get("ok") and res.get("result"):
-                try:
-                    store_thread_map(aid, res["result"]["message_id"], user_chat_id)
-                except Exception:
-                    pass
-
-    if video:
-        file_id = video.get("file_id")
-        for aid in ADMIN_IDS:
-            res = send_video(aid, file_id, caption=caption)
-            if res.get("ok") and res.get("result"):
-                try:
-                    store_thread_map(aid, res["result"]["message_id"], user_chat_id)
-                except Exception:
-                    pass
+    def add(self, msg: Dict[str, Any]) -> None:
+        key = ((msg.get("chat") or {}).get("id"), str(msg.get("media_group_id")))
+        parts = self.pending.setdefault(key, [])
+        parts.append(msg)
+        self.parts += 1
+        self._cancel_timer(key)
+        if len(parts) >= self.max_parts:
+            self._fire(key)
+        else:
+            self._start_timer(key, self.wait)
 
-    if sticker:
-        file_id = sticker.get("file_id")
-        for aid in ADMIN_IDS:
-            res = send_sticker(aid, file_id)
-            if res.get("ok") and res.get("result"):
-                try:
-                    store_thread_map(aid, res["result"]["message_id"], user_chat_id)
-                except Exception:
-                    pass
-
-    # prepare notification text
-    header = f"📩 New message to bot\nTime: {ts}\nName: {escape_html(fullname)}\n"
-    if username:
-        header += f"Username: @{escape_html(username)}\n"
-    user_line = f"user_id: {uid} | chat_id: {user_chat_id}"
-    body = f"{header}{user_line}\n\n<pre>\"{safe_text}\"</pre>"
-
-    # inline keyboard
-    kb = [
-        {"text": "Copy user_id", "callback_data": f"copyuid:{uid}"},
-        {"text": "Prepare Reply", "callback_data": f"prep_reply:{user_chat_id}"},
-        {"text": "Prepare Send Media", "callback_data": f"prep_send_media:{user_chat_id}"}
-    ]
-    reply_markup = {"inline_keyboard": [kb]}
+    def _take(self, key: Tuple[Optional[int], str]) -> Optional[Tuple[Optional[int], Tuple[Any, ...]]]:
+        parts = self.pending.pop(key, None)
+        if not parts:
+            return None
+        parts.sort(key=lambda m: m.get("message_id") or 0)
+        self.albums += 1
+        return key[0], (parts,)
 
-    # notify each admin and map notification message -> user chat (for reply-forwarding)
-    for aid in ADMIN_IDS:
-        res = send_message(aid, body, parse_mode="HTML", reply_markup=reply_markup)
-        if res.get("ok") and res.get("result"):
-            try:
-                store_thread_map(aid, res["result"]["message_id"], user_chat_id)
-            except Exception:
-                pass
+    def stats(self) -> Dict[str, int]:
+        return {"pending": len(self.pending), "albums": self.albums, "parts": self.parts, "errors": self.errors}
 
-# -------------------- Admin commands / helpers --------------------
-def cmd_reply(admin_id: int, args: str) -> Dict[str, Any]:
-    if not is_admin(admin_id):
-        return {"ok": False, "error": "not admin"}
-    if not args:
-        return {"ok": False, "error": "usage: /reply <chat_id> <message>"}
-    parts = args.strip().split(None, 1)
-    if len(parts) < 2:
-        return {"ok": False, "error": "usage: /reply <chat_id> <message>"}
-    try:
-        target = int(parts[0])
-    except Exception:
-        return {"ok": False, "error": "invalid chat_id"}
-    message = parts[1].strip()
-    if not message:
-        return {"ok": False, "error": "empty message"}
-    res = send_message(target, message)
-    if res.get("ok"):
-        return {"ok": True, "sent_to": target}
-    return {"ok": False, "error": res.get("description")}
 
-def cmd_send_media(admin_id: int, msg: Dict[str, Any], args_text: str) -> Dict[str, Any]:
+ALBUMS = AlbumAggregator(process_album, wait=ALBUM_WAIT)
+
+class FloodGuard(BatchBuffer):
     """
-    Supports:
-      - Admin replies to a media/sticker message with `/send_media <chat_id> [caption]`
-      - Admin sends a media with caption starting `/send_media <chat_id> [caption]`
+    Per-user sliding-window flood control for the user path.
+
+    Up to `limit` messages per `window` seconds from one user are notified as usual.
+    Further ones are held (at most `max_held`, the rest only counted) and `window`
+    seconds after the first of them are handed to `handler(msgs, skipped)` as one
+    digest, in a background task holding the chat lock. Acks are limited to one per
+    user per window. A limit of 0 turns all of this off.
     """
-    if not is_admin(admin_id):
-        return {"ok": False, "error": "not admin"}
-    args = (args_text or "").strip()
-    if not args:
-        return {"ok": False, "error": "usage: /send_media <chat_id> <optional caption>"}
-    parts = args.split(None, 1)
-    try:
-        target = int(parts[0])
-    except Exception:
-        return {"ok": False, "error": "invalid chat_id"}
-    caption = parts[1].strip() if len(parts) > 1 else None
 
-    # if replied-to message has media/sticker
-    if msg.get("reply_to_message"):
-        replied = msg["reply_to_message"]
-        if replied.get("photo"):
-            fid = replied["photo"][-1].get("file_id")
-            return send_photo(target, fid, caption=caption)
-        if replied.get("video"):
-            fid = replied["video"].get("file_id")
-            return send_video(target, fid, caption=caption)
-        if replied.get("sticker"):
-            fid = replied["sticker"].get("file_id")
-            return send_sticker(target, fid)
-        return {"ok": False, "error": "replied message has no media/sticker"}
+    label = "flood digest"
 
-    # if current message contains media/sticker
-    if msg.get("photo"):
-        fid = msg["photo"][-1].get("file_id")
-        return send_photo(target, fid, caption=caption)
-    if msg.get("video"):
-        fid = msg["video"].get("file_id")
-        return send_video(target, fid, caption=caption)
-    if msg.get("sticker"):
-        fid = msg["sticker"].get("file_id")
-        return send_sticker(target, fid)
-    return {"ok": False, "error": "no media/sticker found"}
-
-def cmd_sendtoalluser(admin_id: int, text: str) -> Dict[str, Any]:
-    if not is_admin(admin_id):
-        return {"ok": False, "error": "not admin"}
-    if not text or not text.strip():
-        return {"ok": False, "error": "no message"}
-    d = load_store()
-    chat_ids = d.get("seen_chats", [])
-    sent = 0
-    failed = 0
-    failures = []
-    for cid in chat_ids:
-        try:
-            r = send_message(cid, text)
-            if r.get("ok"):
-                sent += 1
-            else:
-                failed += 1
-                failures.append({"chat_id": cid, "error": r})
-        except Exception as exc:
-            failed += 1
-            failures.append({"chat_id": cid, "error": str(exc)})
-        time.sleep(0.05)   # gentle pacing
-    return {"ok": True, "sent": sent, "failed": failed, "failures": failures}
+    def __init__(self, handler: Callable[[List[Dict[str, Any]], int], Awaitable[None]], window: float = 60.0,
+                 limit: int = 5, max_held: int = 200) -> None:
+        super().__init__(handler)
+        self.window = window
+        self.limit = limit
+        self.max_held = max_held
+        self.recent: Dict[int, deque] = {}
+        self.pending: Dict[int, List[Dict[str, Any]]] = {}   # held messages per user
+        self.skipped: Dict[int, int] = {}
+        self.last_ack: Dict[int, float] = {}
+        self.allowed = 0
+        self.throttled = 0
+        self.digests = 0
+        self.acks = 0
+        self.acks_skipped = 0
+
+    def allow(self, key: int) -> bool:
+        """True if this message may be notified normally (and count it)."""
+        if self.limit <= 0:
+            return True
+        now = time.monotonic()
+        if len(self.recent) > 10000:
+            self._prune(now)
+        q = self.recent.get(key)
+        if q is None:
+            q = self.recent[key] = deque()
+        while q and now - q[0] >= self.window:
+            q.popleft()
+        if len(q) < self.limit:
+            q.append(now)
+            self.allowed += 1
+            return True
+        self.throttled += 1
+        return False
+
+    def hold(self, key: int, msg: Dict[str, Any]) -> None:
+        held = self.pending.setdefault(key, [])
+        if len(held) < self.max_held:
+            held.append(msg)
+        else:
+            self.skipped[key] = self.skipped.get(key, 0) + 1
+        self._start_timer(key, self.window)
+
+    def should_ack(self, key: int) -> bool:
+        if self.limit <= 0:
+            return True
+        now = time.monotonic()
+        last = self.last_ack.get(key)
+        if last is not None and now - last < self.window:
+            self.acks_skipped += 1
+            return False
+        self.last_ack[key] = now
+        self.acks += 1
+        return True
+
+    def _prune(self, now: float) -> None:
+        for key, q in list(self.recent.items()):
+            if (not q or now - q[-1] >= self.window) and key not in self.pending:
+                del self.recent[key]
+        for key, ts in list(self.last_ack.items()):
+            if now - ts >= self.window:
+                del self.last_ack[key]
+
+    def _take(self, key: int) -> Optional[Tuple[Optional[int], Tuple[Any, ...]]]:
+        msgs = self.pending.pop(key, None)
+        skipped = self.skipped.pop(key, 0)
+        if not msgs:
+            return None
+        self.digests += 1
+        return (msgs[0].get("chat") or {}).get("id"), (msgs, skipped)
+
+    def stats(self) -> Dict[str, int]:
+        return {"users": len(self.recent), "holding": len(self.pending), "allowed": self.allowed,
+                "throttled": self.throttled, "digests": self.digests, "acks": self.acks,
+                "acks_skipped": self.acks_skipped}
 
-# -------------------- Core update processing (no long-poll) --------------------
-def process_update(upd: Dict[str, Any]) -> None:
+
+FLOOD = FloodGuard(send_flood_digest, window=FLOOD_WINDOW, limit=FLOOD_LIMIT)
+
+class AdminDigest(BatchBuffer):
     """
-    Process a single Telegram update (called from FastAPI webhook).
-    This is basically the old 'for upd in updates:' body, adapted.
+    Digest mode for notify_admins: text messages from users are gathered for `window`
+    seconds and handed to `handler(entries)` as one list, one entry per user
+    ({"chat_id", "from", "texts", "count"}), so each admin gets one combined message
+    instead of one per user message.
+
+    mode "on" batches every text message, "auto" only while more than `threshold`
+    messages arrived within the last `window` seconds, "off" none. Each user shows at
+    most `max_texts` messages of at most `text_limit` characters, and a digest is sent
+    early once it lists `max_users` users or would grow past `max_chars`.
     """
 
-    # callback queries (inline button presses)
-    if "callback_query" in upd:
-        cq = upd["callback_query"]
-        cq_id = cq.get("id")
-        cq_from = cq.get("from", {}) or {}
-        cq_data = cq.get("data", "")
+    label = "admin digest"
 
-        if cq_data.startswith("copyuid:"):
-            answer_callback(cq_id, text="User ID sent to your chat.")
-            try:
-                uid = cq_data.split(":", 1)[1]
-                send_message(cq_from.get("id"), uid)
-            except Exception:
-                send_message(cq_from.get("id"), "Failed to send user id.")
+    def __init__(self, handler: Callable[[List[Dict[str, Any]]], Awaitable[None]], mode: str = "off",
+                 window: float = 10.0, max_users: int = 10, threshold: int = 20,
+                 max_texts: int = 3, text_limit: int = 100, max_chars: int = MESSAGE_LIMIT - 600) -> None:
+        super().__init__(handler)
+        self.mode = mode if mode in ("on", "auto") else "off"
+        self.window = window
+        self.max_users = max(1, max_users)
+        self.threshold = threshold
+        self.max_texts = max_texts
+        self.text_limit = text_limit
+        self.max_chars = max_chars
+        self.recent: deque = deque()
+        self.pending: Dict[int, Dict[str, Any]] = {}   # one entry per user; a single digest timer (key None)
+        self.size = 0   # rough length of the digest text so far
+        self.batched = 0
+        self.direct = 0
+        self.digests = 0
+
+    def wants(self, msg: Dict[str, Any]) -> bool:
+        """True if this user message should go into a digest instead of notify_admins."""
+        if self.mode == "off" or message_kind(msg) or not msg.get("text"):
+            return False   # media keeps its single copyMessage notification
+        if self.mode == "auto":
+            now = time.monotonic()
+            q = self.recent
+            q.append(now)
+            while q and now - q[0] >= self.window:
+                q.popleft()
+            if len(q) <= self.threshold and not self.pending:
+                self.direct += 1
+                return False
+        self.batched += 1
+        return True
+
+    def add(self, chat_id: int, from_user: Dict[str, Any], text: str) -> None:
+        text = " ".join(text.split())
+        if len(text) > self.text_limit:
+            text = text[:self.text_limit - 1] + "…"
+        text = escape_html(text)   # kept escaped, so the size budget counts what is sent
+        entry = self.pending.get(chat_id)
+        grow = 200 if entry is None else 0   # header line, "(+N more)" and separators
+        if entry is None or len(entry["texts"]) < self.max_texts:
+            grow += len(text) + 5
+        if self.pending and self.size + grow > self.max_chars:
+            self._fire(None)
+            entry = None
+        if entry is None:
+            entry = self.pending[chat_id] = {"chat_id": chat_id, "from": from_user, "texts": [], "count": 0}
+            self.size += 200
+        entry["count"] += 1
+        if len(entry["texts"]) < self.max_texts:
+            entry["texts"].append(text)
+            self.size += len(text) + 5
+        if len(self.pending) >= self.max_users:
+            self._fire(None)
+        else:
+            self._start_timer(None, self.window)
+
+    def _keys(self) -> List[Any]:
+        return [None]
+
+    def _take(self, key: None) -> Optional[Tuple[Optional[int], Tuple[Any, ...]]]:
+        entries = list(self.pending.values())
+        self.pending = {}
+        self.size = 0
+        if not entries:
+            return None
+        self.digests += 1
+        return None, (entries,)   # many users: no chat lock
+
+    def stats(self) -> Dict[str, int]:
+        return {"pending_users": len(self.pending), "batched": self.batched, "direct": self.direct,
+                "digests": self.digests}
+
+
+DIGEST = AdminDigest(notify_admins_digest, mode=DIGEST_MODE, window=DIGEST_WINDOW,
+                     max_users=DIGEST_MAX_USERS, threshold=DIGEST_AUTO_THRESHOLD)
+
+class AdminNotifier:
+    """
+    Queue between the user path and notify_admins: the update worker acks the user and
+    enqueues, and background tasks send the notifications, so update workers never wait
+    on the admin chats' rate limits. Like UpdateQueue, notifications are sharded by user
+    chat onto `workers` tasks with bounded queues (`maxsize` in all), so one user's
+    messages reach the admins in order. On a full shard, plain text messages go into
+    DIGEST instead and others wait for room.
+    """
+
+    def __init__(self, handler: Callable[..., Awaitable[None]], workers: int = 8, maxsize: int = 100) -> None:
+        self.handler = handler
+        self.workers = workers
+        self.maxsize = maxsize
+        self.queues: List[asyncio.Queue] = []
+        self.tasks: List[asyncio.Task] = []
+        self.enqueued = 0
+        self.sent = 0
+        self.digested = 0
+        self.errors = 0
+        self.max_depth = 0
+
+    def start(self) -> None:
+        if self.tasks:
             return
+        loop = asyncio.get_running_loop()
+        per_shard = max(1, self.maxsize // self.workers)
+        self.queues = [asyncio.Queue(maxsize=per_shard) for _ in range(self.workers)]
+        self.tasks = [loop.create_task(self._worker(q)) for q in self.queues]
 
-        if cq_data.startswith("prep_reply:"):
-            answer_callback(cq_id, text="Prepared reply command.")
-            try:
-                target = cq_data.split(":", 1)[1]
-                send_message(cq_from.get("id"), f"/reply {target} ")
-            except Exception:
-                send_message(cq_from.get("id"), "Failed to prepare reply.")
+    def depth(self) -> int:
+        return sum(q.qsize() for q in self.queues)
+
+    async def put(self, chat_id: int, from_user: Dict[str, Any], text: str, message=None, album=None) -> None:
+        self.start()
+        q = self.queues[hash(chat_id) % self.workers]
+        if q.full() and message and not album and not message_kind(message) and message.get("text"):
+            self.digested += 1
+            DIGEST.add(chat_id, from_user, text)
             return
+        await q.put((LOG_CONTEXT.get(), (chat_id, from_user, text), {"message": message, "album": album}))
+        self.enqueued += 1
+        self.max_depth = max(self.max_depth, self.depth())
 
-        if cq_data.startswith("prep_send_media:"):
-            answer_callback(cq_id, text="Prepared send_media command.")
+    async def _worker(self, q: asyncio.Queue) -> None:
+        while True:
+            fields, args, kwargs = await q.get()
+            token = LOG_CONTEXT.set(fields)
             try:
-                target = cq_data.split(":", 1)[1]
-                send_message(cq_from.get("id"), f"/send_media {target} ")
-            except Exception:
-                send_message(cq_from.get("id"), "Failed to prepare send_media.")
+                await self.handler(*args, **kwargs)
+                self.sent += 1
+            except Exception as exc:
+                self.errors += 1
+                log.exception("notifying admins failed: %s", exc)
+            finally:
+                LOG_CONTEXT.reset(token)
+                q.task_done()
+
+    def busy(self) -> bool:
+        return self.enqueued > self.sent + self.errors
+
+    async def stop(self, timeout: float = 30.0) -> None:
+        """Send what is queued (up to `timeout`), then stop the workers."""
+        if not self.tasks:
             return
+        try:
+            await asyncio.wait_for(asyncio.gather(*(q.join() for q in self.queues)), timeout)
+        except asyncio.TimeoutError:
+            log.warning("stopping with %s admin notifications unsent", self.depth())
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
 
-        # unknown callback
-        answer_callback(cq_id, text="Unknown action")
-        return
+    def stats(self) -> Dict[str, int]:
+        return {"depth": self.depth(), "max_depth": self.max_depth, "enqueued": self.enqueued,
+                "sent": self.sent, "digested": self.digested, "errors": self.errors}
 
-    # normal message or edited_message
-    msg = upd.get("message") or upd.get("edited_message")
-    if not msg:
-        return
 
-    chat = msg.get("chat", {}) or {}
-    chat_id = chat.get("id")
-    from_user = msg.get("from", {}) or {}
-    user_id = from_user.get("id")
-    text = msg.get("text", "") or ""
-    photos = msg.get("photo")
-    video = msg.get("video")
-    sticker = msg.get("sticker")
-    caption = msg.get("caption", "") or ""
+NOTIFIER = AdminNotifier(notify_admins, workers=NOTIFY_WORKERS, maxsize=NOTIFY_QUEUE_SIZE)
 
-    # -------------------- ADMIN flows --------------------
-    if is_admin(user_id):
-        # /send_sticker start flow
-        if text.strip().startswith("/send_sticker"):
-            parts = text.strip().split(None, 1)
-            if len(parts) < 2:
-                send_message(user_id, "Usage: /send_sticker <chat_id>")
-            else:
-                try:
-                    target = int(parts[1])
-                    set_pending_sticker(user_id, target)
-                    send_message(
-                        user_id,
-                        f"OK — now send the sticker to forward to {target}. Use /cancel_sticker to cancel.",
-                    )
-                except Exception:
-                    send_message(user_id, "Invalid chat_id. Usage: /send_sticker <chat_id>")
-            return
+class UpdateDeduper:
+    """
+    Recently seen update_ids (bounded LRU with TTL), so Telegram redeliveries are
+    acknowledged without being processed twice. Optionally saved to `path` on
+    shutdown and reloaded on startup.
+    """
 
-        # cancel pending sticker
-        if text.strip().startswith("/cancel_sticker"):
-            prev = pop_pending_sticker(user_id)
-            if prev:
-                send_message(user_id, f"Pending sticker to {prev} cancelled.")
-            else:
-                send_message(user_id, "No pending sticker request.")
-            return
+    def __init__(self, max_size: int = 10000, ttl: float = 24 * 3600, path: Optional[str] = None) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.path = path
+        self.recent: "OrderedDict[int, float]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
 
-        # if admin sends a sticker and has a pending target -> forward and clear pending
-        if sticker:
-            pending = get_pending_sticker(user_id)
-            if pending:
-                fid = sticker.get("file_id")
-                res = send_sticker(pending, fid)
-                if res.get("ok"):
-                    send_message(user_id, f"Sticker forwarded to {pending}.")
-                    pop_pending_sticker(user_id)
-                else:
-                    send_message(user_id, f"Failed to forward sticker: {res}")
-                return
-            # else sticker may be reply-forward; handled below
+    def _expire(self, now: float) -> None:
+        while self.recent:
+            update_id, ts = next(iter(self.recent.items()))
+            if now - ts < self.ttl and len(self.recent) <= self.max_size:
+                break
+            self.recent.popitem(last=False)
+            self.evictions += 1
 
-        # reply-to-admin-message mapping -> forward to user
-        if msg.get("reply_to_message"):
-            replied = msg["reply_to_message"]
-            replied_mid = replied.get("message_id")
-            target_chat = lookup_thread_target(user_id, replied_mid)
-            if target_chat:
-                forwarded = False
-                if text:
-                    send_message(target_chat, text)
-                    forwarded = True
-                    send_message(user_id, f"Forwarded to user {target_chat}.")
-                if photos:
-                    fid = photos[-1].get("file_id")
-                    send_photo(target_chat, fid, caption=caption if caption else None)
-                    forwarded = True
-                    send_message(user_id, f"Photo forwarded to user {target_chat}.")
-                if video:
-                    fid = video.get("file_id")
-                    send_video(target_chat, fid, caption=caption if caption else None)
-                    forwarded = True
-                    send_message(user_id, f"Video forwarded to user {target_chat}.")
-                if sticker:
-                    fid = sticker.get("file_id")
-                    send_sticker(target_chat, fid)
-                    forwarded = True
-                    send_message(user_id, f"Sticker forwarded to user {target_chat}.")
-                if not forwarded:
-                    send_message(user_id, "No forwardable content found in your reply.")
-                return
+    def check(self, update_id: int) -> bool:
+        """True if update_id was already seen; otherwise remember it and return False."""
+        now = time.time()
+        ts = self.recent.get(update_id)
+        if ts is not None and now - ts < self.ttl:
+            self.hits += 1
+            return True
+        self.misses += 1
+        self.recent[update_id] = now
+        self.recent.move_to_end(update_id)
+        self._expire(now)
+        return False
 
-        # admin send_media flows
-        if ((photos or video or sticker) and caption.strip().startswith("/send_media")):
-            cmd_text = caption.strip()
-            res = cmd_send_media(user_id, msg, cmd_text[len("/send_media"):].strip())
-            if res.get("ok"):
-                send_message(user_id, "Media/sticker sent to target.")
-            else:
-                send_message(user_id, "Send media failed: " + (res.get("error") or "unknown"))
-            return
+    def discard(self, update_id: int) -> None:
+        self.recent.pop(update_id, None)
 
-        if text.strip().startswith("/send_media"):
-            res = cmd_send_media(user_id, msg, text[len("/send_media"):].strip())
-            if res.get("ok"):
-                send_message(user_id, "Media/sticker sent to target.")
-            else:
-                send_message(user_id, "Send media failed: " + (res.get("error") or "unknown"))
+    def load(self) -> None:
+        if not self.path:
             return
+        now = time.time()
+        for update_id, ts in load_store(self.path).get("recent", []):
+            if now - ts < self.ttl:
+                self.recent[int(update_id)] = ts
+        self._expire(now)
 
-        # /sendtoalluser
-        if text.strip().startswith("/sendtoalluser"):
-            payload = text.strip()[len("/sendtoalluser"):].strip()
-            res = cmd_sendtoalluser(user_id, payload)
-            if res.get("ok"):
-                send_message(user_id, f"Sent to {res.get('sent')} users; failed: {res.get('failed')}.")
-            else:
-                send_message(user_id, "sendtoalluser failed: " + (res.get("error") or "unknown"))
-            return
+    def save(self) -> None:
+        if self.path:
+            save_store({"recent": list(self.recent.items())}, self.path)
 
-        # generic admin commands: /reply, /inbox, /broadcast, /help
-        if text.strip().startswith("/reply"):
-            res = cmd_reply(user_id, text.strip()[len("/reply"):].strip())
-            if res.get("ok"):
-                send_message(user_id, f"Message sent to {res.get('sent_to')}.")
-            else:
-                send_message(user_id, "Reply failed: " + (res.get("error") or "unknown"))
-            return
+    def stats(self) -> Dict[str, int]:
+        return {"size": len(self.recent), "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
 
-        if text.strip().startswith("/inbox"):
-            d = load_store()
-            inbox = d.get("inbox", [])[-20:]
-            if not inbox:
-                send_message(user_id, "Inbox is empty.")
-            else:
-                lines = [
-                    f"{fmt_time(e['ts'])} | user_id:{e['user_id']} | chat:{e['chat_id']} | {e.get('text','')[:60]}"
-                    for e in inbox
-                ]
-                send_message(user_id, "Last messages:\n" + "\n".join(lines))
-            return
 
-        if text.strip().startswith("/broadcast"):
-            payload = text.strip()[len("/broadcast"):].strip()
-            if payload:
-                d = load_store()
-                count = 0
-                for cid in d.get("seen_chats", []):
-                    r = send_message(cid, payload)
-                    if r.get("ok"):
-                        count += 1
-                    time.sleep(0.02)
-                send_message(user_id, f"Broadcast sent to ~{count} chats.")
-            else:
-                send_message(user_id, "Usage: /broadcast <message>")
-            return
+DEDUP = UpdateDeduper(max_size=DEDUP_SIZE, ttl=DEDUP_TTL, path=DEDUP_FILE)
 
-        if text.strip().startswith("/help"):
-            send_message(
-                user_id,
-                "Admin commands:\n"
-                "/reply <chat_id> <message>\n"
-                "/send_media <chat_id> (reply to media or send media with caption)\n"
-                "/send_sticker <chat_id>  -> then send the sticker\n"
-                "/cancel_sticker\n"
-                "/sendtoalluser <message>\n"
-                "/inbox\n"
-                "/broadcast <message>\n"
-                "You can also reply to a forwarded message to send to the original user."
-            )
-            return
+register_metric(Gauge("bot_update_queue_depth", "Updates waiting in the update queue.", UPDATES.depth))
+register_metric(Gauge("bot_update_queue_events", "Update queue counters since start.", UPDATES.stats, label="event"))
+register_metric(Gauge("bot_flood_events", "Per-user flood control counters since start.", FLOOD.stats, label="event"))
+register_metric(Gauge("bot_digest_events", "Admin digest mode counters since start.", DIGEST.stats, label="event"))
+register_metric(Gauge("bot_album_events", "Album aggregator counters since start.", ALBUMS.stats, label="event"))
+register_metric(Gauge("bot_dedup_events", "Update dedup cache counters since start.", DEDUP.stats, label="event"))
+register_metric(Gauge("bot_admin_notify_events", "Admin notification queue counters since start.", NOTIFIER.stats,
+                      label="event"))
 
-        # if none matched, ignore
-        return
+# -------------------- Long polling --------------------
+class UpdatePoller:
+    """
+    getUpdates long polling instead of the webhook (BOT_MODE=polling), for hosts without
+    a public HTTPS URL and for working off a backlog in bulk after downtime.
 
-    # -------------------- NON-ADMIN (user) --------------------
-    if text.strip().startswith("/help"):
-        send_message(chat_id, "Commands:\n/start\n/help\n(You can message admin via this bot.)")
-        return
+    Each batch (up to `limit` updates) goes through DEDUP and UPDATES like webhook
+    deliveries, so chats keep their order and different chats run in parallel. The
+    batch's offset is only passed to Telegram, which confirms the updates, once the
+    whole batch has been processed; after a crash the unconfirmed updates come again.
+    """
 
-    # store inbox entry (with small info) + track seen_chats here
-    ts = now_ts()
-    try:
-        d = load_store()
-        inbox = d.get("inbox", [])
-        inbox.append({
-            "ts": ts,
-            "chat_id": chat_id,
-            "user_id": user_id,
-            "text": text,
-            "username": from_user.get("username"),
-            "first_name": from_user.get("first_name"),
-            "last_name": from_user.get("last_name")
-        })
-        if len(inbox) > INBOX_LIMIT:
-            inbox = inbox[-INBOX_LIMIT:]
-        d["inbox"] = inbox
+    def __init__(self, timeout: int = 50, limit: int = 100, interval: float = 1.0) -> None:
+        self.timeout = timeout
+        self.limit = limit
+        self.interval = interval
+        self.offset: Optional[int] = None     # next update_id to ask for
+        self.confirmed: Optional[int] = None  # offset Telegram has already been sent
+        self.task: Optional[asyncio.Task] = None
+        self.polls = 0
+        self.updates = 0
+        self.duplicates = 0
+        self.errors = 0
+        self.max_batch = 0
 
-        sc = set(d.get("seen_chats", []))
-        if chat_id:
-            sc.add(chat_id)
-        d["seen_chats"] = list(sc)
+    def start(self) -> None:
+        if self.task is None:
+            self.task = asyncio.get_running_loop().create_task(self._run())
 
-        save_store(d)
-    except Exception as exc:
-        print(f"[process_update] failed to store inbox: {exc}")
+    async def _run(self) -> None:
+        while True:
+            params: Dict[str, Any] = {"timeout": self.timeout, "limit": self.limit}
+            if self.offset is not None:
+                params["offset"] = self.offset
+            res = await api_request_async("getUpdates", params, timeout=self.timeout + 10)
+            self.polls += 1
+            if not res.get("ok"):
+                self.errors += 1
+                log.warning("getUpdates failed: %s", res.get("description") or res.get("error"))
+                await asyncio.sleep(self.interval)
+                continue
+            self.confirmed = self.offset
+            batch = [u for u in res.get("result") or [] if isinstance(u.get("update_id"), int)]
+            if batch:
+                await self._process(batch)
+                self.offset = batch[-1]["update_id"] + 1
+            elif self.timeout <= 0:
+                await asyncio.sleep(self.interval)   # short polling: don't spin
+
+    async def _process(self, batch: List[Dict[str, Any]]) -> None:
+        self.updates += len(batch)
+        self.max_batch = max(self.max_batch, len(batch))
+        for upd in batch:
+            if DEDUP.check(upd["update_id"]):
+                self.duplicates += 1
+                continue
+            await UPDATES.put(upd)
+        await UPDATES.join()
+
+    async def stop(self) -> None:
+        """Stop polling and confirm the last fully processed batch."""
+        if self.task is None:
+            return
+        self.task.cancel()
+        await asyncio.gather(self.task, return_exceptions=True)
+        self.task = None
+        if self.offset is not None and self.offset != self.confirmed:
+            await api_request_async("getUpdates", {"offset": self.offset, "timeout": 0, "limit": 1})
+            self.confirmed = self.offset
+
+    def stats(self) -> Dict[str, int]:
+        return {"polls": self.polls, "updates": self.updates, "duplicates": self.duplicates,
+                "errors": self.errors, "max_batch": self.max_batch}
 
-    # notify admins and forward any media/sticker
-    notify_admins(chat_id, from_user, text, photos=photos, video=video, sticker=sticker)
-    send_message(chat_id, "धन्यवाद — आपका संदेश पहुँच गया। Admin जल्द reply कर देगा।")
-    return
+
+POLLER = UpdatePoller(timeout=POLL_TIMEOUT, limit=POLL_LIMIT, interval=POLL_INTERVAL)
+register_metric(Gauge("bot_poll_events", "getUpdates polling counters since start.", POLLER.stats, label="event"))
 
 # -------------------- Webhook setup helpers --------------------
-def set_webhook():
+async def set_webhook() -> str:
+    """Point Telegram at BASE_URL/webhook unless getWebhookInfo shows it already is."""
     if not BASE_URL:
-        print("[set_webhook] BASE_URL not set, skipping setWebhook")
-        return
+        log.warning("BASE_URL not set, skipping setWebhook")
+        return "skipped"
     webhook_url = f"{BASE_URL.rstrip('/')}/webhook"
-    print("[set_webhook] Setting webhook to:", webhook_url)
-    resp = api_request("setWebhook", {"url": webhook_url})
-    print("[set_webhook] Response:", resp)
+    info = await api_request_async("getWebhookInfo")
+    if info.get("ok") and (info.get("result") or {}).get("url") == webhook_url:
+        log.info("webhook already set to %s", webhook_url)
+        return "unchanged"
+    log.info("setting webhook to %s", webhook_url)
+    resp = await api_request_async("setWebhook", {"url": webhook_url})
+    log.log(logging.INFO if resp.get("ok") else logging.ERROR, "setWebhook: %s", resp)
+    return "set" if resp.get("ok") else "failed"
+
+async def delete_webhook() -> str:
+    """Polling mode: getUpdates fails while a webhook is set, so remove it (keeping pending updates)."""
+    info = await api_request_async("getWebhookInfo")
+    if info.get("ok") and not (info.get("result") or {}).get("url"):
+        return "none"
+    log.info("removing webhook for polling mode")
+    resp = await api_request_async("deleteWebhook")
+    log.log(logging.INFO if resp.get("ok") else logging.ERROR, "deleteWebhook: %s", resp)
+    return "deleted" if resp.get("ok") else "failed"
+
+# -------------------- Startup --------------------
+STARTUP_PHASES: Dict[str, float] = {}   # phase -> seconds, shown on /health
+READINESS = {"state": "loading", "webhook": "pending"}
+STARTUP_TASKS: Dict[str, asyncio.Task] = {}
+
+@contextlib.contextmanager
+def startup_phase(name: str) -> Iterator[None]:
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        STARTUP_PHASES[name] = round(time.perf_counter() - t0, 4)
+        log.info("startup phase %s done", name, extra={"data": {"phase": name, "ms": round(STARTUP_PHASES[name] * 1000, 1)}})
+
+async def load_state() -> None:
+    """
+    Load the store in a worker thread (a large bot_data.json or journal replay must not
+    block the event loop or the webhook), then let the update workers go and resume
+    broadcasts. If loading fails, updates still run and retry the load on first use.
+    """
+    try:
+        with startup_phase("state"):
+            await asyncio.to_thread(STORE.ensure_loaded)
+            await STATS.load()
+        READINESS["state"] = "ready"
+    except Exception as exc:
+        READINESS["state"] = "failed"
+        log.exception("loading state failed: %s", exc)
+    UPDATES.ready.set()
+    STARTUP_PHASES["ready"] = round(time.perf_counter() - IMPORT_STARTED, 4)
+    with startup_phase("broadcast_resume"):
+        await BROADCASTS.resume()
+
+async def register_webhook() -> None:
+    """Webhook mode: setWebhook. Polling mode: drop any webhook, then start getUpdates."""
+    try:
+        with startup_phase("webhook"):
+            if BOT_MODE == "polling":
+                READINESS["webhook"] = await delete_webhook()
+            else:
+                READINESS["webhook"] = await set_webhook()
+    except Exception as exc:
+        READINESS["webhook"] = "failed"
+        log.error("webhook registration failed: %s", exc)
+    if BOT_MODE == "polling":
+        POLLER.start()
+
+def start_background(name: str, coro: Awaitable[None]) -> None:
+    STARTUP_TASKS[name] = asyncio.get_running_loop().create_task(coro)
 
 # -------------------- FastAPI app --------------------
 app = FastAPI()
 
 @app.on_event("startup")
 async def startup_event():
-    # try to set webhook on startup
-    set_webhook()
+    # only cheap work before we accept requests; the state load and the webhook
+    # registration run in the background (see /health for readiness)
+    setup_logging()
+    STARTUP_PHASES["import"] = round(MODULE_LOADED - IMPORT_STARTED, 4)
+    with startup_phase("dedup"):
+        DEDUP.load()
+    UPDATES.ready.clear()
+    UPDATES.start()
+    start_background("state", load_state())
+    start_background("webhook", register_webhook())
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    webhook = STARTUP_TASKS.get("webhook")
+    if webhook:
+        webhook.cancel()
+    if STARTUP_TASKS.get("state"):
+        await asyncio.gather(STARTUP_TASKS["state"], return_exceptions=True)
+    await POLLER.stop()
+    await UPDATES.stop()
+    await ALBUMS.flush()
+    await FLOOD.flush()
+    await NOTIFIER.stop()
+    await DIGEST.flush()
+    DEDUP.save()
+    await STATS.close()
+    BROADCASTS.close()
+    close_store()
+    await API_CLIENT.close()
 
 @app.get("/")
 async def root():
-    return {"status": "ok", "message": "Telegram bot is running."}
+    return {
+        "status": "ok",
+        "message": "Telegram bot is running.",
+        "queue": UPDATES.stats(),
+        "dedup": DEDUP.stats(),
+    }
+
+@app.get("/health")
+async def health():
+    """Readiness: 200 once the state is loaded and updates are being processed, else 503."""
+    ready = READINESS["state"] == "ready"
+    body = {"ready": ready, **READINESS, "phases": STARTUP_PHASES}
+    return body if ready else JSONResponse(body, status_code=503)
+
+@app.get("/metrics")
+async def metrics():
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
 
 @app.post("/webhook")
 async def telegram_webhook(request: Request):
-    update = await request.json()
+    # validate and enqueue only; UPDATES workers run process_update in the background
     try:
-        process_update(update)
-    except Exception as exc:
-        print("[webhook] exception:", exc)
-        traceback.print_exc()
+        update = await request.json()
+    except ValueError:
+        return {"ok": False, "error": "invalid json"}
+    if not isinstance(update, dict) or not isinstance(update.get("update_id"), int):
+        return {"ok": False, "error": "not a telegram update"}
+    if DEDUP.check(update["update_id"]):
+        return {"ok": True, "duplicate": True}
+    if not await UPDATES.submit(update):
+        # queue full: a non-2xx makes Telegram redeliver the update later
+        DEDUP.discard(update["update_id"])
+        return JSONResponse({"ok": False, "error": "busy"}, status_code=503)
     return {"ok": True}
+
+async def run_polling() -> None:
+    """`python bot.py`: app startup, getUpdates until SIGINT/SIGTERM, app shutdown (no HTTP server)."""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        with contextlib.suppress(NotImplementedError):
+            loop.add_signal_handler(sig, stop.set)
+    await startup_event()
+    try:
+        await stop.wait()
+    finally:
+        await shutdown_event()
+
+MODULE_LOADED = time.perf_counter()   # end of import, for the "import" startup phase
+
+if __name__ == "__main__":
+    # `python bot.py` (Procfile / render.yaml background worker): long polling unless
+    # BOT_MODE=webhook asks for the HTTP server
+    BOT_MODE = os.getenv("BOT_MODE", "polling")
+    if BOT_MODE == "polling":
+        asyncio.run(run_polling())
+    else:
+        import uvicorn
+        uvicorn.run(app, host="0.0.0.0", port=int(os.getenv("PORT", "8000")))
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# bot.py reads its config at import time and refuses to start without a token
+os.environ.setdefault("BOT_TOKEN", "123:test")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
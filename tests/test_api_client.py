@@ -0,0 +1,186 @@
+"""TelegramClient against a raw local HTTP server: keep-alive reuse, retries, timeouts."""
+
+import asyncio
+import json
+import urllib.parse
+
+import bot
+
+
+class RawServer:
+    """
+    HTTP/1.1 server whose answer to each request is chosen by `behave(n, body)`:
+    "ok", "close_idle" (answer, then drop the idle connection), "cut_body" (status
+    line and headers, half the body, then close), "close" (close before answering)
+    or "hang". Every request body received is recorded.
+    """
+
+    def __init__(self, behave):
+        self.behave = behave
+        self.bodies = []
+        self.connections = 0
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        return f"http://127.0.0.1:{self.server.sockets[0].getsockname()[1]}/botT/"
+
+    async def stop(self):
+        self.server.close()
+
+    async def _handle(self, reader, writer):
+        self.connections += 1
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                length = int(head.lower().split(b"content-length:")[1].split(b"\r\n")[0])
+                body = (await reader.readexactly(length)).decode()
+                self.bodies.append(body)
+                action = self.behave(len(self.bodies), body)
+                if action == "hang":
+                    await asyncio.sleep(10)
+                if action == "close":
+                    break
+                payload = json.dumps({"ok": True, "result": {"message_id": len(self.bodies)}}).encode()
+                head = (f"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                        f"Content-Length: {len(payload)}\r\n\r\n").encode()
+                if action == "cut_body":
+                    writer.write(head + payload[:5])
+                    await writer.drain()
+                    break
+                writer.write(head + payload)
+                await writer.drain()
+                if action == "close_idle":
+                    await asyncio.sleep(0.05)
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+def run(behave, calls):
+    """Start a RawServer, run `calls(client)` and return (its result, the server)."""
+    async def main():
+        server = RawServer(behave)
+        client = bot.TelegramClient(await server.start(), timeout=0.5)
+        try:
+            return await calls(client), server
+        finally:
+            await client.close()
+            await server.stop()
+
+    return asyncio.run(main())
+
+
+def texts(server):
+    return [urllib.parse.parse_qs(b)["text"][0] for b in server.bodies]
+
+
+def test_keep_alive_connection_is_reused():
+    async def calls(client):
+        return [await client.request("sendMessage", {"chat_id": 1, "text": t}) for t in "abc"]
+
+    results, server = run(lambda n, body: "ok", calls)
+    assert [r["result"]["message_id"] for r in results] == [1, 2, 3]
+    assert server.connections == 1
+
+
+def test_stale_idle_connection_is_retried_once():
+    async def calls(client):
+        first = await client.request("sendMessage", {"chat_id": 1, "text": "a"})
+        await asyncio.sleep(0.1)   # the server has dropped the pooled connection by now
+        return first, await client.request("sendMessage", {"chat_id": 1, "text": "b"})
+
+    (first, second), server = run(lambda n, body: "close_idle", calls)
+    assert first["ok"] and second["ok"]
+    assert texts(server) == ["a", "b"]
+    assert server.connections == 2
+
+
+def test_response_cut_off_is_not_sent_again():
+    async def calls(client):
+        await client.request("sendMessage", {"chat_id": 1, "text": "a"})
+        return await client.request("sendMessage", {"chat_id": 1, "text": "b"})
+
+    res, server = run(lambda n, body: "cut_body" if n == 2 else "ok", calls)
+    assert not res["ok"] and "unsent" not in res
+    assert texts(server) == ["a", "b"]
+
+
+def test_closed_before_answering_a_fresh_connection_is_not_unsent():
+    async def calls(client):
+        return await client.request("sendMessage", {"chat_id": 1, "text": "a"})
+
+    res, server = run(lambda n, body: "close", calls)
+    assert not res["ok"] and "unsent" not in res
+    assert texts(server) == ["a"]
+
+
+def test_timeout_after_sending():
+    async def calls(client):
+        return await client.request("sendMessage", {"chat_id": 1, "text": "a"})
+
+    res, server = run(lambda n, body: "hang", calls)
+    assert res == {"ok": False, "error": "timeout"}
+    assert texts(server) == ["a"]
+
+
+def test_connect_failure_is_unsent():
+    async def main():
+        client = bot.TelegramClient("http://127.0.0.1:1/botT/", connect_timeout=0.5)
+        return await client.request("sendMessage", {"chat_id": 1, "text": "a"})
+
+    res = asyncio.run(main())
+    assert not res["ok"] and res["unsent"]
+
+
+def test_cancelled_request_closes_its_connection():
+    async def calls(client):
+        task = asyncio.ensure_future(client.request("sendMessage", {"chat_id": 1, "text": "a"}))
+        await asyncio.sleep(0.1)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        return len(client._idle)
+
+    idle, _ = run(lambda n, body: "hang", calls)
+    assert idle == 0
+
+
+def fake_api(calls, **fake_options):
+    """Run `calls(client)` against bench.py's FakeTelegramServer; (its result, the server)."""
+    from bench import FakeTelegramServer
+
+    async def main():
+        fake = FakeTelegramServer(**fake_options)
+        port = await fake.start()
+        client = bot.TelegramClient(f"http://127.0.0.1:{port}/bot123:test/", pool_size=8, max_concurrency=8)
+        try:
+            return await calls(client), fake
+        finally:
+            await client.close()
+            await fake.stop()
+
+    return asyncio.run(main())
+
+
+def test_concurrent_calls_share_a_bounded_pool():
+    async def calls(client):
+        return await asyncio.gather(*(client.request("sendMessage", {"chat_id": c, "text": "hi"})
+                                      for c in range(50)))
+
+    results, fake = fake_api(calls, latency=0.005)
+    assert all(r["ok"] for r in results)
+    assert fake.calls == {"sendMessage": 50}
+    assert fake.connections <= 8   # at most max_concurrency sockets, reused
+
+
+def test_error_answers_are_returned_as_they_are():
+    async def calls(client):
+        return await client.request("sendMessage", {"chat_id": 1, "text": "hi"})
+
+    res, fake = fake_api(calls, rate_limit_rate=1.0, retry_after=7)
+    assert res["error_code"] == 429 and res["parameters"] == {"retry_after": 7}
+    assert fake.calls == {"sendMessage": 1}   # retries are the scheduler's job
+    res, _ = fake_api(calls, error_rate=1.0)
+    assert res["error_code"] == 500
@@ -0,0 +1,128 @@
+"""BatchBuffer and its subclasses: AlbumAggregator and FloodGuard."""
+
+import asyncio
+
+import bot
+
+
+def part(chat_id, group, message_id):
+    return {"message_id": message_id, "chat": {"id": chat_id}, "from": {"id": chat_id},
+            "media_group_id": group, "photo": [{"file_id": f"f{message_id}"}]}
+
+
+def text(chat_id, t):
+    return {"message_id": 1, "chat": {"id": chat_id}, "from": {"id": chat_id}, "text": t}
+
+
+def test_batch_buffer_default_take_hands_over_the_pending_batch():
+    got = []
+
+    async def handler(batch):
+        got.append(batch)
+
+    class Collector(bot.BatchBuffer):
+        def add(self, key, item):
+            self.pending.setdefault(key, []).append(item)
+            self._start_timer(key, 0.02)
+
+    async def run():
+        buf = Collector(handler)
+        buf.add("a", 1)
+        buf.add("a", 2)
+        buf.add("b", 3)
+        await asyncio.sleep(0.1)
+        assert not buf.busy()
+
+    asyncio.run(run())
+    assert sorted(got) == [[1, 2], [3]]
+
+
+def test_album_parts_are_sorted_and_flushed_after_the_wait():
+    albums = []
+
+    async def handler(parts):
+        albums.append([m["message_id"] for m in parts])
+
+    async def run():
+        agg = bot.AlbumAggregator(handler, wait=0.03)
+        for message_id in (3, 1, 2):
+            agg.add(part(1, "g", message_id))
+        agg.add(part(2, "g", 9))   # same group id, other chat: its own album
+        assert albums == []
+        await asyncio.sleep(0.1)
+        return agg
+
+    agg = asyncio.run(run())
+    assert sorted(albums) == [[1, 2, 3], [9]]
+    assert agg.stats()["albums"] == 2
+
+
+def test_full_album_is_flushed_at_once():
+    albums = []
+
+    async def handler(parts):
+        albums.append(len(parts))
+
+    async def run():
+        agg = bot.AlbumAggregator(handler, wait=10, max_parts=3)
+        for message_id in range(3):
+            agg.add(part(1, "g", message_id))
+        await asyncio.sleep(0.01)
+        assert not agg.busy()
+
+    asyncio.run(run())
+    assert albums == [3]
+
+
+def test_flood_guard_holds_messages_past_the_limit():
+    digests = []
+
+    async def handler(msgs, skipped):
+        digests.append(([m["text"] for m in msgs], skipped))
+
+    async def run():
+        flood = bot.FloodGuard(handler, window=0.05, limit=2, max_held=2)
+        allowed = []
+        for i in range(5):
+            msg = text(1, f"m{i}")
+            allowed.append(flood.allow(1))
+            if not allowed[-1]:
+                flood.hold(1, msg)
+        assert flood.allow(2)   # another user is not affected
+        await asyncio.sleep(0.15)
+        return flood, allowed
+
+    flood, allowed = asyncio.run(run())
+    assert allowed == [True, True, False, False, False]
+    assert digests == [(["m2", "m3"], 1)]
+    assert flood.allow(1)   # the window has passed
+
+
+def test_flood_guard_acks_once_per_window():
+    async def handler(msgs, skipped):
+        pass
+
+    flood = bot.FloodGuard(handler, window=60, limit=2)
+    assert [flood.should_ack(1) for _ in range(3)] == [True, False, False]
+    assert flood.should_ack(2)
+    off = bot.FloodGuard(handler, limit=0)
+    assert all(off.allow(1) and off.should_ack(1) for _ in range(10))
+
+
+def test_flush_hands_over_held_messages_now():
+    digests = []
+
+    async def handler(msgs, skipped):
+        digests.append(len(msgs))
+
+    async def run():
+        flood = bot.FloodGuard(handler, window=60, limit=1)
+        flood.allow(1)
+        for i in range(3):
+            flood.allow(1)
+            flood.hold(1, text(1, f"m{i}"))
+        await flood.flush()
+        assert not flood.busy()
+
+    asyncio.run(run())
+    assert digests == [3]
@@ -0,0 +1,81 @@
+"""UpdateDeduper and the webhook's handling of redelivered updates."""
+
+import asyncio
+
+import bot
+
+
+class FakeRequest:
+    def __init__(self, body):
+        self.body = body
+
+    async def json(self):
+        return self.body
+
+
+def test_seen_update_ids_are_duplicates():
+    d = bot.UpdateDeduper()
+    assert not d.check(1)
+    assert d.check(1)
+    assert not d.check(2)
+    assert d.stats() == {"size": 2, "hits": 1, "misses": 2, "evictions": 0}
+
+
+def test_oldest_ids_are_evicted_past_max_size():
+    d = bot.UpdateDeduper(max_size=3)
+    for update_id in range(5):
+        d.check(update_id)
+    assert list(d.recent) == [2, 3, 4]
+    assert not d.check(0)
+
+
+def test_ids_expire_after_the_ttl(monkeypatch):
+    d = bot.UpdateDeduper(ttl=10)
+    now = 1000.0
+    monkeypatch.setattr(bot.time, "time", lambda: now)
+    d.check(1)
+    now += 11
+    assert not d.check(1)
+
+
+def test_saved_ids_survive_a_restart(tmp_path):
+    path = str(tmp_path / "dedup.json")
+    d = bot.UpdateDeduper(path=path)
+    d.check(7)
+    d.save()
+    reloaded = bot.UpdateDeduper(path=path)
+    reloaded.load()
+    assert reloaded.check(7)
+
+
+def test_webhook_processes_a_redelivered_update_once(monkeypatch):
+    submitted = []
+
+    async def submit(update):
+        submitted.append(update["update_id"])
+        return True
+
+    monkeypatch.setattr(bot, "DEDUP", bot.UpdateDeduper())
+    monkeypatch.setattr(bot.UPDATES, "submit", submit)
+    update = {"update_id": 5, "message": {"chat": {"id": 1}, "text": "hi"}}
+
+    first = asyncio.run(bot.telegram_webhook(FakeRequest(update)))
+    again = asyncio.run(bot.telegram_webhook(FakeRequest(update)))
+    assert first == {"ok": True}
+    assert again == {"ok": True, "duplicate": True}
+    assert submitted == [5]
+
+
+def test_an_update_refused_as_busy_is_not_remembered(monkeypatch):
+    answers = [False, True]
+
+    async def submit(update):
+        return answers.pop(0)
+
+    monkeypatch.setattr(bot, "DEDUP", bot.UpdateDeduper())
+    monkeypatch.setattr(bot.UPDATES, "submit", submit)
+    update = {"update_id": 5, "message": {"chat": {"id": 1}, "text": "hi"}}
+
+    busy = asyncio.run(bot.telegram_webhook(FakeRequest(update)))
+    assert busy.status_code == 503
+    assert asyncio.run(bot.telegram_webhook(FakeRequest(update))) == {"ok": True}   # Telegram's retry
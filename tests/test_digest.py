@@ -0,0 +1,103 @@
+"""Admin digest mode: batching, the message size budget and `#N` replies."""
+
+import asyncio
+import html
+import urllib.parse
+
+import pytest
+
+import bot
+
+
+def text_msg(chat_id, text):
+    return {"message_id": 1, "chat": {"id": chat_id}, "from": {"id": chat_id}, "text": text}
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    """Digest texts sent to the first admin, as Telegram shows them (HTML unescaped)."""
+    bodies = []
+
+    async def fake_api(method, params):
+        fields = urllib.parse.parse_qs(bot.encode_params(params).decode())
+        if fields["chat_id"] == [str(bot.ADMIN_IDS[0])]:
+            bodies.append(fields["text"][0])
+        return {"ok": True, "result": {"message_id": len(bodies)}}
+
+    async def no_thread_maps(entries):
+        pass
+
+    monkeypatch.setattr(bot, "api_request_async", fake_api)
+    monkeypatch.setattr(bot, "store_thread_maps", no_thread_maps)
+    return bodies
+
+
+def run_digest(adds, **kwargs):
+    async def run():
+        digest = bot.AdminDigest(bot.notify_admins_digest, mode="on", window=60, **kwargs)
+        for chat_id, text in adds:
+            digest.add(chat_id, {"id": chat_id, "first_name": f"U{chat_id}"}, text)
+        await digest.flush()
+        return digest
+
+    return asyncio.run(run())
+
+
+def targets(body):
+    return {int(n): int(chat) for n, chat in bot.DIGEST_LINE_RE.findall(html.unescape(body))}
+
+
+def test_messages_from_several_users_make_one_digest(sent):
+    digest = run_digest([(1, "hi"), (2, "hello"), (1, "again"), (1, "3"), (1, "4")])
+    assert len(sent) == 1
+    assert targets(sent[0]) == {1: 1, 2: 2}
+    assert "5 messages from 2 users" in sent[0]
+    assert "(+1 more)" in sent[0]   # max_texts=3 per user
+    assert digest.stats()["digests"] == 1
+
+
+def test_budget_counts_the_escaped_text(sent):
+    # 100 characters of "<&>" grow to ~430 once escaped
+    run_digest([(chat_id, "<&>" * 40) for chat_id in range(1, 31)], max_users=50)
+    assert len(sent) > 3
+    assert all(len(body) <= bot.MESSAGE_LIMIT for body in sent)
+    assert sorted(c for body in sent for c in targets(body).values()) == list(range(1, 31))
+    assert "&lt;&amp;&gt;" in sent[0]   # escaped once, not twice
+
+
+def test_a_digest_too_long_for_one_message_is_split(sent):
+    entries = [{"chat_id": c, "from": {"id": c, "first_name": "&" * 64, "last_name": "<" * 64},
+                "texts": ["x" * 100] * 3, "count": 3} for c in range(1, 11)]
+    asyncio.run(bot.notify_admins_digest(entries))
+    assert len(sent) > 1
+    assert all(len(body) <= bot.MESSAGE_LIMIT for body in sent)
+    assert sorted(c for body in sent for c in targets(body).values()) == list(range(1, 11))
+
+
+def test_reply_picks_the_user_by_number(sent):
+    run_digest([(11, "a"), (22, "b")])
+    replied = {"text": html.unescape(sent[0]), "from": {"is_bot": True}}
+    assert bot.is_digest(replied)
+    assert bot.parse_digest_reply(replied, "#2 thanks") == (22, "thanks")
+    assert bot.parse_digest_reply(replied, "#9 nobody") == (None, "#9 nobody")
+    assert bot.parse_digest_reply(replied, "no number") == (None, "no number")
+
+
+def test_reply_to_a_single_user_digest_needs_no_number(sent):
+    run_digest([(11, "a"), (11, "b")])
+    replied = {"text": html.unescape(sent[0]), "from": {"is_bot": True}}
+    assert bot.parse_digest_reply(replied, "thanks") == (11, "thanks")
+
+
+def test_modes():
+    async def handler(entries):
+        pass
+
+    off = bot.AdminDigest(handler, mode="off")
+    on = bot.AdminDigest(handler, mode="on")
+    assert not off.wants(text_msg(1, "hi"))
+    assert on.wants(text_msg(1, "hi"))
+    assert not on.wants({"chat": {"id": 1}, "photo": [{"file_id": "f"}]})   # media is copied right away
+
+    auto = bot.AdminDigest(handler, mode="auto", window=60, threshold=3)
+    assert [auto.wants(text_msg(1, "hi")) for _ in range(5)] == [False, False, False, True, True]
@@ -0,0 +1,85 @@
+"""Command and callback registries and how process_update dispatches through them."""
+
+import asyncio
+
+import pytest
+
+import bot
+
+ADMIN = bot.ADMIN_IDS[0]
+
+
+def message(user_id, text, **extra):
+    return {"update_id": 1, "message": {"message_id": 1, "chat": {"id": user_id}, "from": {"id": user_id},
+                                        "text": text, **extra}}
+
+
+@pytest.fixture
+def record(monkeypatch):
+    """Replace registered handlers with recorders: record(registry, name) -> calls list."""
+    def replace(registry, name):
+        calls = []
+
+        async def handler(*args):
+            calls.append(args)
+
+        monkeypatch.setitem(registry, name, handler)
+        return calls
+
+    return replace
+
+
+@pytest.mark.parametrize("text, parsed", [
+    ("/reply 5 hi there", ("/reply", "5 hi there")),
+    ("/Inbox@my_bot  2", ("/inbox", "2")),
+    ("  /help", ("/help", "")),
+    ("hello /reply", (None, "hello /reply")),
+])
+def test_parse_command(text, parsed):
+    assert bot.parse_command(text) == parsed
+
+
+def test_every_command_is_registered():
+    assert {"/reply", "/inbox", "/broadcast", "/sendtoalluser", "/send_media", "/stats", "/chats",
+            "/broadcast_status", "/broadcast_cancel", "/help"} <= set(bot.ADMIN_COMMANDS)
+    assert {"/send_sticker", "/cancel_sticker"} <= set(bot.EARLY_ADMIN_COMMANDS)
+    assert set(bot.CALLBACK_ACTIONS) == {"copyuid", "prep_reply", "prep_send_media"}
+    assert "/help" in bot.USER_COMMANDS
+
+
+def test_admin_command_goes_to_its_handler(record):
+    calls = record(bot.ADMIN_COMMANDS, "/reply")
+    asyncio.run(bot.process_update(message(ADMIN, "/reply@my_bot 42 hello")))
+    (msg, admin_id, args), = calls
+    assert admin_id == ADMIN and args == "42 hello"
+
+
+def test_early_commands_win_over_a_reply(record):
+    calls = record(bot.EARLY_ADMIN_COMMANDS, "/send_sticker")
+    replied = {"message_id": 9, "from": {"is_bot": True}, "text": "notice"}
+    asyncio.run(bot.process_update(message(ADMIN, "/send_sticker 42", reply_to_message=replied)))
+    assert calls and calls[0][2] == "42"
+
+
+def test_user_commands_are_separate_from_admin_ones(record):
+    user_help = record(bot.USER_COMMANDS, "/help")
+    admin_help = record(bot.ADMIN_COMMANDS, "/help")
+    asyncio.run(bot.process_update(message(555, "/help")))
+    asyncio.run(bot.process_update(message(ADMIN, "/help")))
+    assert [c[1] for c in user_help] == [555]
+    assert [c[1] for c in admin_help] == [ADMIN]
+
+
+def test_callback_dispatches_on_the_data_prefix(record, monkeypatch):
+    calls = record(bot.CALLBACK_ACTIONS, "prep_reply")
+    answered = []
+
+    async def answer(cq_id, text=None, **kwargs):
+        answered.append(text)
+
+    monkeypatch.setattr(bot, "answer_callback_async", answer)
+    cq = {"id": "q1", "from": {"id": ADMIN}, "data": "prep_reply:-100:5"}
+    asyncio.run(bot.process_update({"update_id": 1, "callback_query": cq}))
+    asyncio.run(bot.process_update({"update_id": 2, "callback_query": {**cq, "data": "nope:1"}}))
+    assert calls == [("q1", ADMIN, "-100:5")]
+    assert answered == ["Unknown action"]
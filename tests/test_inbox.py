@@ -0,0 +1,80 @@
+"""InboxRing and the paged, filtered /inbox command."""
+
+import asyncio
+
+import pytest
+
+import bot
+
+ADMIN = bot.ADMIN_IDS[0]
+
+
+def entry(i, user_id=1, text=None):
+    return {"ts": 1000 + i, "chat_id": user_id, "user_id": user_id, "text": text or f"msg {i}"}
+
+
+def test_ring_overwrites_the_oldest_records():
+    ring = bot.InboxRing(3)
+    for i in range(5):
+        ring.append(entry(i))
+    assert len(ring) == 3
+    assert [e["text"] for e in ring.to_list()] == ["msg 2", "msg 3", "msg 4"]
+    assert [e.text for e in ring.newest()] == ["msg 4", "msg 3", "msg 2"]
+    assert ring.get(1) is None and ring.get(2).text == "msg 2" and ring.get(5) is None
+
+
+def test_zero_capacity_ring_keeps_nothing():
+    ring = bot.InboxRing(0)
+    ring.append(entry(0))
+    assert len(ring) == 0 and ring.to_list() == []
+
+
+def test_ring_pages_and_filters():
+    ring = bot.InboxRing(100)
+    for i in range(30):
+        ring.append(entry(i, user_id=1 + i % 3, text=f"Order #{i}" if i % 5 == 0 else None))
+    assert [e["ts"] for e in ring.page(limit=3)] == [1029, 1028, 1027]
+    assert [e["ts"] for e in ring.page(limit=3, offset=3)] == [1026, 1025, 1024]
+    assert {e["user_id"] for e in ring.page(limit=50, user_id=2)} == {2}
+    assert [e["text"] for e in ring.page(text="order #2")] == ["Order #25", "Order #20"]
+    assert [e["ts"] for e in ring.page(since=1010, until=1013)] == [1012, 1011, 1010]
+
+
+@pytest.mark.parametrize("args, opts", [
+    ("", {"page": 1, "limit": bot.INBOX_PAGE_SIZE}),
+    ("3", {"page": 3, "limit": bot.INBOX_PAGE_SIZE}),
+    ("2 user:5 n:5 refund please", {"page": 2, "limit": 5, "user_id": 5, "text": "refund please"}),
+    ("chat:-100 n:100000", {"page": 1, "limit": bot.INBOX_MAX_PAGE_SIZE, "chat_id": -100}),
+    ("order 42", {"page": 1, "limit": bot.INBOX_PAGE_SIZE, "text": "order 42"}),
+])
+def test_parse_inbox_args(args, opts):
+    assert bot.parse_inbox_args(args) == opts
+
+
+def test_parse_inbox_args_rejects_bad_numbers():
+    with pytest.raises(ValueError):
+        bot.parse_inbox_args("user:abc")
+
+
+def test_inbox_command_pages_with_a_next_link(tmp_path, monkeypatch):
+    store = bot.MemoryStore(str(tmp_path / "bot_data.json"))
+    store.ensure_loaded()
+    for i in range(12):
+        store.append_inbox(entry(i, user_id=7))
+    sent = []
+
+    async def send(chat_id, text, **kwargs):
+        sent.append(text)
+
+    monkeypatch.setattr(bot, "STORE", store)
+    monkeypatch.setattr(bot, "send_long_message_async", send)
+    monkeypatch.setattr(bot, "send_message_async", send)
+    asyncio.run(bot.on_inbox({}, ADMIN, "user:7 n:5"))
+    asyncio.run(bot.on_inbox({}, ADMIN, "3 user:7 n:5"))
+    asyncio.run(bot.on_inbox({}, ADMIN, "user:8"))
+
+    first, last, none = sent
+    assert first.count("user_id:7") == 5 and "msg 11" in first and "msg 6" not in first
+    assert first.endswith("More: /inbox 2 user:7 n:5")
+    assert "page 3" in last and "msg 0" in last and "More:" not in last
+    assert none == "No matching messages."
@@ -0,0 +1,64 @@
+"""AdminNotifier: admin notifications sent in order in the background, text overflow to a digest."""
+
+import asyncio
+
+import bot
+
+
+def text_msg(chat_id, text):
+    return {"message_id": 1, "chat": {"id": chat_id}, "from": {"id": chat_id}, "text": text}
+
+
+def test_each_users_notifications_are_sent_in_order_without_blocking_put():
+    sent = []
+    gate = asyncio.Event()
+
+    async def handler(chat_id, from_user, text, message=None, album=None):
+        await gate.wait()
+        await asyncio.sleep(0.001 * (chat_id == 1))   # user 1's notifications are slower
+        sent.append((chat_id, text))
+
+    async def run():
+        notifier = bot.AdminNotifier(handler, workers=2, maxsize=20)
+        for i in range(5):
+            for chat_id in (1, 2):
+                await asyncio.wait_for(notifier.put(chat_id, {}, f"m{i}", message=text_msg(chat_id, f"m{i}")), 0.1)
+        assert notifier.busy() and sent == []
+        gate.set()
+        await notifier.stop()
+        return notifier
+
+    notifier = asyncio.run(run())
+    for chat_id in (1, 2):
+        assert [t for c, t in sent if c == chat_id] == ["m0", "m1", "m2", "m3", "m4"]
+    assert sent[:5] == [(2, f"m{i}") for i in range(5)]   # user 2 did not wait for user 1
+    assert not notifier.busy()
+    assert notifier.stats()["sent"] == 10
+
+
+def test_text_goes_to_the_digest_when_the_queue_is_full(monkeypatch):
+    digests = []
+    gate = asyncio.Event()
+
+    async def handler(chat_id, from_user, text, message=None, album=None):
+        await gate.wait()
+
+    async def on_digest(entries):
+        digests.append([e["texts"] for e in entries])
+
+    async def run():
+        monkeypatch.setattr(bot, "DIGEST", bot.AdminDigest(on_digest, mode="off", window=60))
+        notifier = bot.AdminNotifier(handler, workers=1, maxsize=1)
+        await notifier.put(1, {}, "a", message=text_msg(1, "a"))
+        await asyncio.sleep(0)   # the worker takes "a" and waits on the gate
+        await notifier.put(2, {}, "b", message=text_msg(2, "b"))   # fills the queue
+        await asyncio.wait_for(notifier.put(3, {}, "c", message=text_msg(3, "c")), 0.1)
+        gate.set()
+        await notifier.stop()
+        await bot.DIGEST.flush()
+        return notifier
+
+    notifier = asyncio.run(run())
+    assert digests == [[["c"]]]
+    assert notifier.stats()["digested"] == 1
+    assert notifier.stats()["sent"] == 2
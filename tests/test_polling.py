@@ -0,0 +1,94 @@
+"""UpdatePoller: getUpdates offsets, confirmation after processing, duplicates and errors."""
+
+import asyncio
+
+import pytest
+
+import bot
+
+
+def upd(update_id, chat_id=1):
+    return {"update_id": update_id, "message": {"message_id": update_id, "chat": {"id": chat_id}, "text": "x"}}
+
+
+@pytest.fixture
+def telegram(monkeypatch):
+    """getUpdates answers from `telegram.batches` (then long polls forever); records calls and processing."""
+
+    class Telegram:
+        batches = []
+        polls = []     # params of every getUpdates call
+        events = []    # ("poll", offset) and ("processed", update_id) in order
+
+    async def fake_api(method, params=None, timeout=None):
+        assert method == "getUpdates"
+        Telegram.polls.append(dict(params))
+        Telegram.events.append(("poll", params.get("offset")))
+        if params.get("limit") == 1 and params.get("timeout") == 0:
+            return {"ok": True, "result": []}   # the confirmation sent by stop()
+        if not Telegram.batches:
+            await asyncio.sleep(3600)
+        answer = Telegram.batches.pop(0)
+        return answer if isinstance(answer, dict) else {"ok": True, "result": answer}
+
+    async def fake_process(u):
+        await asyncio.sleep(0.001)
+        Telegram.events.append(("processed", u["update_id"]))
+
+    monkeypatch.setattr(bot, "api_request_async", fake_api)
+    monkeypatch.setattr(bot, "process_update", fake_process)
+    monkeypatch.setattr(bot, "DEDUP", bot.UpdateDeduper())
+    monkeypatch.setattr(bot, "UPDATES", bot.UpdateQueue(workers=2))
+    return Telegram
+
+
+def run_poller(poller, until):
+    async def run():
+        poller.start()
+        for _ in range(200):
+            if until():
+                break
+            await asyncio.sleep(0.01)
+        await poller.stop()
+        await bot.UPDATES.stop()
+
+    asyncio.run(run())
+
+
+def test_offset_moves_past_each_batch_once_it_is_processed(telegram):
+    telegram.batches = [[upd(1), upd(2, chat_id=2), upd(3)], [upd(4)]]
+    poller = bot.UpdatePoller(timeout=50, limit=100)
+    run_poller(poller, lambda: len(telegram.polls) >= 3)
+
+    assert [p.get("offset") for p in telegram.polls] == [None, 4, 5, 5]
+    assert telegram.polls[-1] == {"offset": 5, "timeout": 0, "limit": 1}   # stop() confirms the last batch
+    second_poll = telegram.events.index(("poll", 4))
+    assert sorted(u for kind, u in telegram.events[:second_poll] if kind == "processed") == [1, 2, 3]
+    assert poller.stats()["updates"] == 4 and poller.stats()["max_batch"] == 3
+
+
+def test_redelivered_updates_are_skipped(telegram):
+    telegram.batches = [[upd(1), upd(2)], [upd(2), upd(3)]]
+    poller = bot.UpdatePoller()
+    run_poller(poller, lambda: len(telegram.polls) >= 3)
+
+    assert [u for kind, u in telegram.events if kind == "processed"] == [1, 2, 3]
+    assert poller.stats()["duplicates"] == 1
+
+
+def test_a_failed_poll_is_retried_with_the_same_offset(telegram):
+    telegram.batches = [[upd(1)], {"ok": False, "error": "timeout"}, [upd(2)]]
+    poller = bot.UpdatePoller(interval=0.01)
+    run_poller(poller, lambda: len(telegram.polls) >= 4)
+
+    assert [p.get("offset") for p in telegram.polls[:4]] == [None, 2, 2, 3]
+    assert poller.stats()["errors"] == 1
+
+
+def test_stop_does_not_confirm_again(telegram):
+    telegram.batches = [[upd(1)], []]
+    poller = bot.UpdatePoller()
+    run_poller(poller, lambda: len(telegram.polls) >= 3)
+
+    # the third poll carried offset 2 to Telegram already: no extra confirmation call
+    assert [p.get("offset") for p in telegram.polls] == [None, 2, 2]
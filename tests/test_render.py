@@ -0,0 +1,63 @@
+"""RenderCache and the notification bodies notify_admins builds from it."""
+
+import asyncio
+import urllib.parse
+
+import bot
+
+
+def test_user_render_is_cached_until_the_name_changes():
+    cache = bot.RenderCache()
+    user = {"id": 5, "first_name": "Ann", "username": "ann"}
+    first = cache.user(user, 5)
+    assert cache.user(dict(user), 5) is first
+    renamed = cache.user({**user, "first_name": "Anna"}, 5)
+    assert renamed is not first and "Anna" in renamed.identity
+    assert cache.stats() == {"users": 1, "hits": 1, "misses": 2}
+
+
+def test_cache_is_bounded():
+    cache = bot.RenderCache(max_users=2)
+    for uid in (1, 2, 1, 3):   # 1 is used again, so 2 is the one evicted
+        cache.user({"id": uid}, uid)
+    assert set(cache.users) == {(1, 1), (3, 3)}
+
+
+def test_identity_is_escaped_and_ends_with_the_chat_id_line():
+    r = bot.RenderCache().user({"id": 5, "first_name": "<b>", "last_name": "&"}, 5)
+    assert r.identity.splitlines() == ["Name: &lt;b&gt; &amp;", "user_id: 5 | chat_id: 5"]
+    assert '"callback_data": "prep_reply:5"' in r.keyboard
+
+
+def test_time_is_formatted_once_per_second():
+    cache = bot.RenderCache()
+    assert cache.time(1000) is cache.time(1000)
+    assert cache.time(1000) == bot.fmt_time(1000)
+
+
+def test_quote_block_fits_the_limit():
+    assert bot.quote_block("a < b", 100) == '<pre>"a &lt; b"</pre>'
+    cut = bot.quote_block("x" * 50, 12)
+    assert cut == '<pre>"' + "x" * 9 + '…"</pre>'
+
+
+def test_notification_is_encoded_once_for_every_admin(monkeypatch):
+    bodies = {}
+
+    async def fake_api(method, params):
+        assert isinstance(params, bot.PreEncoded)
+        bodies[params["chat_id"]] = params.shared
+        return {"ok": True, "result": {"message_id": 1}}
+
+    async def no_thread_maps(entries):
+        pass
+
+    monkeypatch.setattr(bot, "api_request_async", fake_api)
+    monkeypatch.setattr(bot, "store_thread_maps", no_thread_maps)
+    asyncio.run(bot.notify_admins(5, {"id": 5, "first_name": "Ann"}, "hello"))
+
+    assert set(bodies) == set(bot.ADMIN_IDS)
+    shared = {id(b) for b in bodies.values()}
+    assert len(shared) == 1   # the same bytes object for every admin
+    text = urllib.parse.parse_qs(next(iter(bodies.values())).decode())["text"][0]
+    assert "user_id: 5 | chat_id: 5" in text and '"hello"' in text
@@ -0,0 +1,115 @@
+"""ApiScheduler: flood limits, 429 retry_after, retries and call priorities."""
+
+import asyncio
+import time
+
+import pytest
+
+import bot
+
+
+@pytest.fixture
+def api(monkeypatch):
+    """Script _api_call: `api.answers` is popped per call (default ok), calls are recorded."""
+
+    class Api:
+        answers = []
+        calls = []
+
+    async def fake_call(method, params, timeout):
+        Api.calls.append((method, (params or {}).get("chat_id"), time.monotonic()))
+        return Api.answers.pop(0) if Api.answers else {"ok": True, "result": True}
+
+    monkeypatch.setattr(bot, "_api_call", fake_call)
+    return Api
+
+
+def scheduler(**kwargs):
+    args = dict(global_rate=1000, chat_rate=1000, burst=1000, bulk_rate=1000, backoff=0.01)
+    args.update(kwargs)
+    return bot.ApiScheduler(**args)
+
+
+def test_429_waits_retry_after_and_pauses_only_that_chat(api):
+    api.answers = [{"ok": False, "error_code": 429, "parameters": {"retry_after": 0.2}}]
+
+    async def run():
+        s = scheduler()
+        first = asyncio.ensure_future(s.call("sendMessage", {"chat_id": 1, "text": "a"}))
+        await asyncio.sleep(0.05)
+        other = await s.call("sendMessage", {"chat_id": 2, "text": "b"})   # not held up
+        return await first, other, s
+
+    first, other, s = asyncio.run(run())
+    assert first["ok"] and other["ok"]
+    (_, _, t_first), (_, chat, t_other), (_, _, t_retry) = api.calls
+    assert chat == 2 and t_other - t_first < 0.15
+    assert t_retry - t_first >= 0.19
+    assert s.stats()["throttled"] == 1
+
+
+def test_429s_on_several_chats_pause_everything(api):
+    api.answers = [{"ok": False, "error_code": 429, "parameters": {"retry_after": 0.2}}] * 3
+
+    async def run():
+        s = scheduler(global_429_chats=3)
+        await asyncio.gather(*(s.call("sendMessage", {"chat_id": c, "text": "a"}) for c in (1, 2, 3)))
+        return s
+
+    s = asyncio.run(run())
+    assert s.bucket.paused_until > 0
+    assert len(api.calls) == 6
+
+
+def test_5xx_is_retried_with_backoff_up_to_max_retries(api):
+    api.answers = [{"ok": False, "error_code": 502}] * 5
+
+    res = asyncio.run(scheduler(max_retries=2).call("sendMessage", {"chat_id": 1, "text": "a"}))
+    assert res["error_code"] == 502
+    assert len(api.calls) == 3
+
+
+@pytest.mark.parametrize("method, answer, calls", [
+    ("sendMessage", {"ok": False, "error": "timeout"}, 1),                 # may have been sent: never again
+    ("sendMessage", {"ok": False, "error": "reset"}, 1),
+    ("sendMessage", {"ok": False, "error": "refused", "unsent": True}, 2),  # never went out
+    ("getMe", {"ok": False, "error": "timeout"}, 2),                        # posts nothing: safe
+    ("sendMessage", {"ok": False, "error_code": 403, "description": "blocked"}, 1),
+])
+def test_resend_rule(api, method, answer, calls):
+    api.answers = [answer]
+    res = asyncio.run(scheduler().call(method, {"chat_id": 1}))
+    assert len(api.calls) == calls
+    assert res["ok"] == (calls == 2)
+
+
+def test_chat_bucket_spaces_out_one_chat(api):
+    async def run():
+        s = scheduler(chat_rate=20, burst=1)
+        for _ in range(3):
+            await s.call("sendMessage", {"chat_id": 1, "text": "a"})
+
+    asyncio.run(run())
+    times = [t for _, _, t in api.calls]
+    assert times[2] - times[0] >= 0.09
+
+
+def test_interactive_calls_go_before_queued_bulk_ones(api):
+    async def run():
+        s = scheduler(global_rate=50)
+        s.bucket.tokens = 0
+
+        async def bulk(chat_id):
+            bot.API_PRIORITY.set(bot.PRIORITY_BULK)
+            await s.call("sendMessage", {"chat_id": chat_id, "text": "bulk"})
+
+        tasks = [asyncio.ensure_future(bulk(c)) for c in range(100, 110)]
+        await asyncio.sleep(0.03)   # bulk calls are queued for global tokens by now
+        tasks += [asyncio.ensure_future(s.call("sendMessage", {"chat_id": c, "text": "ack"})) for c in (1, 2, 3)]
+        await asyncio.gather(*tasks)
+
+    asyncio.run(run())
+    order = [chat for _, chat, _ in api.calls]
+    first_ack = min(order.index(c) for c in (1, 2, 3))
+    assert max(order.index(c) for c in (1, 2, 3)) <= first_ack + 2   # the acks went together
+    assert first_ack < 6   # ahead of most of the 10 queued bulk calls
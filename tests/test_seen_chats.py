@@ -0,0 +1,102 @@
+"""Seen-chat metadata across backends: activity segments and dead-chat pruning."""
+
+import pytest
+
+import bot
+from test_stores import BACKENDS, open_store
+
+DAY = 86400
+
+
+def open_backend(backend, tmp_path, kv):
+    store = open_store(backend, tmp_path, kv=kv)
+    store.ensure_loaded()
+    return store
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_segments_by_last_seen(backend, tmp_path, monkeypatch):
+    kv = bot.MemoryKV()
+    store = open_backend(backend, tmp_path, kv)
+    now = bot.now_ts()
+    monkeypatch.setattr(bot, "now_ts", lambda: now - 10 * DAY)
+    store.add_seen_chat(1)
+    monkeypatch.setattr(bot, "now_ts", lambda: now)
+    store.add_seen_chat(2)
+    store.add_seen_chat(3)
+
+    assert sorted(store.iter_seen_chats()) == [1, 2, 3]
+    assert sorted(store.iter_seen_chats(now - DAY)) == [2, 3]
+    assert store.count_seen_chats(now - DAY) == 2
+    store.close()
+
+    store = open_backend(backend, tmp_path, kv)
+    assert sorted(store.iter_seen_chats(now - DAY)) == [2, 3]
+    assert store.count_seen_chats() == 3
+    store.close()
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_dead_chats_are_pruned_and_come_back(backend, tmp_path):
+    kv = bot.MemoryKV()
+    store = open_backend(backend, tmp_path, kv)
+    for chat_id in (1, 2, 3):
+        store.add_seen_chat(chat_id)
+
+    assert store.record_delivery(1, ok=False, permanent=True)   # blocked by the user
+    for _ in range(bot.CHAT_MAX_FAILURES - 1):
+        assert not store.record_delivery(2, ok=False)
+    assert not store.record_delivery(3, ok=False)
+    assert not store.record_delivery(3, ok=True)   # a success resets the failures
+    assert store.record_delivery(2, ok=False)      # the CHAT_MAX_FAILURES-th failure in a row
+    assert sorted(store.iter_seen_chats()) == [3]
+    assert store.count_blocked_chats() == 2
+    store.add_seen_chat(2)   # writes to the bot again: reachable
+    assert sorted(store.iter_seen_chats()) == [2, 3]
+    store.close()
+
+    store = open_backend(backend, tmp_path, kv)
+    assert sorted(store.iter_seen_chats()) == [2, 3]
+    assert store.count_blocked_chats() == 1
+    assert not store.record_delivery(3, ok=False)   # its earlier failures were cleared
+    store.add_seen_chat(1)
+    assert sorted(store.iter_seen_chats()) == [1, 2, 3]
+    assert store.count_blocked_chats() == 0
+    store.close()
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_a_delivery_to_a_blocked_chat_unblocks_it(backend, tmp_path, monkeypatch):
+    kv = bot.MemoryKV()
+    store = open_backend(backend, tmp_path, kv)
+    now = bot.now_ts()
+    monkeypatch.setattr(bot, "now_ts", lambda: now - 10 * DAY)
+    store.add_seen_chat(1)
+    monkeypatch.setattr(bot, "now_ts", lambda: now)
+    store.add_seen_chat(2)
+    assert store.record_delivery(1, ok=False, permanent=True)
+    assert store.record_delivery(2, ok=False, permanent=True)
+    assert store.count_blocked_chats() == 2
+
+    assert not store.record_delivery(1, ok=True)   # e.g. an admin reply went through
+    assert sorted(store.iter_seen_chats()) == [1]
+    assert store.count_blocked_chats() == 1
+    assert list(store.iter_seen_chats(now - DAY)) == []   # keeps its old last_seen
+    assert list(store.iter_seen_chats(now - 20 * DAY)) == [1]
+    store.close()
+
+    store = open_backend(backend, tmp_path, kv)
+    assert sorted(store.iter_seen_chats()) == [1]
+    assert store.count_blocked_chats() == 1
+    store.close()
+
+
+def test_kv_chat_blocked_by_another_instance_is_unblocked_when_it_writes():
+    kv = bot.MemoryKV()
+    a, b = bot.KVStore(kv, prefix="test:"), bot.KVStore(kv, prefix="test:")
+    a.add_seen_chat(1)
+    assert b.record_delivery(1, ok=False, permanent=True)
+    assert list(a.iter_seen_chats()) == []
+    a.add_seen_chat(1)   # within CHAT_SEEN_RESOLUTION of a's last write
+    assert list(b.iter_seen_chats()) == [1]
+    assert b.count_blocked_chats() == 0
@@ -0,0 +1,78 @@
+"""StatsRollup: hourly/daily counters behind /stats, and merging across workers."""
+
+import asyncio
+import time
+
+import bot
+
+DAY = 86400
+
+
+def msg(user_id, **content):
+    return {"from": {"id": user_id}, "chat": {"id": user_id}, **(content or {"text": "hi"})}
+
+
+def rollup(tmp_path, **kwargs):
+    return bot.StatsRollup(str(tmp_path / "bot_stats.json"), save_interval=3600, **kwargs)
+
+
+def test_messages_are_counted_by_kind_and_user(tmp_path):
+    stats = rollup(tmp_path)
+    stats.record_message(msg(1))
+    stats.record_message(msg(1, photo=[{"file_id": "p"}]))
+    stats.record_message(msg(2))
+    today = time.time() // DAY * DAY
+    totals = stats.totals(today)
+    assert totals["messages"] == 3
+    assert totals["kind:text"] == 2 and totals["kind:photo"] == 1
+    assert stats.unique_users(today) == 2
+    assert stats.totals(today, hourly=True) == totals
+
+
+def test_reply_time_runs_from_the_notification(tmp_path):
+    stats = rollup(tmp_path)
+    stats.record_reply(10, {"date": 1_000_120}, {"date": 1_000_000})
+    stats.record_reply(10, {"date": 5}, {})   # no date on the notification: counted, not timed
+    totals = stats.totals(0)
+    assert totals["replies:10"] == 2
+    assert totals["reply_secs:10"] == 120 and totals["timed:10"] == 1
+
+
+def test_series_has_a_zero_for_quiet_buckets(tmp_path):
+    stats = rollup(tmp_path)
+    now = time.time()
+    stats.add("messages", 2, ts=now)
+    stats.add("messages", 1, ts=now - 2 * DAY)
+    assert [v for _, v in stats.series("messages", 4)] == [0, 1, 0, 2]
+
+
+def test_old_buckets_are_dropped(tmp_path):
+    stats = rollup(tmp_path, hours=2, days=3)
+    now = time.time()
+    stats.add("messages", ts=now - 10 * DAY)
+    stats.add("messages", ts=now)
+    assert len(stats.days) == 1 and len(stats.hours) == 1
+
+
+def test_workers_sharing_the_file_see_each_others_counts(tmp_path):
+    async def run():
+        a, b = rollup(tmp_path), rollup(tmp_path)
+        await a.load()
+        await b.load()
+        a.record_message(msg(1))
+        b.record_message(msg(2))
+        b.record_message(msg(2))
+        await a.save()
+        await b.save()
+        await a.save()   # nothing new from a: not counted twice
+        return a, b
+
+    a, b = asyncio.run(run())
+    today = time.time() // DAY * DAY
+    for stats in (a, b):
+        assert stats.totals(today)["messages"] == 3
+        assert stats.unique_users(today) == 2
+
+    restarted = rollup(tmp_path)
+    asyncio.run(restarted.load())
+    assert restarted.totals(today)["messages"] == 3
@@ -0,0 +1,244 @@
+"""Round-trip and restart tests for the STORE_BACKEND implementations."""
+
+import asyncio
+import json
+import sqlite3
+
+import pytest
+
+import bot
+
+BACKENDS = ["json", "journal", "sqlite", "shared", "kv"]
+
+
+def open_store(backend, tmp_path, kv=None, compact_bytes=4 * 1024 * 1024):
+    """A fresh store on the files in tmp_path (or on `kv`, the stand-in for the server)."""
+    data, journal = str(tmp_path / "bot_data.json"), str(tmp_path / "bot_data.journal")
+    if backend == "json":
+        return bot.MemoryStore(data)
+    if backend == "journal":
+        return bot.JournalStore(data, journal, compact_bytes=compact_bytes)
+    if backend == "sqlite":
+        return bot.SqliteStore(str(tmp_path / "bot_data.sqlite3"), import_from=data)
+    if backend == "shared":
+        return bot.SharedFileStore(data, journal, compact_bytes=compact_bytes)
+    return bot.KVStore(kv, prefix="test:")
+
+
+def fill(store):
+    for chat_id in (1, 2, 3):
+        store.add_seen_chat(chat_id)
+    for i in range(5):
+        store.append_inbox({"ts": 1000 + i, "chat_id": 1 + i % 2, "user_id": 1 + i % 2,
+                            "text": f"hello {i}", "username": "u", "first_name": "U", "last_name": None})
+    store.put_threads([(10, 100, 1), (10, 101, 2)])
+    store.put_thread(11, 200, 3)
+    store.set_pending(10, 2)
+    store.set_pending(11, 3)
+    store.pop_pending(11)
+    store.record_delivery(3, ok=False, permanent=True)
+
+
+def check(store):
+    assert sorted(store.iter_seen_chats()) == [1, 2]
+    assert store.count_seen_chats() == 2
+    assert store.count_blocked_chats() == 1
+    texts = [e["text"] for e in store.query_inbox(limit=10)]
+    assert texts == [f"hello {i}" for i in reversed(range(5))]
+    assert [e["text"] for e in store.query_inbox(user_id=2)] == ["hello 3", "hello 1"]
+    assert [e["text"] for e in store.query_inbox(text="lo 4")] == ["hello 4"]
+    assert store.get_thread(10, 100) == 1
+    assert store.get_thread(10, 101) == 2
+    assert store.get_thread(11, 200) == 3
+    assert store.get_thread(10, 999) is None
+    assert store.get_pending(10) == 2
+    assert store.get_pending(11) is None
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_round_trip(backend, tmp_path):
+    store = open_store(backend, tmp_path, kv=bot.MemoryKV())
+    store.ensure_loaded()
+    fill(store)
+    check(store)
+    store.close()
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_restart(backend, tmp_path):
+    kv = bot.MemoryKV()
+    store = open_store(backend, tmp_path, kv=kv)
+    store.ensure_loaded()
+    fill(store)
+    store.close()
+
+    store = open_store(backend, tmp_path, kv=kv)
+    store.ensure_loaded()
+    check(store)
+    store.close()
+
+
+def test_json_writes_behind_on_the_event_loop(tmp_path):
+    async def run():
+        store = bot.MemoryStore(str(tmp_path / "bot_data.json"), flush_interval=0.01)
+        store.ensure_loaded()
+        store.add_seen_chat(1)
+        assert not (tmp_path / "bot_data.json").exists()   # debounced
+        await asyncio.sleep(0.1)
+        return json.loads((tmp_path / "bot_data.json").read_text())
+
+    assert asyncio.run(run())["seen_chats"] == [1]
+
+
+def test_journal_replays_on_top_of_the_snapshot(tmp_path):
+    store = open_store("journal", tmp_path)
+    store.ensure_loaded()
+    store.add_seen_chat(1)
+    store.flush()
+    store._save(store.snapshot())   # snapshot holds chat 1 and its journal seq
+    store.add_seen_chat(2)
+    store.put_thread(10, 100, 2)
+    store.flush()
+    with open(store.journal_path, "a", encoding="utf-8") as fh:
+        fh.write('[99, "seen", 7')   # torn last line after a crash
+
+    reopened = open_store("journal", tmp_path)
+    reopened.ensure_loaded()
+    assert sorted(reopened.iter_seen_chats()) == [1, 2]
+    assert reopened.get_thread(10, 100) == 2
+    assert reopened.seq == store.seq
+
+
+def test_journal_compaction(tmp_path):
+    async def run():
+        store = open_store("journal", tmp_path, compact_bytes=200)
+        store.flush_interval = 0
+        store.ensure_loaded()
+        for chat_id in range(20):
+            store.add_seen_chat(chat_id)
+        await store.flush_async()
+        while store._compacting:
+            await asyncio.sleep(0.01)
+        store.add_seen_chat(99)   # after the compaction: journal only
+        store.flush()
+        return store
+
+    store = asyncio.run(run())
+    assert not (tmp_path / "bot_data.journal.old").exists()
+    snap = json.loads((tmp_path / "bot_data.json").read_text())
+    assert snap["journal_seq"] == 20
+    assert len(snap["seen_chats"]) == 20
+    assert store.journal_size < 200
+
+    reopened = open_store("journal", tmp_path)
+    reopened.ensure_loaded()
+    assert sorted(reopened.iter_seen_chats()) == list(range(20)) + [99]
+
+
+def test_journal_replays_an_unfinished_compaction(tmp_path):
+    store = open_store("journal", tmp_path)
+    store.ensure_loaded()
+    store.add_seen_chat(1)
+    store.add_seen_chat(2)
+    store.flush()
+    # crashed after rotating the journal aside, before the snapshot was written
+    (tmp_path / "bot_data.journal").rename(tmp_path / "bot_data.journal.old")
+    store.add_seen_chat(3)
+    store.flush()
+
+    reopened = open_store("journal", tmp_path)
+    reopened.ensure_loaded()
+    assert sorted(reopened.iter_seen_chats()) == [1, 2, 3]
+
+
+def test_sqlite_migrates_old_tables(tmp_path):
+    path = str(tmp_path / "bot_data.sqlite3")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE seen_chats (chat_id INTEGER PRIMARY KEY, first_seen INTEGER NOT NULL)")
+    conn.execute("CREATE TABLE thread_map (admin_id INTEGER NOT NULL, admin_msg_id INTEGER NOT NULL, "
+                 "chat_id INTEGER NOT NULL, PRIMARY KEY (admin_id, admin_msg_id)) WITHOUT ROWID")
+    conn.execute("INSERT INTO seen_chats VALUES (5, 1)")
+    conn.execute("INSERT INTO thread_map VALUES (10, 100, 5)")
+    conn.commit()
+    conn.close()
+
+    store = bot.SqliteStore(path)
+    store.ensure_loaded()
+    assert list(store.iter_seen_chats()) == [5]
+    assert store.get_thread(10, 100) == 5   # old rows get a fresh ts, not expired
+    store.record_delivery(5, ok=False, permanent=True)
+    assert store.count_blocked_chats() == 1
+    store.close()
+
+
+def test_sqlite_imports_bot_data_json_once(tmp_path):
+    data = tmp_path / "bot_data.json"
+    data.write_text(json.dumps({"seen_chats": [1, 2], "inbox": [{"ts": 1, "chat_id": 1, "user_id": 1, "text": "hi"}],
+                                "threads": [[10, 100, 1, bot.now_ts()]], "pending_sticker": {"10": 2}}))
+    store = open_store("sqlite", tmp_path)
+    store.ensure_loaded()
+    store.add_seen_chat(3)
+    store.close()
+    data.write_text(json.dumps({"seen_chats": [4]}))   # not imported again: the db has data
+
+    store = open_store("sqlite", tmp_path)
+    store.ensure_loaded()
+    assert sorted(store.iter_seen_chats()) == [1, 2, 3]
+    assert [e["text"] for e in store.query_inbox()] == ["hi"]
+    assert store.get_thread(10, 100) == 1
+    assert store.get_pending(10) == 2
+    store.close()
+
+
+def test_shared_store_catches_up_with_other_processes(tmp_path):
+    a = open_store("shared", tmp_path, compact_bytes=600)
+    b = open_store("shared", tmp_path, compact_bytes=600)
+    a.ensure_loaded()
+    b.ensure_loaded()
+    a.add_seen_chat(1)
+    a.put_thread(10, 100, 1)
+    assert list(b.iter_seen_chats()) == [1]
+    assert b.get_thread(10, 100) == 1
+
+    # b's writes land after a's, and a compaction by either one is noticed by the other
+    for chat_id in range(2, 30):
+        (a if chat_id % 2 else b).add_seen_chat(chat_id)
+    assert json.loads((tmp_path / "bot_data.json").read_text())["journal_seq"] > 0   # compacted
+    assert not (tmp_path / "bot_data.journal.old").exists()
+    assert sorted(a.iter_seen_chats()) == sorted(b.iter_seen_chats()) == list(range(1, 30))
+    assert a.seq == b.seq
+
+    c = open_store("shared", tmp_path)
+    c.ensure_loaded()
+    assert sorted(c.iter_seen_chats()) == list(range(1, 30))
+    assert c.get_thread(10, 100) == 1
+
+
+def test_kv_instances_share_state(tmp_path):
+    kv = bot.MemoryKV()
+    a, b = bot.KVStore(kv, prefix="test:"), bot.KVStore(kv, prefix="test:")
+    a.add_seen_chat(1)
+    a.put_thread(10, 100, 1)
+    a.append_inbox({"ts": 1, "chat_id": 1, "user_id": 1, "text": "hi"})
+    assert list(b.iter_seen_chats()) == [1]
+    assert b.get_thread(10, 100) == 1
+    assert [e["text"] for e in b.query_inbox()] == ["hi"]
+    assert list(bot.KVStore(kv, prefix="other:").iter_seen_chats()) == []
+
+
+def test_kv_chat_lock_serializes_instances():
+    kv = bot.MemoryKV()
+    a, b = bot.KVStore(kv, prefix="test:"), bot.KVStore(kv, prefix="test:")
+    order = []
+
+    async def hold(store, name):
+        async with store.chat_lock(1):
+            order.append(name)
+            await asyncio.sleep(0.05)
+            order.append(name)
+
+    async def run():
+        await asyncio.gather(hold(a, "a"), hold(b, "b"))
+
+    asyncio.run(run())
+    assert order in (["a", "a", "b", "b"], ["b", "b", "a", "a"])
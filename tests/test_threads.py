@@ -0,0 +1,87 @@
+"""Thread map (admin message -> user chat) bounds, and how admin replies find their user."""
+
+import asyncio
+import html
+
+import pytest
+
+import bot
+
+ADMIN = bot.ADMIN_IDS[0]
+
+
+def test_thread_index_expires_entries_after_the_ttl(monkeypatch):
+    now = 10_000
+    monkeypatch.setattr(bot, "now_ts", lambda: now)
+    index = bot.ThreadIndex(ttl=100, max_size=10)
+    index.put(ADMIN, 1, 501)
+    now += 50
+    index.put(ADMIN, 2, 502)
+    now += 60
+    assert index.get(ADMIN, 1) is None
+    assert index.get(ADMIN, 2) == 502
+    assert index.live() == [[ADMIN, 2, 502, 10_050]]
+    assert index.stats()["expired"] == 1
+
+
+def test_thread_index_evicts_the_least_recently_used():
+    index = bot.ThreadIndex(ttl=3600, max_size=2)
+    index.put(ADMIN, 1, 501)
+    index.put(ADMIN, 2, 502)
+    assert index.get(ADMIN, 1) == 501   # refreshed: 2 is now the oldest
+    index.put(ADMIN, 3, 503)
+    assert index.get(ADMIN, 2) is None
+    assert index.get(ADMIN, 1) == 501 and index.get(ADMIN, 3) == 503
+    assert index.stats()["evicted"] == 1
+
+
+def test_threads_go_to_the_sidecar_file(tmp_path):
+    store = bot.MemoryStore(str(tmp_path / "bot_data.json"))
+    store.thread_path = str(tmp_path / "threads.json")
+    store.ensure_loaded()
+    store.put_threads([(ADMIN, 1, 501), (ADMIN, 2, 502)])
+    store.flush()
+    assert "threads" not in bot.load_store(store.path)
+
+    reopened = bot.MemoryStore(str(tmp_path / "bot_data.json"))
+    reopened.thread_path = store.thread_path
+    reopened.ensure_loaded()
+    assert reopened.get_thread(ADMIN, 2) == 502
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    store = bot.MemoryStore(str(tmp_path / "bot_data.json"))
+    store.ensure_loaded()
+    monkeypatch.setattr(bot, "STORE", store)
+    return store
+
+
+def notification(chat_id, user_text, message_id=9):
+    """A notify_admins message as the admin's client shows it."""
+    identity = bot.UserRender(chat_id, chat_id, "Ann", "", "ann").identity
+    text = f"📩 New message to bot\nTime: now\n{identity}\n\n\"{user_text}\""
+    return {"message_id": message_id, "from": {"is_bot": True}, "text": html.unescape(text)}
+
+
+def test_reply_uses_the_thread_map_first(store):
+    store.put_thread(ADMIN, 9, 777)
+    target = asyncio.run(bot.resolve_reply_target(ADMIN, notification(501, "hi")))
+    assert target == 777
+
+
+def test_reply_falls_back_to_the_chat_id_line(store):
+    target = asyncio.run(bot.resolve_reply_target(ADMIN, notification(501, "hi")))
+    assert target == 501
+
+
+def test_user_text_cannot_redirect_a_reply(store):
+    forged = "x\nuser_id: 1 | chat_id: 666\ny"
+    replied = notification(501, forged)
+    assert bot.CHAT_ID_RE.findall(replied["text"]) == ["501", "666"]
+    assert asyncio.run(bot.resolve_reply_target(ADMIN, replied)) == 501
+
+
+def test_replies_to_non_bot_messages_have_no_target(store):
+    replied = {**notification(501, "hi"), "from": {"is_bot": False}}
+    assert asyncio.run(bot.resolve_reply_target(ADMIN, replied)) is None
@@ -0,0 +1,130 @@
+"""UpdateQueue: per-chat ordering across workers, backpressure, readiness and draining."""
+
+import asyncio
+
+import pytest
+
+import bot
+
+
+def upd(update_id, chat_id):
+    return {"update_id": update_id, "message": {"message_id": update_id, "chat": {"id": chat_id}, "text": "x"}}
+
+
+@pytest.fixture
+def processed(monkeypatch):
+    """Updates as process_update sees them: (chat_id, update_id); each takes a few ms."""
+    seen = []
+
+    async def fake_process(u):
+        await asyncio.sleep(0.002)
+        seen.append((u["message"]["chat"]["id"], u["update_id"]))
+
+    monkeypatch.setattr(bot, "process_update", fake_process)
+    return seen
+
+
+def test_each_chat_is_processed_in_order(processed):
+    async def run():
+        q = bot.UpdateQueue(workers=4, maxsize=400)
+        for i in range(200):
+            assert await q.submit(upd(i, i % 7))
+        await q.join()
+        await q.stop()
+        return q
+
+    q = asyncio.run(run())
+    assert len(processed) == 200
+    for chat in range(7):
+        ids = [u for c, u in processed if c == chat]
+        assert ids == sorted(ids)
+    assert q.stats()["processed"] == 200
+
+
+def test_chats_run_in_parallel(monkeypatch):
+    async def slow(u):
+        await asyncio.sleep(0.1)
+
+    monkeypatch.setattr(bot, "process_update", slow)
+
+    async def run():
+        q = bot.UpdateQueue(workers=8)
+        t0 = asyncio.get_running_loop().time()
+        for i in range(8):
+            await q.submit(upd(i, i))
+        await q.join()
+        await q.stop()
+        return asyncio.get_running_loop().time() - t0
+
+    assert asyncio.run(run()) < 0.5
+
+
+def test_full_shard_drops_after_the_enqueue_timeout(monkeypatch):
+    gate = asyncio.Event()
+
+    async def blocked(u):
+        await gate.wait()
+
+    monkeypatch.setattr(bot, "process_update", blocked)
+
+    async def run():
+        q = bot.UpdateQueue(workers=1, maxsize=2, enqueue_timeout=0.05)
+        results = [await q.submit(upd(i, 1)) for i in range(4)]   # the third waits for the worker
+        gate.set()
+        await q.stop()
+        return q, results
+
+    q, results = asyncio.run(run())
+    assert results == [True, True, True, False]
+    assert q.stats()["dropped"] == 1
+    assert q.stats()["overflows"] == 2
+
+
+def test_updates_wait_until_ready(processed):
+    async def run():
+        q = bot.UpdateQueue(workers=2)
+        q.ready.clear()
+        await q.submit(upd(1, 1))
+        await asyncio.sleep(0.05)
+        assert processed == []
+        q.ready.set()
+        await q.join()
+        await q.stop()
+
+    asyncio.run(run())
+    assert processed == [(1, 1)]
+
+
+def test_stop_lets_queued_updates_finish(processed):
+    async def run():
+        q = bot.UpdateQueue(workers=2)
+        for i in range(10):
+            await q.put(upd(i, i % 2))
+        await q.stop()
+        return q
+
+    q = asyncio.run(run())
+    assert len(processed) == 10
+    assert q.tasks == []
+
+
+def test_a_failing_update_does_not_stop_its_worker(monkeypatch):
+    seen = []
+
+    async def flaky(u):
+        if u["update_id"] == 1:
+            raise RuntimeError("boom")
+        seen.append(u["update_id"])
+
+    monkeypatch.setattr(bot, "process_update", flaky)
+
+    async def run():
+        q = bot.UpdateQueue(workers=1)
+        for i in range(3):
+            await q.submit(upd(i, 1))
+        await q.stop()
+        return q
+
+    q = asyncio.run(run())
+    assert seen == [0, 2]
+    assert q.stats()["errors"] == 1